@@ -0,0 +1,69 @@
+import time
+import click
+
+from types import SimpleNamespace
+
+from langchain_core.language_models.fake_chat_models import FakeListChatModel
+
+import src.libs.agents.flow_agents as flow_agents
+from src.chat_llm import GraphBuilder
+from src.libs.plotter import Plotter
+from src.libs.state import GraphState
+
+
+def fake_models():
+    translator = FakeListChatModel(responses=['{"language": "english", "input": "How much energy did the lab use?"}'])
+    return SimpleNamespace(chat_model=translator, json_model=translator,
+                           ht_model=translator, ht_json_model=translator)
+
+
+def stub_connect(latency):
+    # Stands in for the connection DataDB used to open when constructed, no database needed
+    time.sleep(latency)
+
+
+def eager_node(llm_models, state, connect_latency):
+    # Previous behaviour: a new agent per node call, each one eagerly building
+    # a Plotter (and therefore a DataAccess/DataDB) it never uses. DataDB used
+    # to open its own connection when constructed, the pooled one no longer
+    # does, so that connection is simulated here to keep the comparison honest
+    agent = flow_agents.InputTranslator(llm_models, None, False)
+    agent.plotter  # the property builds the Plotter, as the old constructor did
+    stub_connect(connect_latency)
+    return agent.execute(state)
+
+
+def time_calls(fn, iterations):
+    timings = []
+    for _ in range(iterations):
+        state = GraphState.initialize('How much energy did the lab use?', [])
+        st = time.perf_counter()
+        fn(state)
+        timings.append(time.perf_counter() - st)
+    timings.sort()
+    return sum(timings) / len(timings), timings[len(timings) // 2]
+
+
+@click.command()
+@click.option('-n', '--iterations', default=200, help='Node calls per scenario.')
+@click.option('-c', '--connect-latency', default=0.02, help='Latency of every stub database connection, in seconds.')
+def main(iterations, connect_latency):
+    """Per-node overhead of building agents on every call vs. reusing the GraphBuilder agents"""
+    llm_models = fake_models()
+    builder = GraphBuilder(None, False, init_tools=False, llm_models=llm_models)
+
+    # Warm up imports and the plotly renderer configuration
+    Plotter()
+    builder.input_translator(GraphState.initialize('warm up', []))
+
+    eager_mean, eager_median = time_calls(lambda state: eager_node(llm_models, state, connect_latency), iterations)
+    reused_mean, reused_median = time_calls(builder.input_translator, iterations)
+
+    print(f'{"scenario":<28}{"mean (ms)":>12}{"median (ms)":>14}')
+    print(f'{"new agent + DB conn / call":<28}{eager_mean * 1000:>12.3f}{eager_median * 1000:>14.3f}')
+    print(f'{"reused GraphBuilder agent":<28}{reused_mean * 1000:>12.3f}{reused_median * 1000:>14.3f}')
+    print(f'Overhead removed per node call: {(eager_mean - reused_mean) * 1000:.3f} ms')
+
+
+if __name__ == '__main__':
+    main()
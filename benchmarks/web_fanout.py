@@ -0,0 +1,50 @@
+import time
+import asyncio
+import click
+
+from types import SimpleNamespace
+
+from langchain_core.language_models.fake_chat_models import FakeListChatModel
+
+from src.libs.agents.research_agents import ResearchInfoWeb
+from src.libs.state import GraphState
+from src.tools.web_search import StubWebSearchTool
+
+
+def fake_models():
+    # The keyword chain and the answer analyzer share the model, so responses alternate
+    model = FakeListChatModel(responses=['{"keywords": ["cesm lab", "cesm energy", "cesm devices"]}', 'Summary'])
+    return SimpleNamespace(chat_model=model, json_model=model, ht_model=model, ht_json_model=model)
+
+
+def time_runs(fn, iterations):
+    timings = []
+    for _ in range(iterations):
+        state = GraphState.initialize('What is the CESM lab?', [])
+        st = time.perf_counter()
+        fn(state)
+        timings.append(time.perf_counter() - st)
+    return sum(timings) / len(timings)
+
+
+@click.command()
+@click.option('-n', '--iterations', default=5, help='Searches per scenario.')
+@click.option('-l', '--latency', default=0.5, help='Latency of every stub search call, in seconds.')
+def main(iterations, latency):
+    """Latency of a 3 keyword web search done one keyword at a time vs. fanned out"""
+    agent = ResearchInfoWeb(fake_models(), None, StubWebSearchTool(latency), None, False)
+
+    agent.search_concurrency = 1
+    sequential = time_runs(agent.execute, iterations)
+    agent.search_concurrency = 3
+    threaded = time_runs(agent.execute, iterations)
+    concurrent = time_runs(lambda state: asyncio.run(agent.aexecute(state)), iterations)
+
+    print(f'{"scenario":<24}{"mean (s)":>10}')
+    print(f'{"sequential":<24}{sequential:>10.3f}')
+    print(f'{"thread pool fan-out":<24}{threaded:>10.3f}')
+    print(f'{"asyncio fan-out":<24}{concurrent:>10.3f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,9 @@
-import os
+import uuid
 import time
+import asyncio
+import concurrent.futures
 import click
-import pickle
+import queue
 import customtkinter
 
 from abc import ABC
@@ -11,41 +13,128 @@ from src.libs.state import GraphState
 from langgraph.graph.state import CompiledStateGraph
 from src.chat_llm import GraphBuilder
 from src.libs.memory import Memory
+from src.libs.cancellation import CancellationToken, TurnCancelledError
+from src.libs.history import HistoryManager, HistoryStore, STORE_ERRORS
+from src.libs.events import event_bus, EventBus, FileSink, CONTROL, DEBUG, STATUS
+from src.libs.rollups import RollupManager
+from src.config.db import DataDB, MemoryDB
+from src.config.env import settings
+
+# Milliseconds between two checks of the answer tokens and debug lines by the main loop
+ANSWER_POLL_INTERVAL = 30
+DEBUG_POLL_INTERVAL = 100
 
 class Chat(ABC):
-    def __init__(self, graph: CompiledStateGraph, recursion_limit, debug):
-        try:
-            os.remove("metadata/chat_history.pkl")
-        except:
-            pass
+    def __init__(self, graph: CompiledStateGraph, recursion_limit, debug, history: HistoryManager):
         self.graph = graph
         self.recursion_limit = recursion_limit
         self.debug = debug
         self.memory = Memory()
+        self.history = history
+        self.compaction = None
+
+        # Every turn runs on this loop: the async Groq and Tavily clients keep their
+        # connections between turns and an abort can cancel the running task
+        self.loop = asyncio.new_event_loop()
+        Thread(target=self.loop.run_forever, daemon=True).start()
+        self.cancellation = None
+
+    def prepare_inputs(self, input, cancellation):
+        # The user message is only saved along with its answer, an aborted turn leaves no trace
+        history = self.history.prompt_history() + [{"role": "user", "content": input}]
+
+        return GraphState.initialize(input, history, cancellation)
+
+    def save_turn(self, input, answer):
+        self.history.add("user", input)
+        self.history.add("assistant", answer)
+
+    async def save_answer(self, input, answer):
+        # The history store is a blocking database write
+        await asyncio.to_thread(self.save_turn, input, answer)
+        # Summarized in the background, the next turn only waits if it comes first
+        self.compaction = asyncio.ensure_future(self.compact_history())
+
+    async def compact_history(self):
+        try:
+            await self.history.acompact()
+        except Exception as e:
+            # The older messages stay out of the prompt until a later compaction succeeds
+            self.memory.save_debug(f'History compaction failed: {e}')
+
+    @staticmethod
+    def stream_modes(on_token):
+        # LLM tokens are only streamed when someone listens to them
+        return ["updates", "messages"] if on_token is not None else ["updates"]
 
-    def invoke(self, input) -> str:
-        # run the agent
+    @staticmethod
+    def answer_node(last_iter):
+        """Node whose tokens are the answer shown to the user"""
+        if last_iter.get('target_language', '').lower() == 'english':
+            return 'output_generator'
+        return 'output_translator'
+
+    def handle_token(self, message, metadata, last_iter, on_token):
+        if metadata.get('langgraph_node') == self.answer_node(last_iter) and message.content:
+            on_token(message.content)
+
+    def handle_output(self, output, last_iter, cancellation):
+        """Returns the updated last state, or None if the user asked to abort"""
+        if cancellation.cancelled:
+            return None
+        for key, value in output.items():
+            if value is not None:
+                last_iter = value
+            if self.debug:
+                self.memory.save_debug(f"Finished running <{key}> \n")
+        return last_iter
+
+    def abort(self):
+        """Cancels the running turn, including its in-flight LLM requests and database queries"""
+        if self.cancellation is not None:
+            self.cancellation.cancel()
+
+    def invoke(self, input, on_token=None) -> str:
+        """
+        Runs the agent on the chat loop and returns the final answer. When given,
+        `on_token` is called (from the loop thread) with every token of the answer
+        as it is generated
+        """
+        # Created before the turn is scheduled, so an abort clicked right away is never lost
+        cancellation = self.cancellation = CancellationToken()
+        future = asyncio.run_coroutine_threadsafe(self.ainvoke(input, on_token, cancellation), self.loop)
         try:
-            with open("metadata/chat_history.pkl", "rb") as f:
-                history = pickle.load(f)
-        except:
-            history = []
-        history.append({"role": "user", "content": input})
-        self.memory.save_history(history)
+            return future.result()
+        except concurrent.futures.CancelledError:
+            return 'Generation aborted'
 
-        inputs = GraphState.initialize(input, history)
+    async def ainvoke(self, input, on_token=None, cancellation=None) -> str:
+        # The nodes run as coroutines so many conversations can share one event
+        # loop instead of holding one thread each
+        if cancellation is None:
+            cancellation = self.cancellation = CancellationToken()
+        task = asyncio.current_task()
+        loop = asyncio.get_running_loop()
         last_iter = {}
-        for output in self.graph.stream(inputs, {"recursion_limit": self.recursion_limit}):
-            with open('metadata/chat_control.log', 'r') as f:
-                control_flag = f.read()
-            if control_flag == 'aborting':
-                last_iter['final_answer'] = 'Generation aborted'
-                break
-            for key, value in output.items():
-                if value is not None:
-                    last_iter = value
-                if self.debug:
-                    self.memory.save_debug(f"Finished running <{key}> \n")
+        try:
+            with cancellation.on_cancel(lambda: loop.call_soon_threadsafe(task.cancel)):
+                if self.compaction is not None:
+                    # Shielded: aborting the turn must not cancel the summary of the previous ones
+                    await asyncio.shield(self.compaction)
+                inputs = await asyncio.to_thread(self.prepare_inputs, input, cancellation)
+                cancellation.raise_if_cancelled()
+                async for mode, output in self.graph.astream(inputs, {"recursion_limit": self.recursion_limit}, stream_mode=self.stream_modes(on_token)):
+                    if mode == 'messages':
+                        self.handle_token(*output, last_iter, on_token)
+                        continue
+                    last_iter = self.handle_output(output, last_iter, cancellation)
+                    if last_iter is None:
+                        return 'Generation aborted'
+        except (asyncio.CancelledError, TurnCancelledError):
+            if not cancellation.cancelled:
+                raise
+            return 'Generation aborted'
+        await self.save_answer(input, last_iter['final_answer'])
         return last_iter['final_answer']
                 
 class App(customtkinter.CTk):
@@ -103,6 +192,7 @@ class App(customtkinter.CTk):
             
             # Tracking whether the user is at the bottom for each textbox
             self.is_user_at_bottom = True
+            self.debug_events = event_bus.subscribe(DEBUG)
 
             # Bind scroll events for each textbox
             self.debug_textbox.bind("<MouseWheel>", self.on_user_scroll)
@@ -113,6 +203,10 @@ class App(customtkinter.CTk):
         self.available = True
         self.chat_running = False
         self.is_first_message = True
+
+        # Answer tokens put by the chat thread, only the main loop touches the textbox
+        self.answer_queue = queue.Queue()
+        self.answer_start = None
     
     def on_user_scroll(self, event):
         # Detect when user scrolls manually and stop automatic scrolling
@@ -120,31 +214,25 @@ class App(customtkinter.CTk):
         if self.debug_textbox.yview()[1] == 1.0:
             self.is_user_at_bottom = True
     
-    def update_debug(self):
-        try:
-            os.remove('metadata/debug.log')
-        except:
-            pass
+    def clear_debug(self):
+        EventBus.drain(self.debug_events)
         self.debug_textbox.configure(state="normal")
         self.debug_textbox.delete('0.0', END)
         self.debug_textbox.configure(state="disabled")
-        last_position = 0
-        
-        while self.chat_running:
-            try:
-                with open('metadata/debug.log') as f:
-                    f.seek(last_position)
-                    new_log = f.read()
-                    last_position = f.tell()
-                
-                if new_log:
-                    self.debug_textbox.configure(state="normal")
-                    self.debug_textbox.insert(END, new_log)
-                    self.debug_textbox.configure(state="disabled")
-                    if self.is_user_at_bottom:
-                        self.debug_textbox.yview_moveto(1.0)  # Scroll to the bottom
-            except:
-                pass
+
+    def update_debug(self):
+        """Appends the new debug lines to the sidebar, runs on the main loop while the chat runs"""
+        # Read before draining so the lines published right before the chat stops are shown
+        chat_running = self.chat_running
+        new_log = ''.join(f'{payload}\n' for _, payload in EventBus.drain(self.debug_events))
+        if new_log:
+            self.debug_textbox.configure(state="normal")
+            self.debug_textbox.insert(END, new_log)
+            self.debug_textbox.configure(state="disabled")
+            if self.is_user_at_bottom:
+                self.debug_textbox.yview_moveto(1.0)  # Scroll to the bottom
+        if chat_running:
+            self.after(DEBUG_POLL_INTERVAL, self.update_debug)
             
     def loading_animation(self):
         states = ['   ', '.  ', '.. ', '...']
@@ -152,18 +240,9 @@ class App(customtkinter.CTk):
 
         def update_text():
             if self.chat_running:
-                try:
-                    with open('metadata/status.log', 'r') as f:
-                        status = f.read()
-                except:
-                    status = 'Processing'
-                try:
-                    with open('metadata/chat_control.log', 'r') as f:
-                        control_flag = f.read()
-                    if control_flag == 'aborting':
-                        status = 'Aborting'
-                except:
-                    pass
+                status = event_bus.last(STATUS, 'Processing')
+                if event_bus.last(CONTROL) == 'aborting':
+                    status = 'Aborting'
                 self.entry.configure(state="normal")
                 self.entry.delete('0.0', END)
                 self.entry.insert('0.0', f'{status}{states[self.animate_index]}')
@@ -185,28 +264,64 @@ class App(customtkinter.CTk):
         else:
             new_text = "\n\nUSER:\n" + self.input_text
         self.textbox.configure(state="normal")
-        self.textbox.insert(END, new_text)
+        self.textbox.insert(END, new_text + "\nASSISTANT:\n")
+        self.answer_start = self.textbox.index("end-1c")
         self.textbox.yview_moveto(1)
         self.textbox.configure(state="disabled")
         self.entry.delete("0.0", END)
-        Thread(target=self.call_llm).start()
+        # Disabled until the turn ends, loading_animation enables it again from the main loop
+        self.entry.configure(state="disabled")
+        self.available = False
+        event_bus.publish(STATUS, 'Processing')
+        if self.debug:
+            self.clear_debug()
         self.chat_running = True
-        Thread(target=self.loading_animation).start()
+        Thread(target=self.call_llm).start()
+        self.after(ANSWER_POLL_INTERVAL, self.show_answer)
+        self.loading_animation()
         if self.debug:
-            Thread(target=self.update_debug).start()
+            self.update_debug()
         self.is_first_message = False
     
+    def show_answer(self):
+        """Moves the answer tokens from the chat thread to the textbox, runs on the main loop"""
+        finished = False
+        # Read before inserting: the new text would always push the view off the bottom
+        followed = self.is_answer_followed()
+        self.textbox.configure(state="normal")
+        while not finished:
+            try:
+                kind, text = self.answer_queue.get_nowait()
+            except queue.Empty:
+                break
+            if kind == 'token':
+                self.textbox.insert(END, text)
+            else:
+                # The final answer replaces the streamed one: cached answers aren't
+                # streamed and the generated answer is cleaned up afterwards
+                self.textbox.delete(self.answer_start, END)
+                self.textbox.insert(END, text)
+                finished = True
+        if followed:
+            self.textbox.yview_moveto(1)
+        self.textbox.configure(state="disabled")
+        if not finished:
+            self.after(ANSWER_POLL_INTERVAL, self.show_answer)
+
+    def is_answer_followed(self):
+        return self.textbox.yview()[1] >= 0.99
+
     def button_callback(self):
         if self.button._text == 'Send':
+            event_bus.publish(CONTROL, 'running')
             self.submit_message()
-            with open('metadata/chat_control.log', 'w') as f:
-                f.write('running')
         elif self.button._text == 'Abort':
-            with open('metadata/chat_control.log', 'w') as f:
-                f.write('aborting')
+            event_bus.publish(CONTROL, 'aborting')
+            self.chat.abort()
     
     def on_enter(self, event):
         if self.available:
+            event_bus.publish(CONTROL, 'running')
             self.submit_message()
         return "break"
     
@@ -216,23 +331,16 @@ class App(customtkinter.CTk):
         return "break"
         
     def call_llm(self):
+        # Runs in its own thread: only the queue and flags are touched, never the widgets
         st = time.time()
-        self.entry.configure(state="disabled")
-        self.available = False
         try:
-            answer = self.chat.invoke(self.input_text)
+            answer = self.chat.invoke(self.input_text, lambda token: self.answer_queue.put(('token', token)))
         except Exception as e:
             self.memory.save_debug(e)
             answer = 'An error has ocurred, please try again'
-        new_text = "\nASSISTANT:\n" + answer
-        self.textbox.configure(state="normal")
-        self.textbox.insert("end", new_text)
-        self.textbox.yview_moveto(1)
-        self.textbox.configure(state="disabled")
-        self.entry.configure(state="normal")
+        self.answer_queue.put(('answer', answer))
         self.available = True
-        with open('metadata/chat_control.log', 'w') as f:
-            f.write('idle')
+        event_bus.publish(CONTROL, 'idle')
         self.chat_running = False
         print(f"Execution finished in {time.time()-st:.2f} seconds")
         
@@ -243,12 +351,28 @@ class App(customtkinter.CTk):
 
 @click.command()
 @click.option('-d', '--debug', is_flag=True, help='Activate the debugger.')
-def main(debug):
+@click.option('-s', '--session', default=None, help='Resume the chat session with this id.')
+def main(debug, session):
     print("Welcome to the Energy System Insight Tool (ESIT)")
     # TODO modify the way we get the path in CESM/core/input_parser.py
+    RollupManager(DataDB()).start_background_refresh(settings.ROLLUP_REFRESH_INTERVAL)
+    if settings.DEBUG_LOG_FILE:
+        FileSink(event_bus, settings.DEBUG_LOG_PATH, flush_interval=settings.DEBUG_LOG_FLUSH_INTERVAL)
     app = App(debug, 22)
-    graph = GraphBuilder('CESM/Data/Techmap', app, debug).build()
-    chat = Chat(graph, 40, debug)
+    builder = GraphBuilder(app, debug)
+    graph = builder.build()
+    history_store = None
+    if settings.HISTORY_STORE_ENABLED:
+        try:
+            history_store = HistoryStore(MemoryDB())
+            history_store.ensure_schema()
+        except STORE_ERRORS as e:
+            Memory().save_debug(f'History store unavailable, the history is kept in memory only: {e}')
+            history_store = None
+    session = session or uuid.uuid4().hex
+    print(f"Chat session: {session}")
+    history = HistoryManager(builder.llm_models.chat_model, store=history_store, session_id=session)
+    chat = Chat(graph, 40, debug, history)
     app.set_chat(chat)
     app.mainloop()
 
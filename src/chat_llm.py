@@ -1,7 +1,10 @@
+import asyncio
+
 from abc import ABC
 
 from langgraph.graph import END, StateGraph
 from langgraph.graph.state import CompiledStateGraph
+from langchain_core.runnables import RunnableLambda
 
 import src.libs.agents.main_agents as main_agents
 import src.libs.agents.flow_agents as flow_agents
@@ -11,51 +14,128 @@ import src.libs.agents.research_agents as research_agents
 import src.libs.routers as routers
 import src.libs.printers as printers
 from src.libs.state import GraphStateType
+from src.libs.memory import Memory
+from src.libs.semantic_cache import SemanticCache
 
 from src.tools.web_search import WebSearchTool
 from src.tools.rag_retriever import RAGRetriever
 
 from src.config.models import Models
+from src.config.env import settings
 
 
 class GraphBuilder(ABC):
-    def __init__(self, app, debug, init_tools=True):
-        self.llm_models = Models()
+    def __init__(self, app, debug, init_tools=True, llm_models=None):
+        self.llm_models = llm_models if llm_models is not None else Models()
 
         self.retriever = RAGRetriever(self.llm_models.chat_model) if init_tools else None
         self.web_tool = WebSearchTool() if init_tools else None
         
         self.debug = debug
         self.app = app
+        self.memory = Memory()
+        
+        # Agents are stateless between calls (the graph state is passed on every
+        # execution), so they are built once and reused for every turn
+        self.input_translator_agent = flow_agents.InputTranslator(self.llm_models, self.app, self.debug)
+        self.tool_selector_agent = flow_agents.ToolSelector(self.llm_models, self.app, self.debug)
+        self.research_info_web_agent = research_agents.ResearchInfoWeb(self.llm_models, self.retriever, self.web_tool, self.app, self.debug)
+        self.calculator_agent = tool_agents.Calculator(self.llm_models, self.app, self.debug)
+        self.context_analyzer_agent = flow_agents.ContextAnalyzer(self.llm_models, self.app, self.debug)
+        self.rag_search_agent = research_agents.ResearchInfoRAG(self.llm_models, self.retriever, self.web_tool, self.app, self.debug)
+        self.consult_data_agent = tool_agents.DataAgent(self.llm_models, self.app, self.debug)
+        self.output_generator_agent = main_agents.OutputGenerator(self.llm_models, self.app, self.debug)
+        self.output_translator_agent = flow_agents.OutputTranslator(self.llm_models, self.app, self.debug)
+
+        # Shares the RAG embedding model when there is one, data-backed entries are checked against the newest measurement
+        embedding_model = self.retriever.embedding_model if self.retriever is not None else None
+        self.semantic_cache = SemanticCache(embedding_model, lambda: self.consult_data_agent.plotter.data_access.data_version())
     
+    # Semantic cache (node of the Graph and storage after the output generation)
+
+    def cache_lookup(self, state: GraphStateType) -> GraphStateType:
+        if not settings.SEMANTIC_CACHE_ENABLED:
+            return state
+        kind, entry = self.semantic_cache.lookup(state['user_input'])
+        if kind is None:
+            return state
+        if self.debug:
+            self.memory.save_debug(f'---SEMANTIC CACHE---\nHIT ({kind}): {entry.question}\n')
+        state['cache_hit'] = kind
+        state['context'] = list(entry.context)
+        state['is_data_complete'] = True
+        if kind == 'answer':
+            state['final_answer'] = entry.answer
+        return state
+
+    async def acache_lookup(self, state: GraphStateType) -> GraphStateType:
+        # Embedding the question is CPU bound
+        return await asyncio.to_thread(self.cache_lookup, state)
+
+    def cache_store(self, state: GraphStateType) -> GraphStateType:
+        # Only tool-backed answers are reusable (conversation depends on the history)
+        # and plots are a side effect a cached answer can't show again
+        if (settings.SEMANTIC_CACHE_ENABLED and not state['cache_hit'] and state['context']
+                and not any('[PLOT SHOWN]' in context for context in state['context'])):
+            self.semantic_cache.store(state['user_input'], state['final_answer'], state['context'], state['data_version'])
+        return state
+
     # Agents (Nodes of the Graph)
     
     def input_translator(self, state: GraphStateType) -> GraphStateType:
-        return flow_agents.InputTranslator(self.llm_models, state, self.app, self.debug).execute()
+        return self.input_translator_agent.execute(state)
+
+    async def ainput_translator(self, state: GraphStateType) -> GraphStateType:
+        return await self.input_translator_agent.aexecute(state)
     
     def tool_selector(self, state: GraphStateType) -> GraphStateType:
-        return flow_agents.ToolSelector(self.llm_models, state, self.app, self.debug).execute()
+        return self.tool_selector_agent.execute(state)
 
+    async def atool_selector(self, state: GraphStateType) -> GraphStateType:
+        return await self.tool_selector_agent.aexecute(state)
+    
     def research_info_web(self, state: GraphStateType) -> GraphStateType:
-        return research_agents.ResearchInfoWeb(self.llm_models, self.retriever, self.web_tool, state, self.app, self.debug).execute()
+        return self.research_info_web_agent.execute(state)
 
+    async def aresearch_info_web(self, state: GraphStateType) -> GraphStateType:
+        return await self.research_info_web_agent.aexecute(state)
+    
     def calculator(self, state: GraphStateType) -> GraphStateType:
-        return tool_agents.Calculator(self.llm_models, state, self.app, self.debug).execute()
+        return self.calculator_agent.execute(state)
+
+    async def acalculator(self, state: GraphStateType) -> GraphStateType:
+        return await self.calculator_agent.aexecute(state)
     
     def context_analyzer(self, state: GraphStateType) -> GraphStateType:
-        return flow_agents.ContextAnalyzer(self.llm_models, state, self.app, self.debug).execute()
+        return self.context_analyzer_agent.execute(state)
+
+    async def acontext_analyzer(self, state: GraphStateType) -> GraphStateType:
+        return await self.context_analyzer_agent.aexecute(state)
     
     def rag_search(self, state: GraphStateType) -> GraphStateType:
-        return research_agents.ResearchInfoRAG(self.llm_models, self.retriever, self.web_tool, state, self.app, self.debug).execute()
+        return self.rag_search_agent.execute(state)
 
+    async def arag_search(self, state: GraphStateType) -> GraphStateType:
+        return await self.rag_search_agent.aexecute(state)
+    
     def consult_data(self, state: GraphStateType) -> GraphStateType:
-        return tool_agents.DataAgent(self.llm_models, state, self.app, self.debug).execute()
+        return self.consult_data_agent.execute(state)
 
+    async def aconsult_data(self, state: GraphStateType) -> GraphStateType:
+        return await self.consult_data_agent.aexecute(state)
+    
     def output_generator(self, state: GraphStateType) -> GraphStateType:
-        return main_agents.OutputGenerator(self.llm_models, state, self.app, self.debug).execute()
+        return self.cache_store(self.output_generator_agent.execute(state))
+
+    async def aoutput_generator(self, state: GraphStateType) -> GraphStateType:
+        state = await self.output_generator_agent.aexecute(state)
+        return await asyncio.to_thread(self.cache_store, state)
     
     def output_translator(self, state: GraphStateType) -> GraphStateType:
-        return flow_agents.OutputTranslator(self.llm_models, state, self.app, self.debug).execute()
+        return self.output_translator_agent.execute(state)
+
+    async def aoutput_translator(self, state: GraphStateType) -> GraphStateType:
+        return await self.output_translator_agent.aexecute(state)
     
     # Printers (nodes of the Graph)
 
@@ -70,6 +150,9 @@ class GraphBuilder(ABC):
     def bypass_router(self, state: GraphStateType) -> str:
         return routers.BypassRouter(state, self.debug).execute()
 
+    def cache_router(self, state: GraphStateType) -> str:
+        return routers.CacheRouter(state, self.debug).execute()
+
     def context_router(self, state: GraphStateType) -> str:
         return routers.ContextRouter(state, self.debug).execute()
 
@@ -81,19 +164,36 @@ class GraphBuilder(ABC):
     
     ##### Build the Graph #####
 
+    @staticmethod
+    def node(func, afunc) -> RunnableLambda:
+        # Sync and async implementations of the same node, the compiled graph
+        # uses `func` with stream() and `afunc` with astream(). Both run with the
+        # turn's cancellation token active, so blocking calls deep inside the
+        # agents (database queries) can be interrupted when the user aborts
+        def run(state: GraphStateType) -> GraphStateType:
+            with state['cancellation'].activate():
+                return func(state)
+
+        async def arun(state: GraphStateType) -> GraphStateType:
+            with state['cancellation'].activate():
+                return await afunc(state)
+
+        return RunnableLambda(run, afunc=arun, name=func.__name__)
+
     def build(self) -> CompiledStateGraph:
         workflow = StateGraph(GraphStateType)
 
         ### Define the nodes ###
-        workflow.add_node("input_translator", self.input_translator)
-        workflow.add_node("tool_selector", self.tool_selector)
-        workflow.add_node("context_analyzer", self.context_analyzer)
-        workflow.add_node("web_search", self.research_info_web) # web search
-        workflow.add_node("calculator", self.calculator)
-        workflow.add_node("rag_search", self.rag_search)
-        workflow.add_node("consult_data", self.consult_data) 
-        workflow.add_node("output_generator", self.output_generator)
-        workflow.add_node("output_translator", self.output_translator)
+        workflow.add_node("input_translator", self.node(self.input_translator, self.ainput_translator))
+        workflow.add_node("semantic_cache", self.node(self.cache_lookup, self.acache_lookup))
+        workflow.add_node("tool_selector", self.node(self.tool_selector, self.atool_selector))
+        workflow.add_node("context_analyzer", self.node(self.context_analyzer, self.acontext_analyzer))
+        workflow.add_node("web_search", self.node(self.research_info_web, self.aresearch_info_web)) # web search
+        workflow.add_node("calculator", self.node(self.calculator, self.acalculator))
+        workflow.add_node("rag_search", self.node(self.rag_search, self.arag_search))
+        workflow.add_node("consult_data", self.node(self.consult_data, self.aconsult_data))
+        workflow.add_node("output_generator", self.node(self.output_generator, self.aoutput_generator))
+        workflow.add_node("output_translator", self.node(self.output_translator, self.aoutput_translator))
         workflow.add_node("context_state_printer", self.state_printer)
         workflow.add_node("final_answer_printer", self.final_answer_printer)
 
@@ -101,7 +201,17 @@ class GraphBuilder(ABC):
         
         # Entry and query type routing
         workflow.set_entry_point("input_translator")
-        workflow.add_edge("input_translator", "tool_selector")
+        workflow.add_edge("input_translator", "semantic_cache")
+        workflow.add_conditional_edges(
+            "semantic_cache",
+            self.cache_router,
+            {
+                "answer": "final_answer_printer",
+                "translate_answer": "output_translator",
+                "context": "output_generator",
+                "miss": "tool_selector",
+            }
+        )
         workflow.add_conditional_edges(
             "tool_selector",
             self.tool_router,
@@ -1,30 +1,251 @@
+import atexit
+import threading
+import time
+
 from abc import ABC
+from contextlib import contextmanager
 
 import pyodbc
 
 from src.config.env import settings
+from src.libs.cancellation import cancelling
 
 
-class DataDB(ABC):
-    def __init__(self):
-        self.conn = pyodbc.connect(
-            'DRIVER={PostgreSQL Unicode};'
-            f'SERVER={settings.DB_POSTGRESQL_SERVER};'
-            f'DATABASE={settings.DB_POSTGRESQL_DATA_DATABASE};'
-            f'UID={settings.DB_POSTGRESQL_USER};'
-            f'PWD={settings.DB_POSTGRESQL_PWD};'
-            f'PORT={settings.DB_POSTGRESQL_PORT};'
-        )
-        self.cursor = self.conn.cursor()
-        
-class MemoryDB(ABC):
+class PoolTimeoutError(Exception):
+    pass
+
+
+class ConnectionPool(ABC):
+    """
+    Bounded, thread-safe pool of pyodbc connections.
+
+    Connections are opened lazily up to `max_size`, handed out with `acquire`
+    and given back with `release` (or through the `connection`/`cursor`
+    context managers). Idle connections are health-checked before being
+    leased again and connections that broke while leased are discarded.
+    """
+    _pools = {}
+    _pools_lock = threading.Lock()
+
+    def __init__(self, connection_string, max_size, timeout, health_check_after):
+        self.connection_string = connection_string
+        self.max_size = max_size
+        self.timeout = timeout
+        self.health_check_after = health_check_after
+
+        self._cond = threading.Condition()
+        self._idle = []  # (connection, last_used) pairs, most recently used last
+        self._size = 0
+        self._closed = False
+        self._stats = {
+            'created': 0,
+            'closed': 0,
+            'acquired': 0,
+            'released': 0,
+            'waits': 0,
+            'wait_time': 0.0,
+            'timeouts': 0,
+            'health_check_failures': 0,
+        }
+
+    @classmethod
+    def for_database(cls, database, extra_attributes=''):
+        """Return the process-wide pool for the given database, creating it on first use"""
+        key = (database, extra_attributes)
+        with cls._pools_lock:
+            pool = cls._pools.get(key)
+            if pool is None:
+                connection_string = (
+                    'DRIVER={PostgreSQL Unicode};'
+                    f'SERVER={settings.DB_POSTGRESQL_SERVER};'
+                    f'DATABASE={database};'
+                    f'UID={settings.DB_POSTGRESQL_USER};'
+                    f'PWD={settings.DB_POSTGRESQL_PWD};'
+                    f'PORT={settings.DB_POSTGRESQL_PORT};'
+                    f'{extra_attributes}'
+                )
+                pool = cls(connection_string,
+                           max_size=settings.DB_POOL_MAX_SIZE,
+                           timeout=settings.DB_POOL_TIMEOUT,
+                           health_check_after=settings.DB_POOL_HEALTH_CHECK_AFTER)
+                cls._pools[key] = pool
+            return pool
+
+    @classmethod
+    def close_all(cls):
+        with cls._pools_lock:
+            pools = list(cls._pools.values())
+            cls._pools.clear()
+        for pool in pools:
+            pool.close()
+
+    def _connect(self):
+        conn = pyodbc.connect(self.connection_string)
+        with self._cond:
+            self._stats['created'] += 1
+        return conn
+
+    def _dispose(self, conn):
+        try:
+            conn.close()
+        except pyodbc.Error:
+            pass
+        with self._cond:
+            self._size -= 1
+            self._stats['closed'] += 1
+            self._cond.notify()
+
+    def _is_healthy(self, conn):
+        try:
+            cursor = conn.cursor()
+            cursor.execute('SELECT 1')
+            cursor.fetchone()
+            cursor.close()
+            return True
+        except pyodbc.Error:
+            return False
+
+    def acquire(self, timeout=None):
+        """Lease a connection, blocking up to `timeout` seconds when the pool is exhausted"""
+        timeout = self.timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        conn = None
+        last_used = None
+
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise pyodbc.InterfaceError('Connection pool is closed')
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    self._size += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats['timeouts'] += 1
+                    raise PoolTimeoutError(f'No connection available after {timeout:.1f}s (max_size={self.max_size})')
+                self._stats['waits'] += 1
+                wait_start = time.monotonic()
+                self._cond.wait(remaining)
+                self._stats['wait_time'] += time.monotonic() - wait_start
+
+        if conn is not None and time.monotonic() - last_used > self.health_check_after:
+            if not self._is_healthy(conn):
+                with self._cond:
+                    self._stats['health_check_failures'] += 1
+                try:
+                    conn.close()
+                except pyodbc.Error:
+                    pass
+                with self._cond:
+                    self._stats['closed'] += 1
+                conn = None
+
+        if conn is None:
+            try:
+                conn = self._connect()
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                    self._cond.notify()
+                raise
+
+        with self._cond:
+            self._stats['acquired'] += 1
+        return conn
+
+    def release(self, conn, discard=False):
+        """Give a leased connection back, closing it instead if it is broken or `discard` is set"""
+        if not discard:
+            try:
+                # Never hand out a connection with an open transaction
+                conn.rollback()
+            except pyodbc.Error:
+                discard = True
+
+        with self._cond:
+            self._stats['released'] += 1
+            if not discard and not self._closed:
+                self._idle.append((conn, time.monotonic()))
+                self._cond.notify()
+                return
+        self._dispose(conn)
+
+    @contextmanager
+    def connection(self, timeout=None):
+        conn = self.acquire(timeout)
+        discard = False
+        try:
+            yield conn
+        except (pyodbc.OperationalError, pyodbc.InterfaceError):
+            discard = True
+            raise
+        finally:
+            self.release(conn, discard)
+
+    @contextmanager
+    def cursor(self, timeout=None):
+        with self.connection(timeout) as conn:
+            cursor = conn.cursor()
+            try:
+                # Aborting the chat turn interrupts the query running on the cursor
+                with cancelling(cursor.cancel):
+                    yield cursor
+            finally:
+                try:
+                    cursor.close()
+                except pyodbc.Error:
+                    pass
+
+    def metrics(self):
+        with self._cond:
+            metrics = dict(self._stats)
+            metrics['size'] = self._size
+            metrics['idle'] = len(self._idle)
+            metrics['in_use'] = self._size - len(self._idle)
+            metrics['max_size'] = self.max_size
+        return metrics
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            idle = self._idle
+            self._idle = []
+        for conn, _ in idle:
+            self._dispose(conn)
+
+
+atexit.register(ConnectionPool.close_all)
+
+
+class PooledDB(ABC):
+    database = None
+    extra_attributes = ''
+
     def __init__(self):
-        self.conn = pyodbc.connect(
-            'DRIVER={PostgreSQL Unicode};'
-            f'SERVER={settings.DB_POSTGRESQL_SERVER};'
-            f'DATABASE={settings.DB_POSTGRESQL_MEMORY_DATABASE};'
-            f'UID={settings.DB_POSTGRESQL_USER};'
-            f'PWD={settings.DB_POSTGRESQL_PWD};'
-            f'PORT={settings.DB_POSTGRESQL_PORT};'
-        )
-        self.cursor = self.conn.cursor()
\ No newline at end of file
+        self.pool = ConnectionPool.for_database(self.database, self.extra_attributes)
+
+    def connection(self, timeout=None):
+        return self.pool.connection(timeout)
+
+    def cursor(self, timeout=None):
+        return self.pool.cursor(timeout)
+
+    def metrics(self):
+        return self.pool.metrics()
+
+
+class DataDB(PooledDB):
+    database = settings.DB_POSTGRESQL_DATA_DATABASE
+
+
+class MemoryDB(PooledDB):
+    database = settings.DB_POSTGRESQL_MEMORY_DATABASE
+
+
+class StreamingDataDB(DataDB):
+    # psqlODBC declares a server-side cursor and fetches `Fetch` rows at a time instead
+    # of buffering the whole result set, so fetchmany() really streams
+    extra_attributes = f'UseDeclareFetch=1;Fetch={settings.DB_STREAM_FETCH_SIZE};'
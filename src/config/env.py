@@ -8,6 +8,9 @@ class Settings(BaseSettings):
     LLAMA_CLOUD_API_KEY: SecretStr
     QDRANT_API_KEY: SecretStr
     QDRANT_URL: str
+    QDRANT_PATH: str = "metadata/qdrant"
+    VECTOR_STORE_BACKEND: str = "remote"
+    NUMPY_VECTOR_STORE_PATH: str = "metadata/vector_store"
     CHAT_MODEL: str
     HT_MODEL: str
     HUGGINGFACE_EMBEDDING_MODEL: str
@@ -17,6 +20,52 @@ class Settings(BaseSettings):
     DB_POSTGRESQL_USER: str
     DB_POSTGRESQL_PWD: str
     DB_POSTGRESQL_PORT: str
+    DB_POOL_MAX_SIZE: int = 5
+    DB_POOL_TIMEOUT: float = 30.0
+    DB_POOL_HEALTH_CHECK_AFTER: float = 60.0
+    DB_STREAM_FETCH_SIZE: int = 10000
+    ROLLUP_REFRESH_INTERVAL: float = 300.0
+    MEASUREMENT_CACHE_DIR: str = "metadata/measurement_cache"
+    MEASUREMENT_CACHE_SETTLE_MINUTES: float = 10.0
+    POWER_BOX_STATS_MODE: str = "sql"
+    OUTLIER_EWMA_SPAN: int = 60
+    OUTLIER_Z_THRESHOLD: float = 4.0
+    OUTLIER_MIN_SAMPLES: int = 30
+    OUTLIER_CHUNK_SIZE: int = 50000
+    LLM_CACHE_ENABLED: bool = True
+    LLM_CACHE_PATH: str = "metadata/llm_cache.sqlite"
+    LLM_CACHE_MAX_ENTRIES: int = 5000
+    LANGUAGE_DETECTION_THRESHOLD: float = 0.99
+    FAST_ROUTER_ENABLED: bool = True
+    SEMANTIC_CACHE_ENABLED: bool = True
+    SEMANTIC_CACHE_ANSWER_THRESHOLD: float = 0.95
+    SEMANTIC_CACHE_CONTEXT_THRESHOLD: float = 0.88
+    SEMANTIC_CACHE_TTL: float = 3600.0
+    SEMANTIC_CACHE_MAX_ENTRIES: int = 512
+    WEB_SEARCH_CONCURRENCY: int = 3
+    WEB_SEARCH_TIMEOUT: float = 15.0
+    RAG_SIMILARITY_TOP_K: int = 2
+    RAG_QUERY_MODE: str = "concurrent"
+    RAG_CONCURRENCY: int = 3
+    RAG_TIMEOUT: float = 60.0
+    RAG_RETRIEVAL_ONLY: bool = True
+    RAG_PARSER: str = "llamaparse"
+    RAG_PARSE_CACHE_DIR: str = "metadata/parse_cache"
+    RAG_CHUNK_SIZE: int = 1024
+    RAG_CHUNK_OVERLAP: int = 200
+    RAG_EMBED_WORKERS: int = 2
+    RAG_EMBED_BATCH_SIZE: int = 64
+    RAG_UPSERT_BATCH_SIZE: int = 256
+    RAG_EMBEDDING_CACHE_PATH: str = "metadata/embedding_cache.sqlite"
+    HISTORY_TOKEN_BUDGET: int = 1500
+    HISTORY_SUMMARY_TOKENS: int = 300
+    HISTORY_MIN_MESSAGES: int = 2
+    HISTORY_TOKENIZER: str = ""
+    HISTORY_STORE_ENABLED: bool = True
+    HISTORY_LOAD_MESSAGES: int = 20
+    DEBUG_LOG_FILE: bool = False
+    DEBUG_LOG_PATH: str = "metadata/debug.log"
+    DEBUG_LOG_FLUSH_INTERVAL: float = 1.0
 
     model_config = SettingsConfigDict(
         env_file=".env",
@@ -1,14 +1,129 @@
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+
 from abc import ABC
+from typing import Any, Optional
 
+from langchain_core.caches import BaseCache, RETURN_VAL_TYPE
+from langchain_core.load import dumps, loads
+from langchain_core.utils.json import parse_json_markdown
 from langchain_groq import ChatGroq
 from src.config.env import settings
 
 
+class LLMCache(BaseCache):
+    """
+    Persistent exact-match cache of LLM responses in SQLite.
+
+    langchain looks every call up by the rendered prompt and the llm string,
+    which holds the model name and every call parameter (including the bound
+    kwargs such as the JSON response format), so only byte-identical calls hit.
+    Beyond `max_entries` the least recently used responses are evicted.
+
+    Responses to JSON calls are only stored when they parse, otherwise a
+    malformed answer would be replayed on every retry of the same prompt.
+    """
+    def __init__(self, path=None, max_entries=None):
+        self.path = path or settings.LLM_CACHE_PATH
+        self.max_entries = max_entries or settings.LLM_CACHE_MAX_ENTRIES
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._stats = {'hits': 0, 'misses': 0, 'updates': 0, 'evicted': 0, 'rejected': 0}
+        with self._lock, self._conn:
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS llm_cache (
+                    key TEXT PRIMARY KEY,
+                    llm_string TEXT NOT NULL,
+                    response TEXT NOT NULL,
+                    last_used REAL NOT NULL
+                );
+            """)
+            self._conn.execute("CREATE INDEX IF NOT EXISTS llm_cache_last_used ON llm_cache (last_used);")
+
+    @staticmethod
+    def key(prompt: str, llm_string: str) -> str:
+        return hashlib.sha256(f'{llm_string}\x00{prompt}'.encode('utf-8')).hexdigest()
+
+    def lookup(self, prompt: str, llm_string: str) -> Optional[RETURN_VAL_TYPE]:
+        key = self.key(prompt, llm_string)
+        with self._lock:
+            row = self._conn.execute("SELECT response FROM llm_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self._stats['misses'] += 1
+                return None
+            self._stats['hits'] += 1
+            with self._conn:
+                self._conn.execute("UPDATE llm_cache SET last_used = ? WHERE key = ?", (time.time(), key))
+        try:
+            return loads(row[0])
+        except Exception:
+            # Written by an incompatible langchain version, treat as a miss
+            return None
+
+    @staticmethod
+    def parses(llm_string: str, return_val: RETURN_VAL_TYPE) -> bool:
+        """False for a JSON call (bound response format) whose response isn't valid JSON"""
+        if "'json_object'" not in llm_string:
+            return True
+        try:
+            for generation in return_val:
+                parse_json_markdown(generation.text)
+        except Exception:
+            return False
+        return True
+
+    def update(self, prompt: str, llm_string: str, return_val: RETURN_VAL_TYPE) -> None:
+        if not self.parses(llm_string, return_val):
+            with self._lock:
+                self._stats['rejected'] += 1
+            return
+        response = dumps(return_val)
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO llm_cache (key, llm_string, response, last_used) VALUES (?, ?, ?, ?)",
+                               (self.key(prompt, llm_string), llm_string, response, time.time()))
+            self._stats['updates'] += 1
+            size = self._conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+            if size > self.max_entries:
+                # Evict a tenth of the cache at once so not every insert pays for the eviction
+                evict = size - self.max_entries + max(1, self.max_entries // 10)
+                self._conn.execute("""
+                    DELETE FROM llm_cache WHERE key IN (
+                        SELECT key FROM llm_cache ORDER BY last_used LIMIT ?
+                    )
+                """, (evict,))
+                self._stats['evicted'] += evict
+
+    def clear(self, **kwargs: Any) -> None:
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM llm_cache")
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = self._conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+        return stats
+
+
 class Models(ABC):
     def __init__(self):
-        self.chat_model = ChatGroq(model=settings.CHAT_MODEL, api_key=settings.GROQ_API_KEY)
-        self.json_model = self.chat_model.bind(response_format={"type": "json_object"})
+        # Only the temperature 0 JSON models (routing and planning) are cached, where a cached
+        # decision is the one the model would make again. The free text models sample, and
+        # their prompts (timestamps, history) rarely repeat, so they are never cached
+        self.llm_cache = LLMCache() if settings.LLM_CACHE_ENABLED else None
+
+        self.chat_model = ChatGroq(model=settings.CHAT_MODEL, api_key=settings.GROQ_API_KEY, cache=False)
         
         # High Token model (higher limit for tokens per request, but has daily limit)
-        self.ht_model = ChatGroq(model=settings.HT_MODEL, api_key=settings.GROQ_API_KEY)
-        self.ht_json_model = self.ht_model.bind(response_format={"type": "json_object"})
+        self.ht_model = ChatGroq(model=settings.HT_MODEL, api_key=settings.GROQ_API_KEY, cache=False)
+
+        # Shared by both JSON models: the model name is part of the cache key
+        self.json_model = ChatGroq(model=settings.CHAT_MODEL, api_key=settings.GROQ_API_KEY, cache=self.llm_cache,
+                                   temperature=0).bind(response_format={"type": "json_object"})
+        self.ht_json_model = ChatGroq(model=settings.HT_MODEL, api_key=settings.GROQ_API_KEY, cache=self.llm_cache,
+                                      temperature=0).bind(response_format={"type": "json_object"})
@@ -1,12 +1,19 @@
 from langchain.prompts import PromptTemplate
 from langchain_core.output_parsers import JsonOutputParser
 from langchain_core.output_parsers import StrOutputParser
+from langchain_core.runnables import Runnable
 
+from src.config.env import settings
 from src.libs.state import GraphStateType
+from src.libs.language import LanguageDetector
+from src.libs.fast_router import FastRouter
 from src.libs.agents.main_agents import AgentBase
 
 
 class InputTranslator(AgentBase):
+    # Shared by every instance, the models are built once at import
+    language_detector = LanguageDetector()
+
     def get_prompt_template(self) -> PromptTemplate:
         return PromptTemplate(
             template="""<|begin_of_text|><|start_header_id|>system<|end_header_id|>
@@ -27,15 +34,23 @@ class InputTranslator(AgentBase):
             input_variables=["user_input"],
         )
     
-    def execute(self) -> GraphStateType:
-        user_input = self.state['user_input']
-        num_steps = self.state['num_steps']
+    def get_chain(self) -> Runnable:
+        return self.get_prompt_template() | self.ht_json_model | JsonOutputParser()
+
+    def get_inputs(self, state: GraphStateType) -> dict:
+        return {"user_input": state['user_input']}
+
+    def shortcut(self, state: GraphStateType):
+        # Most questions are already in English, only the others need the (daily-limited) HT model
+        if self.language_detector.is_english(state['user_input'], settings.LANGUAGE_DETECTION_THRESHOLD):
+            return {"language": "english", "input": state['user_input']}
+        return None
+
+    def update_state(self, state: GraphStateType, llm_output) -> GraphStateType:
+        user_input = state['user_input']
+        num_steps = state['num_steps']
         num_steps += 1
         
-        prompt = self.get_prompt_template()
-        llm_chain = prompt | self.ht_json_model | JsonOutputParser()
-
-        llm_output = llm_chain.invoke({"user_input": user_input})
         translated_user_input = llm_output['input']
         source_language = llm_output['language']
         
@@ -46,13 +61,15 @@ class InputTranslator(AgentBase):
             if source_language.lower() != 'english':
                 self.memory.save_debug(f'TRANSLATED INPUT:{translated_user_input.rstrip()}\n')
         
-        self.state['num_steps'] = num_steps
-        self.state['user_input'] = translated_user_input
-        self.state['target_language'] = source_language
+        state['num_steps'] = num_steps
+        state['user_input'] = translated_user_input
+        state['target_language'] = source_language
         
-        return self.state
+        return state
     
 class ToolSelector(AgentBase):
+    fast_router = FastRouter()
+
     def get_prompt_template(self) -> PromptTemplate:
         return PromptTemplate(
             template="""<|begin_of_text|><|start_header_id|>system<|end_header_id|>
@@ -85,27 +102,43 @@ class ToolSelector(AgentBase):
             input_variables=["user_input"],
         )
     
-    def execute(self) -> GraphStateType:
-        prompt = self.get_prompt_template()
-        llm_chain = prompt | self.json_model | JsonOutputParser()
-        
-        user_input = self.state['user_input']
-        num_steps = self.state['num_steps']
+    def get_chain(self) -> Runnable:
+        return self.get_prompt_template() | self.json_model | JsonOutputParser()
+
+    def get_inputs(self, state: GraphStateType) -> dict:
+        return {"user_input": state['user_input']}
+
+    def shortcut(self, state: GraphStateType):
+        # Well-formed data questions go straight to the data operation, but only on the
+        # first pass: once there is context, what is still missing is the LLM's call
+        if settings.FAST_ROUTER_ENABLED and not state['context']:
+            data_request = self.fast_router.route(state['user_input'])
+            if data_request is not None:
+                return {"selected_tool": "consult_data", "data_request": data_request}
+        return None
+
+    def update_state(self, state: GraphStateType, llm_output) -> GraphStateType:
+        num_steps = state['num_steps']
         num_steps += 1
         
-        llm_output = llm_chain.invoke({"user_input": user_input})
         selected_tool = llm_output['selected_tool']
+        data_request = llm_output.get('data_request')
         
         if self.debug:
             self.memory.save_debug("---TOOL SELECTOR---")
             self.memory.save_debug(f'SELECTED TOOL: {selected_tool}\n')
+            if data_request is not None:
+                self.memory.save_debug(f'FAST ROUTE: {data_request}\n')
         
-        self.state['selected_tool'] = selected_tool
-        self.state['num_steps'] = num_steps
+        state['selected_tool'] = selected_tool
+        state['data_request'] = data_request
+        state['num_steps'] = num_steps
         
-        return self.state
+        return state
 
 class ContextAnalyzer(AgentBase):
+    status = 'Processing'
+
     def get_prompt_template(self) -> PromptTemplate:
         return PromptTemplate(
             template="""<|begin_of_text|><|start_header_id|>system<|end_header_id|>
@@ -133,27 +166,24 @@ class ContextAnalyzer(AgentBase):
             input_variables=["user_input","context","history"]
         )
         
-    def execute(self) -> GraphStateType:
-        self.memory.save_chat_status('Processing')
-        prompt = self.get_prompt_template()
-        llm_chain = prompt | self.chat_model | StrOutputParser()
+    def get_chain(self) -> Runnable:
+        return self.get_prompt_template() | self.chat_model | StrOutputParser()
+
+    def get_inputs(self, state: GraphStateType) -> dict:
+        return {"user_input": state['user_input'], "context": state['context'], "history": state['history']}
         
-        user_input = self.state['user_input']
-        context = self.state['context']
-        history = self.state['history']
-        num_steps = self.state['num_steps']
+    def update_state(self, state: GraphStateType, llm_output) -> GraphStateType:
+        num_steps = state['num_steps']
         num_steps += 1
-
-        llm_output = llm_chain.invoke({"user_input": user_input, "context": context, "history": history})
         
         if self.debug:
             self.memory.save_debug("---CONTEXT ANALYZER---")
             self.memory.save_debug(f'READY TO ANSWER: {llm_output}\n')
         
-        self.state['is_data_complete'] = llm_output.lower() == "ready"
-        self.state['num_steps'] = num_steps
+        state['is_data_complete'] = llm_output.lower() == "ready"
+        state['num_steps'] = num_steps
         
-        return self.state
+        return state
     
 class OutputTranslator(AgentBase):
     def get_prompt_template(self) -> PromptTemplate:
@@ -164,8 +194,9 @@ class OutputTranslator(AgentBase):
             
             The tool name is Energy System Insight Tool (ESIT), never translate this name. \n
             
-            Your output must be a JSON object with a single key, 'output', where you should
-            put the translated output. \n
+            Your output must be only the translated text, without any introduction,
+            comment or formatting of your own, since it is shown to the user as it
+            is generated. \n
             
             <|eot_id|><|start_header_id|>user<|end_header_id|>
             TOOL_OUTPUT : {tool_output} \n
@@ -174,22 +205,21 @@ class OutputTranslator(AgentBase):
             input_variables=["tool_output", "target_language"],
         )
     
-    def execute(self) -> GraphStateType:
-        final_answer = self.state['final_answer']
-        target_language = self.state['target_language']
-        num_steps = self.state['num_steps']
-        num_steps += 1
-        
+    def get_chain(self) -> Runnable:
+        # Plain text (instead of JSON) so the tokens can be streamed to the user
+        return self.get_prompt_template() | self.ht_model | StrOutputParser()
+
+    def get_inputs(self, state: GraphStateType) -> dict:
         if self.debug:
             self.memory.save_debug("---TRANSLATE OUTPUT---")
-            self.memory.save_debug(f'TARGET LANGUAGE: {target_language}\n')
-        
-        prompt = self.get_prompt_template()
-        llm_chain = prompt | self.ht_json_model | JsonOutputParser()
-
-        llm_output = llm_chain.invoke({"tool_output": final_answer, "target_language": target_language})
+            self.memory.save_debug(f'TARGET LANGUAGE: {state["target_language"]}\n')
+        return {"tool_output": state['final_answer'], "target_language": state['target_language']}
+    
+    def update_state(self, state: GraphStateType, llm_output) -> GraphStateType:
+        num_steps = state['num_steps']
+        num_steps += 1
         
-        self.state['num_steps'] = num_steps
-        self.state['final_answer'] = llm_output['output']
+        state['num_steps'] = num_steps
+        state['final_answer'] = llm_output.strip()
         
-        return self.state
+        return state
@@ -2,6 +2,7 @@ from abc import ABC, abstractmethod
 from datetime import datetime
 
 from langchain.prompts import PromptTemplate
+from langchain_core.runnables import Runnable
 from langchain_core.output_parsers import StrOutputParser
 
 from src.libs.plotter import Plotter
@@ -13,16 +14,26 @@ from src.libs.memory import Memory
 # TODO standardize the way the agents interact with the state
 
 class AgentBase(ABC):
-    def __init__(self, llm_models, state: GraphStateType, app, debug):
+    # Chat status shown to the user while the agent runs
+    status = None
+
+    def __init__(self, llm_models, app, debug):
         self.chat_model = llm_models.chat_model
         self.json_model = llm_models.json_model
         self.ht_model = llm_models.ht_model
         self.ht_json_model = llm_models.ht_json_model
-        self.state = state
         self.debug = debug
         self.app = app
         self.memory = Memory()
-        self.plotter = Plotter()
+        self._plotter = None
+
+    @property
+    def plotter(self) -> Plotter:
+        # Only data nodes need the plotter (and its database access), so it is
+        # created on first use and kept for the lifetime of the agent
+        if self._plotter is None:
+            self._plotter = Plotter()
+        return self._plotter
         
     def confirm_selection(self, selected_value):
         self.selected_value = selected_value
@@ -31,12 +42,47 @@ class AgentBase(ABC):
     def get_prompt_template(self) -> PromptTemplate:
         pass
 
-    def execute(self) -> GraphStateType:
-        return self.state
+    def get_chain(self) -> Runnable:
+        """Prompt, model and parser used by the agent"""
+        pass
+
+    def get_inputs(self, state: GraphStateType) -> dict:
+        """Prompt variables taken from the state"""
+        pass
+
+    def update_state(self, state: GraphStateType, llm_output) -> GraphStateType:
+        """Apply the chain output to the state"""
+        return state
+
+    def shortcut(self, state: GraphStateType):
+        """Output to use instead of calling the LLM when it can be worked out locally, None otherwise"""
+        return None
+
+    async def aupdate_state(self, state: GraphStateType, llm_output) -> GraphStateType:
+        # Blocking work done while applying the output (database, plots) overrides this
+        return self.update_state(state, llm_output)
+
+    def execute(self, state: GraphStateType) -> GraphStateType:
+        if self.status:
+            self.memory.save_chat_status(self.status)
+        llm_output = self.shortcut(state)
+        if llm_output is None:
+            llm_output = self.get_chain().invoke(self.get_inputs(state))
+        return self.update_state(state, llm_output)
+
+    async def aexecute(self, state: GraphStateType) -> GraphStateType:
+        if self.status:
+            self.memory.save_chat_status(self.status)
+        llm_output = self.shortcut(state)
+        if llm_output is None:
+            llm_output = await self.get_chain().ainvoke(self.get_inputs(state))
+        return await self.aupdate_state(state, llm_output)
 
 # TODO the outputs should also indicate if the model was runned etc...
 
 class OutputGenerator(AgentBase):
+    status = 'Generating output'
+
     def get_prompt_template(self) -> PromptTemplate:
         return PromptTemplate(
             template="""<|begin_of_text|><|start_header_id|>system<|end_header_id|>
@@ -95,20 +141,16 @@ class OutputGenerator(AgentBase):
             input_variables=["datetime","user_input","context","history"],
         )
         
-    def execute(self) -> GraphStateType:
-        self.memory.save_chat_status('Generating output')
-        prompt = self.get_prompt_template()
-        llm_chain = prompt | self.ht_model | StrOutputParser()
-        
-        ## Get the state
+    def get_chain(self) -> Runnable:
+        return self.get_prompt_template() | self.ht_model | StrOutputParser()
+
+    def get_inputs(self, state: GraphStateType) -> dict:
         date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        user_input = self.state['user_input']
-        context = self.state['context']
-        history = self.state['history']
-        num_steps = self.state['num_steps']
+        return {"datetime": date, "user_input": state['user_input'], "context": state['context'], "history": state['history']}
+        
+    def update_state(self, state: GraphStateType, llm_output) -> GraphStateType:
+        num_steps = state['num_steps']
         num_steps += 1
-
-        llm_output = llm_chain.invoke({"datetime": date, "user_input": user_input, "context": context, "history": history})
         
         if self.debug:
             self.memory.save_debug("---GENERATE OUTPUT---")
@@ -117,8 +159,7 @@ class OutputGenerator(AgentBase):
         if '\nSource:\n- None' in llm_output:
             llm_output = llm_output.replace('\nSource:\n- None','')
         
-        self.state['num_steps'] = num_steps
-        self.state['final_answer'] = llm_output
+        state['num_steps'] = num_steps
+        state['final_answer'] = llm_output
         
-        return self.state
-    
\ No newline at end of file
+        return state
@@ -1,23 +1,37 @@
+import asyncio
+
 from abc import ABC, abstractmethod
 
 from langchain.schema import Document
 from langchain.prompts import PromptTemplate
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.output_parsers import JsonOutputParser
+from langchain_core.runnables import Runnable
 
+from src.config.env import settings
+from src.libs.concurrency import fan_out, afan_out
 from src.libs.state import GraphStateType
 from src.libs.memory import Memory
 
 
 class ResearchAgentBase(ABC):
-    def __init__(self, llm_models, retriever, web_tool, state: GraphStateType, app, debug):
+    """
+    Research nodes: an LLM plans the searches (keywords, questions) from the
+    user input, the searches run, and the answer analyzer summarizes what they
+    found into the context. Subclasses provide the prompts and the searches,
+    the sync and async paths only differ in how the I/O is awaited.
+    """
+    # Chat status and debug title shown while the agent runs
+    status = None
+    title = None
+
+    def __init__(self, llm_models, retriever, web_tool, app, debug):
         self.retriever = retriever
         self.web_tool = web_tool
         self.chat_model = llm_models.chat_model
         self.json_model = llm_models.json_model
         self.ht_model = llm_models.ht_model
         self.ht_json_model = llm_models.ht_json_model
-        self.state = state
         self.debug = debug
         self.app = app
         self.memory = Memory()
@@ -49,10 +63,64 @@ class ResearchAgentBase(ABC):
     def get_prompt_template(self) -> PromptTemplate:
         pass
 
-    def execute(self) -> GraphStateType:
-        return self.state
+    def get_answer_analyzer_chain(self) -> Runnable:
+        return self.get_answer_analyzer_prompt_template() | self.chat_model | StrOutputParser()
+
+    def get_plan_chain(self) -> Runnable:
+        return self.get_prompt_template() | self.json_model | JsonOutputParser()
+
+    @abstractmethod
+    def get_plan_inputs(self, state: GraphStateType) -> dict:
+        pass
+
+    @abstractmethod
+    def parse_plan(self, llm_output) -> list:
+        """Searches to run, taken from the planning chain output"""
+        pass
+
+    @abstractmethod
+    def search(self, items):
+        """(search_results, sources) of the planned searches"""
+        pass
+
+    @abstractmethod
+    async def asearch(self, items):
+        pass
+
+    @abstractmethod
+    def update_state(self, state: GraphStateType, search_results, sources, processed_searches) -> GraphStateType:
+        pass
+
+    def start(self, state: GraphStateType) -> dict:
+        self.memory.save_chat_status(self.status)
+        if self.debug:
+            self.memory.save_debug(self.title)
+        return self.get_plan_inputs(state)
+
+    def get_analyzer_inputs(self, state: GraphStateType, search_results) -> dict:
+        return {"query": state['user_input'], "search_results": search_results, "context": state['context']}
+
+    def execute(self, state: GraphStateType) -> GraphStateType:
+        plan = self.get_plan_chain().invoke(self.start(state))
+        search_results, sources = self.search(self.parse_plan(plan))
+        processed_searches = self.get_answer_analyzer_chain().invoke(self.get_analyzer_inputs(state, search_results))
+        return self.update_state(state, search_results, sources, processed_searches)
+
+    async def aexecute(self, state: GraphStateType) -> GraphStateType:
+        plan = await self.get_plan_chain().ainvoke(self.start(state))
+        search_results, sources = await self.asearch(self.parse_plan(plan))
+        processed_searches = await self.get_answer_analyzer_chain().ainvoke(self.get_analyzer_inputs(state, search_results))
+        return self.update_state(state, search_results, sources, processed_searches)
     
 class ResearchInfoWeb(ResearchAgentBase):
+    status = 'Searching info in the internet'
+    title = "---RESEARCH INFO SEARCHING---"
+
+    def __init__(self, llm_models, retriever, web_tool, app, debug):
+        super().__init__(llm_models, retriever, web_tool, app, debug)
+        self.search_concurrency = settings.WEB_SEARCH_CONCURRENCY
+        self.search_timeout = settings.WEB_SEARCH_TIMEOUT
+
     def get_prompt_template(self) -> PromptTemplate:
         return PromptTemplate(
             template="""<|begin_of_text|><|start_header_id|>system<|end_header_id|>
@@ -71,61 +139,66 @@ class ResearchInfoWeb(ResearchAgentBase):
             input_variables=["query"],
         )
         
-    def execute(self) -> GraphStateType:
-        self.memory.save_chat_status('Searching info in the internet')
+    def format_results(self, idx, keyword, temp_docs):
+        web_results = ''
+        if type(temp_docs) == list:
+            for d in temp_docs:
+                web_results += f'Source: {d["url"]}\n{d["content"]}\n'
+            web_results = Document(page_content=web_results)
+        elif type(temp_docs) == dict:
+            web_results = f'\nSource: {temp_docs["url"]}\n{temp_docs["content"]}'
+            web_results = Document(page_content=web_results)
+        else:
+            web_results = 'No results'
         if self.debug:
-            self.memory.save_debug("---RESEARCH INFO SEARCHING---")
-            
-        query = self.state['user_input']
-        context = self.state['context']
-        num_steps = self.state['num_steps']
-        num_steps += 1
-        
-        prompt = self.get_prompt_template()
-        answer_analyzer_prompt = self.get_answer_analyzer_prompt_template()
-        
-        llm_chain = prompt | self.json_model | JsonOutputParser()
-        answer_analyzer_chain = answer_analyzer_prompt | self.chat_model | StrOutputParser()
-
-        # Web search
-        keywords = llm_chain.invoke({"query": query, "context": context})
-        keywords = keywords['keywords']
-        full_searches = []
-        for idx, keyword in enumerate(keywords):
-            temp_docs = self.web_tool.execute(keyword)
-            web_results = ''
-            if type(temp_docs) == list:
-                for d in temp_docs:
-                    web_results += f'Source: {d["url"]}\n{d["content"]}\n'
-                web_results = Document(page_content=web_results)
-            elif type(temp_docs) == dict:
-                web_results = f'\nSource: {temp_docs["url"]}\n{temp_docs["content"]}'
-                web_results = Document(page_content=web_results)
-            else:
-                web_results = 'No results'
-            if self.debug:
-                self.memory.save_debug(f'KEYWORD {idx}: {keyword}')
-                self.memory.save_debug(f'RESULTS FOR KEYWORD {idx}: {web_results}')
-            if full_searches is not None:
-                full_searches.append(web_results)
-            else:
-                full_searches = [web_results]
+            self.memory.save_debug(f'KEYWORD {idx}: {keyword}')
+            self.memory.save_debug(f'RESULTS FOR KEYWORD {idx}: {web_results}')
+        return web_results
 
-        processed_searches = answer_analyzer_chain.invoke({"query": query, "search_results": full_searches, "context": context})
-        
+    def get_plan_inputs(self, state: GraphStateType) -> dict:
+        return {"query": state['user_input'], "context": state['context']}
+
+    def parse_plan(self, llm_output) -> list:
+        return llm_output['keywords']
+
+    def format_searches(self, keywords, results):
+        return [self.format_results(idx, keyword, temp_docs)
+                for idx, (keyword, temp_docs) in enumerate(zip(keywords, results))], []
+
+    def search(self, keywords):
+        # All keywords are searched at once, a failed or timed out search counts as no results
+        return self.format_searches(keywords, fan_out(self.web_tool.execute, keywords, self.search_concurrency, self.search_timeout))
+
+    async def asearch(self, keywords):
+        return self.format_searches(keywords, await afan_out(self.web_tool.aexecute, keywords, self.search_concurrency, self.search_timeout))
+
+    def update_state(self, state: GraphStateType, full_searches, sources, processed_searches) -> GraphStateType:
         if self.debug:
             self.memory.save_debug(f'FULL RESULTS: {full_searches}\n')
             self.memory.save_debug(f'PROCESSED RESULT: {processed_searches}\n')
         
-        self.state['context'] = context + [processed_searches]
-        self.state['num_steps'] = num_steps
+        state['context'] = state['context'] + [processed_searches]
+        state['num_steps'] = state['num_steps'] + 1
         
-        return self.state
+        return state
     
 # TODO check the answer analyzer prompt
 # TODO create chain to decide whether to search information on the paper or on the CESM documentation
 
 class ResearchInfoRAG(ResearchAgentBase):
+    status = 'Consulting the source paper'
+    title = "---RAG PDF PAPER RETRIEVER---"
+
+    def __init__(self, llm_models, retriever, web_tool, app, debug):
+        super().__init__(llm_models, retriever, web_tool, app, debug)
+        # 'concurrent': one full query per question, all at once
+        # 'batched': one embedding batch and Qdrant request for all questions, then concurrent syntheses
+        self.query_mode = settings.RAG_QUERY_MODE
+        self.query_concurrency = settings.RAG_CONCURRENCY
+        self.query_timeout = settings.RAG_TIMEOUT
+        # Retrieved chunks go straight to the answer analyzer instead of being synthesized per question
+        self.retrieval_only = settings.RAG_RETRIEVAL_ONLY
+
     def get_prompt_template(self) -> PromptTemplate:
         return PromptTemplate(
             template="""<|begin_of_text|><|start_header_id|>system<|end_header_id|>
@@ -147,44 +220,77 @@ class ResearchInfoRAG(ResearchAgentBase):
             input_variables=["query"],
         )
         
-    def execute(self) -> GraphStateType:
-        self.memory.save_chat_status('Consulting the source paper')
-        question_rag_prompt = self.get_prompt_template()
-        answer_analyzer_prompt = self.get_answer_analyzer_prompt_template()
-        
-        question_rag_chain = question_rag_prompt | self.json_model | JsonOutputParser()
-        answer_analyzer_chain = answer_analyzer_prompt | self.chat_model | StrOutputParser()
-        
+    def format_answer(self, idx, question, temp_docs):
+        answer = temp_docs.response if temp_docs is not None else 'No answer'
         if self.debug:
-            self.memory.save_debug("---RAG PDF PAPER RETRIEVER---")
-            
-        query = self.state['user_input']
-        context = self.state['context']
-        num_steps = self.state['num_steps']
-        num_steps += 1
+            self.memory.save_debug(f'QUESTION {idx}: {question}')
+            self.memory.save_debug(f'ANSWER FOR QUESTION {idx}: {answer}')
+        return question + '\n\n' + answer + "\n\n\n"
+
+    def query(self, questions):
+        if self.query_mode == 'batched':
+            return self.retriever.execute_batch(questions, self.query_concurrency, self.query_timeout)
+        return fan_out(self.retriever.execute, questions, self.query_concurrency, self.query_timeout)
 
-        questions = question_rag_chain.invoke({"query": query})
-        questions = questions['questions']
+    async def aquery(self, questions):
+        if self.query_mode == 'batched':
+            return await self.retriever.aexecute_batch(questions, self.query_concurrency, self.query_timeout)
+        return await afan_out(self.retriever.aexecute, questions, self.query_concurrency, self.query_timeout)
 
+    def format_chunks(self, chunk_lists):
+        """Chunks retrieved for all the questions, deduplicated and best first, plus the list of sources used"""
+        chunks = {}
+        for chunk in (chunk for chunk_list in chunk_lists if chunk_list for chunk in chunk_list):
+            if chunk['id'] not in chunks or (chunk['score'] or 0) > (chunks[chunk['id']]['score'] or 0):
+                chunks[chunk['id']] = chunk
+        chunks = sorted(chunks.values(), key=lambda chunk: chunk['score'] or 0, reverse=True)
+
+        sources = []
         rag_results = []
-        for idx, question in enumerate(questions):
-            temp_docs = self.retriever.execute(question)
-            if self.debug:
-                self.memory.save_debug(f'QUESTION {idx}: {question}')
-                self.memory.save_debug(f'ANSWER FOR QUESTION {idx}: {temp_docs.response}')
-            question_results = question + '\n\n' + temp_docs.response + "\n\n\n"
-            if rag_results is not None:
-                rag_results.append(question_results)
+        for chunk in chunks:
+            source = chunk['file'] if chunk['page'] is None else f"{chunk['file']}, page {chunk['page']}"
+            if source not in sources:
+                sources.append(source)
+            rag_results.append(f"Source: {source}\n{chunk['text']}\n")
+        return rag_results, sources
+
+    def search(self, questions):
+        if self.retrieval_only:
+            if self.query_mode == 'batched':
+                chunk_lists = self.retriever.retrieve_many(questions)
+            else:
+                chunk_lists = fan_out(self.retriever.retrieve, questions, self.query_concurrency, self.query_timeout)
+            return self.format_chunks(chunk_lists)
+        answers = self.query(questions)
+        return [self.format_answer(idx, question, answer)
+                for idx, (question, answer) in enumerate(zip(questions, answers))], []
+
+    async def asearch(self, questions):
+        if self.retrieval_only:
+            if self.query_mode == 'batched':
+                chunk_lists = await asyncio.to_thread(self.retriever.retrieve_many, questions)
             else:
-                rag_results = [question_results]
+                chunk_lists = await afan_out(self.retriever.aretrieve, questions, self.query_concurrency, self.query_timeout)
+            return self.format_chunks(chunk_lists)
+        answers = await self.aquery(questions)
+        return [self.format_answer(idx, question, answer)
+                for idx, (question, answer) in enumerate(zip(questions, answers))], []
+
+    def get_plan_inputs(self, state: GraphStateType) -> dict:
+        return {"query": state['user_input']}
+
+    def parse_plan(self, llm_output) -> list:
+        return llm_output['questions']
+
+    def update_state(self, state: GraphStateType, rag_results, sources, processed_searches) -> GraphStateType:
         if self.debug:
             self.memory.save_debug(f'FULL ANSWERS: {rag_results}\n')
+
+        query = state['user_input']
+        source = '; '.join(sources) if sources else 'PDF paper'
+        result = f'Source: {source} \n{query}: \n{processed_searches}'
         
-        processed_searches = answer_analyzer_chain.invoke({"query": query, "search_results": rag_results, "context": context})
-        # TODO find a way of referencing the used pdfs
-        result = f'Source: PDF paper \n{query}: \n{processed_searches}'
-        
-        self.state['context'] = context + [result]
-        self.state['num_steps'] = num_steps
+        state['context'] = state['context'] + [result]
+        state['num_steps'] = state['num_steps'] + 1
         
-        return self.state
+        return state
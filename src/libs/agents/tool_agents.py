@@ -1,11 +1,17 @@
+import asyncio
+
 from langchain.prompts import PromptTemplate
+from langchain_core.runnables import Runnable
 from langchain_core.output_parsers import JsonOutputParser
 
 from src.libs.agents.main_agents import AgentBase
+from src.config.env import settings
 from src.libs.state import GraphStateType
 
     
 class Calculator(AgentBase):
+    status = 'Calculating result'
+
     def get_prompt_template(self) -> PromptTemplate:
         return PromptTemplate(
             template="""<|begin_of_text|><|start_header_id|>system<|end_header_id|>
@@ -38,17 +44,17 @@ class Calculator(AgentBase):
             input_variables=["query","context"],
         )
         
-    def execute(self) -> GraphStateType:
-        self.memory.save_chat_status('Calculating result')
-        prompt = self.get_prompt_template()
-        llm_chain = prompt | self.json_model | JsonOutputParser()
-    
-        query = self.state['user_input']
-        context = self.state['context']
-        num_steps = self.state['num_steps']
+    def get_chain(self) -> Runnable:
+        return self.get_prompt_template() | self.json_model | JsonOutputParser()
+
+    def get_inputs(self, state: GraphStateType) -> dict:
+        return {"query": state['user_input'], "context": state['context']}
+        
+    def update_state(self, state: GraphStateType, llm_output) -> GraphStateType:
+        context = state['context']
+        num_steps = state['num_steps']
         num_steps += 1
         
-        llm_output = llm_chain.invoke({"query": query, "context": context})
         equation = llm_output['equation']
         
         if self.debug:
@@ -62,12 +68,14 @@ class Calculator(AgentBase):
         if self.debug:
             self.memory.save_debug(f'RESULT: {str_result}\n')
             
-        self.state['context'] = context + [str_result]
-        self.state['num_steps'] = num_steps
+        state['context'] = context + [str_result]
+        state['num_steps'] = num_steps
         
-        return self.state
+        return state
     
 class DataAgent(AgentBase):
+    status = 'Getting data'
+
     def get_prompt_template(self) -> PromptTemplate:
         return PromptTemplate(
             template="""<|begin_of_text|><|start_header_id|>system<|end_header_id|>
@@ -85,7 +93,8 @@ class DataAgent(AgentBase):
             2. get_daily_consumption(period) - period can be "last_week", "last_month" or "last_year"
             3. get_power_readings_by_device(period) - period can be "yesterday" or "last_week"
             4. get_power_factor_analysis(device_id, period) - device_id is an integer, period can be "last_week" or "last_month"
-            5. no_op \n
+            5. get_power_outliers(period) - anomalous power intervals per device, period can be "yesterday", "last_week" or "last_month"
+            6. no_op \n
             
             Here is the device_id list if needed: \n
             - Computador 1 => ID: 1
@@ -134,17 +143,26 @@ class DataAgent(AgentBase):
             input_variables=["query","context"],
         )
         
-    def execute(self) -> GraphStateType:
-        self.memory.save_chat_status('Getting data')
-        prompt = self.get_prompt_template()
-        llm_chain = prompt | self.json_model | JsonOutputParser()
-    
-        query = self.state['user_input']
-        context = self.state['context']
-        num_steps = self.state['num_steps']
+    def get_chain(self) -> Runnable:
+        return self.get_prompt_template() | self.json_model | JsonOutputParser()
+
+    def get_inputs(self, state: GraphStateType) -> dict:
+        return {"query": state['user_input'], "context": state['context']}
+        
+    def shortcut(self, state: GraphStateType):
+        # Operation and parameters already parsed by the ToolSelector fast router
+        return state['data_request']
+
+    async def aupdate_state(self, state: GraphStateType, llm_output) -> GraphStateType:
+        # pyodbc and plotly are blocking, keep them off the event loop
+        return await asyncio.to_thread(self.update_state, state, llm_output)
+        
+    def update_state(self, state: GraphStateType, llm_output) -> GraphStateType:
+        context = state['context']
+        run_id = state['run_id']
+        num_steps = state['num_steps']
         num_steps += 1
         
-        llm_output = llm_chain.invoke({"query": query, "context": context})
         operation = llm_output['operation']
         parameters = llm_output['parameters']
         plot = llm_output['plot']
@@ -155,52 +173,81 @@ class DataAgent(AgentBase):
             self.memory.save_debug(f'PARAMETERS: {parameters}')
             self.memory.save_debug(f'PLOT: {plot}')
 
+        # Versioned before the fetch: readings arriving meanwhile make the cached answer stale, never the opposite
+        if settings.SEMANTIC_CACHE_ENABLED and state['data_version'] is None:
+            state['data_version'] = self.plotter.data_access.data_version()
+
         if operation == 'get_consumption_distribution':
             period = parameters[0]
-            dist = self.plotter.data_access.get_consumption_distribution(period)
+            dist = self.plotter.data_access.fetch(run_id, operation, period)
             labels = [f"{tipo.capitalize()}" for tipo in dist.keys()]
             values = [round(valor, 1) for valor in dist.values()]
             str_result = f'Consumo por tipo de aparelho em {period}: ' + ', '.join([f'{labels[i]}: {values[i]} kWh' for i in range(len(labels))])
             
             if plot:
-                self.plotter.plot_consumption_distribution(period)
+                self.plotter.plot_consumption_distribution(period, dist)
                 str_result += ' [PLOT SHOWN]'
         elif operation == 'get_daily_consumption':
             period = parameters[0]
-            daily_data = self.plotter.data_access.get_daily_consumption(period)
+            daily_data = self.plotter.data_access.fetch(run_id, operation, period)
             if not daily_data:
                 str_result = f'Não há dados para o período {period}.'
             else:
                 str_result = f'Consumo diário total em {period}: ' + ', '.join([f'{row[0]}: {round(row[1], 2)} kWh' for row in daily_data])
                 
                 if plot:
-                    self.plotter.plot_daily_consumption(period)
+                    self.plotter.plot_daily_consumption(period, daily_data)
                     str_result += ' [PLOT SHOWN]'
         elif operation == 'get_power_readings_by_device':
             period = parameters[0]
-            
-            self.plotter.plot_power_outliers(period)
-            str_result = 'The data is too extense for textual description, the plot was displayed to the user. [PLOT SHOWN]'
+            # Only the per-device box statistics and the real outliers are fetched
+            box_stats = self.plotter.data_access.fetch(run_id, 'get_power_box_stats', period)
+            stats, outliers = box_stats
+            if not stats:
+                str_result = f'Não há dados para o período {period}.'
+            else:
+                outlier_counts = {}
+                for name, _ in outliers:
+                    outlier_counts[name] = outlier_counts.get(name, 0) + 1
+                str_result = f'Distribuição de potência por aparelho em {period}: ' + ', '.join([f'{row[0]}: mediana {round(row[2], 2)} kW, IQR {round(row[1], 2)}-{round(row[3], 2)} kW, {outlier_counts.get(row[0], 0)} outliers' for row in stats])
+                
+                self.plotter.plot_power_outliers(period, box_stats)
+                str_result += ' [PLOT SHOWN]'
         elif operation == 'get_power_factor_analysis':
             device_id = parameters[0]
             period = parameters[1]
-            pf_data = self.plotter.data_access.get_power_factor_analysis(device_id, period)
-            if not pf_data:
+            pf_summary = self.plotter.data_access.fetch(run_id, operation, device_id, period)
+            if pf_summary.count == 0:
                 str_result = f'Não há dados para o aparelho ID {device_id} no período {period}.'
             else:
-                str_result = f'Análise de fator de potência para o aparelho ID {device_id} em {period}: ' + ', '.join([f'Potência: {round(row[0], 2)} kW, Fator de Potência: {round(row[1], 2)}' for row in pf_data])
+                correlation = pf_summary.correlation
+                str_result = (f'Análise de fator de potência para o aparelho ID {device_id} em {period}: '
+                              f'{pf_summary.count} leituras, potência média {round(pf_summary.mean_power, 2)} kW, '
+                              f'fator de potência médio {round(pf_summary.mean_power_factor, 2)}, '
+                              f'{round(100 * pf_summary.low_power_factor_share, 1)}% das leituras com fator de potência abaixo de {pf_summary.low_power_factor}'
+                              + (f', correlação potência/fator de potência {round(correlation, 2)}' if correlation is not None else ''))
                 
                 if plot:
-                    device_name = next((row[0] for row in pf_data if row[0] == device_id), f'Aparelho {device_id}')
-                    self.plotter.plot_power_factor_analysis(device_id, device_name, period)
+                    device_name = self.plotter.data_access.get_devices().get(int(device_id), (f'Aparelho {device_id}',))[0]
+                    self.plotter.plot_power_factor_analysis(device_id, device_name, period, pf_summary)
                     str_result += ' [PLOT SHOWN]'
+        elif operation == 'get_power_outliers':
+            period = parameters[0]
+            intervals = self.plotter.data_access.fetch(run_id, operation, period)
+            if not intervals:
+                str_result = f'Nenhuma anomalia de potência detectada em {period}.'
+            else:
+                # Only the most anomalous intervals go to the context
+                str_result = f'{len(intervals)} intervalos de potência anômala em {period}, os mais relevantes: ' + ', '.join([f'{row[0]} de {row[1]:%Y-%m-%d %H:%M} a {row[2]:%Y-%m-%d %H:%M} (pico {round(row[3], 2)} kW, esperado {round(row[4], 2)} kW)' for row in intervals[:10]])
         else:
             str_result = 'The requested data operation can not be performed, stop the execution and inform the user'
         
         if self.debug:
             self.memory.save_debug(f'RESULT: {str_result}\n')
             
-        self.state['context'] = context + [str_result]
-        self.state['num_steps'] = num_steps
+        state['context'] = context + [str_result]
+        state['num_steps'] = num_steps
+        state['data_backed'] = True
+        state['data_request'] = None
         
-        return self.state
\ No newline at end of file
+        return state
\ No newline at end of file
@@ -0,0 +1,315 @@
+import threading
+import numpy as np
+import pyodbc
+
+from abc import ABC
+from datetime import timedelta
+from scipy.signal import lfilter
+
+from src.config.db import DataDB
+from src.config.env import settings
+from src.libs.cancellation import cancelling
+from src.libs.rollups import ROLLUP_STATE_DDL
+
+
+MARK_NAME = 'outliers'
+ORIGIN_NAME = 'outliers_origin'
+
+
+class DeviceBaseline:
+    """Exponentially weighted mean/variance of one device plus its currently open anomaly"""
+    def __init__(self, mean=0.0, mean_sq=0.0, samples=0, last_timestamp=None, open_interval=None):
+        self.mean = mean
+        self.mean_sq = mean_sq
+        self.samples = samples
+        self.last_timestamp = last_timestamp
+        # [start, end, peak_power, baseline_power, max_score] or None
+        self.open_interval = open_interval
+
+
+class OutlierEngine(ABC):
+    """
+    Streaming power anomaly detector over the measurements table.
+
+    Rows are read in fixed-size keyset-paginated chunks ordered by time, so
+    memory stays bounded by the chunk size whatever the scanned window. Each
+    device keeps an EWMA baseline (mean and variance) that is carried across
+    chunks and across runs; readings more than `z_threshold` standard
+    deviations away from the baseline are anomalous and consecutive anomalous
+    readings are merged into intervals stored in power_anomalies. Every run
+    only processes the minutes after the high-water mark of the previous one,
+    and a window starting before everything processed so far only adds the
+    missing prefix.
+    """
+    def __init__(self, db: DataDB, span=None, z_threshold=None, min_samples=None, chunk_size=None,
+                 max_gap=timedelta(minutes=2), warmup=timedelta(days=1)):
+        self.db = db
+        span = span or settings.OUTLIER_EWMA_SPAN
+        self.alpha = 2.0 / (span + 1.0)
+        self.z_threshold = z_threshold or settings.OUTLIER_Z_THRESHOLD
+        self.min_samples = min_samples or settings.OUTLIER_MIN_SAMPLES
+        self.chunk_size = chunk_size or settings.OUTLIER_CHUNK_SIZE
+        self.max_gap = max_gap
+        self.warmup = warmup
+        self._lock = threading.Lock()
+        self._schema_ready = False
+
+    def ensure_schema(self, cursor):
+        cursor.execute(ROLLUP_STATE_DDL)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS outlier_state (
+                device_id INTEGER PRIMARY KEY,
+                mean DOUBLE PRECISION NOT NULL,
+                mean_sq DOUBLE PRECISION NOT NULL,
+                samples INTEGER NOT NULL,
+                last_timestamp TIMESTAMP,
+                open_start TIMESTAMP,
+                open_end TIMESTAMP,
+                open_peak DOUBLE PRECISION,
+                open_baseline DOUBLE PRECISION,
+                open_score DOUBLE PRECISION
+            );
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS power_anomalies (
+                device_id INTEGER NOT NULL,
+                start_ts TIMESTAMP NOT NULL,
+                end_ts TIMESTAMP NOT NULL,
+                peak_power DOUBLE PRECISION NOT NULL,
+                baseline_power DOUBLE PRECISION NOT NULL,
+                max_score DOUBLE PRECISION NOT NULL,
+                PRIMARY KEY (device_id, start_ts)
+            );
+        """)
+
+    def _get_mark(self, cursor, name):
+        cursor.execute("SELECT high_water_mark FROM rollup_state WHERE name = ?", (name,))
+        row = cursor.fetchone()
+        return row[0] if row else None
+
+    def _set_mark(self, cursor, name, value):
+        cursor.execute("""
+            INSERT INTO rollup_state (name, high_water_mark) VALUES (?, ?)
+            ON CONFLICT (name) DO UPDATE SET high_water_mark = EXCLUDED.high_water_mark;
+        """, (name, value))
+
+    def _load_baselines(self, cursor):
+        cursor.execute("""
+            SELECT device_id, mean, mean_sq, samples, last_timestamp,
+                   open_start, open_end, open_peak, open_baseline, open_score
+            FROM outlier_state;
+        """)
+        baselines = {}
+        for row in cursor.fetchall():
+            open_interval = list(row[5:10]) if row.open_start is not None else None
+            baselines[row.device_id] = DeviceBaseline(row.mean, row.mean_sq, row.samples, row.last_timestamp, open_interval)
+        return baselines
+
+    def _save_baselines(self, cursor, baselines):
+        rows = []
+        for device_id, baseline in baselines.items():
+            open_interval = baseline.open_interval or [None] * 5
+            rows.append((device_id, float(baseline.mean), float(baseline.mean_sq), int(baseline.samples),
+                         baseline.last_timestamp, *open_interval))
+        if not rows:
+            return
+        cursor.fast_executemany = True
+        cursor.executemany("""
+            INSERT INTO outlier_state
+                (device_id, mean, mean_sq, samples, last_timestamp, open_start, open_end, open_peak, open_baseline, open_score)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (device_id) DO UPDATE SET
+                mean = EXCLUDED.mean,
+                mean_sq = EXCLUDED.mean_sq,
+                samples = EXCLUDED.samples,
+                last_timestamp = EXCLUDED.last_timestamp,
+                open_start = EXCLUDED.open_start,
+                open_end = EXCLUDED.open_end,
+                open_peak = EXCLUDED.open_peak,
+                open_baseline = EXCLUDED.open_baseline,
+                open_score = EXCLUDED.open_score;
+        """, rows)
+
+    def _save_intervals(self, cursor, intervals):
+        if not intervals:
+            return
+        cursor.fast_executemany = True
+        cursor.executemany("""
+            INSERT INTO power_anomalies (device_id, start_ts, end_ts, peak_power, baseline_power, max_score)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (device_id, start_ts) DO UPDATE SET
+                end_ts = EXCLUDED.end_ts,
+                peak_power = EXCLUDED.peak_power,
+                baseline_power = EXCLUDED.baseline_power,
+                max_score = EXCLUDED.max_score;
+        """, intervals)
+
+    def iter_chunks(self, cursor, since, until):
+        """Yield (device_ids, timestamps, powers) arrays for readings in (since, until], chunk by chunk"""
+        query = """
+            SELECT m.timestamp, m.device_id, m.active_power
+            FROM measurements m
+            WHERE (m.timestamp, m.device_id) > (?, ?) AND m.timestamp <= ?
+            ORDER BY m.timestamp, m.device_id
+            LIMIT ?;
+        """
+        # Everything at `since` was already processed, so start after its last possible device
+        last_timestamp, last_device = since, int(np.iinfo(np.int32).max)
+        while True:
+            cursor.execute(query, (last_timestamp, last_device, until, self.chunk_size))
+            rows = cursor.fetchall()
+            if not rows:
+                return
+            timestamps, device_ids, powers = zip(*rows)
+            yield (np.asarray(device_ids, dtype=np.int64),
+                   np.asarray(timestamps, dtype='datetime64[us]'),
+                   np.asarray(powers, dtype=float))
+            last_timestamp, last_device = rows[-1][0], int(rows[-1][1])
+            if len(rows) < self.chunk_size:
+                return
+
+    def _process_device(self, device_id, baseline, timestamps, powers, closed):
+        valid = ~np.isnan(powers)
+        timestamps, powers = timestamps[valid], powers[valid]
+        if powers.size == 0:
+            return
+
+        # EWMA of x and x^2 in one vectorized pass, seeded with the carried baseline
+        a = self.alpha
+        if baseline.samples == 0:
+            baseline.mean, baseline.mean_sq = powers[0], powers[0] ** 2
+        mean, _ = lfilter([a], [1.0, a - 1.0], powers, zi=[(1.0 - a) * baseline.mean])
+        mean_sq, _ = lfilter([a], [1.0, a - 1.0], powers ** 2, zi=[(1.0 - a) * baseline.mean_sq])
+
+        # Each reading is scored against the baseline built from the readings before it
+        prev_mean = np.concatenate(([baseline.mean], mean[:-1]))
+        prev_mean_sq = np.concatenate(([baseline.mean_sq], mean_sq[:-1]))
+        std = np.sqrt(np.maximum(prev_mean_sq - prev_mean ** 2, 1e-12))
+        scores = np.abs(powers - prev_mean) / std
+        seen = baseline.samples + np.arange(powers.size)
+        anomalous = np.flatnonzero((scores > self.z_threshold) & (seen >= self.min_samples))
+
+        for i in anomalous:
+            ts = timestamps[i].item()
+            interval = baseline.open_interval
+            if interval is not None and ts - interval[1] <= self.max_gap:
+                interval[1] = ts
+                if abs(powers[i] - prev_mean[i]) > abs(interval[2] - interval[3]):
+                    interval[2], interval[3] = float(powers[i]), float(prev_mean[i])
+                interval[4] = max(interval[4], float(scores[i]))
+            else:
+                if interval is not None:
+                    closed.append((device_id, *interval))
+                baseline.open_interval = [ts, ts, float(powers[i]), float(prev_mean[i]), float(scores[i])]
+
+        last_ts = timestamps[-1].item()
+        if baseline.open_interval is not None and last_ts - baseline.open_interval[1] > self.max_gap:
+            closed.append((device_id, *baseline.open_interval))
+            baseline.open_interval = None
+
+        baseline.mean, baseline.mean_sq = float(mean[-1]), float(mean_sq[-1])
+        baseline.samples += int(powers.size)
+        baseline.last_timestamp = last_ts
+
+    def run(self, start, until):
+        """Process every reading up to `until` not seen yet, making sure [start, until] is covered"""
+        with self._lock, self.db.connection() as conn:
+            cursor = conn.cursor()
+            read_cursor = conn.cursor()
+            try:
+                # Aborting the chat turn interrupts whichever query is running, nothing of the run is kept
+                with cancelling(cursor.cancel), cancelling(read_cursor.cancel):
+                    return self._run(conn, cursor, read_cursor, start, until)
+            except Exception:
+                try:
+                    conn.rollback()
+                except pyodbc.Error:
+                    # A broken connection is discarded by the pool anyway
+                    pass
+                raise
+
+    def _run(self, conn, cursor, read_cursor, start, until):
+        """Body of `run`, on the connection held by it"""
+        if not self._schema_ready:
+            # Committed on its own so a failed run can't roll the tables back
+            self.ensure_schema(cursor)
+            conn.commit()
+            self._schema_ready = True
+        origin = self._get_mark(cursor, ORIGIN_NAME)
+        mark = self._get_mark(cursor, MARK_NAME)
+
+        if origin is None or mark is None:
+            # Nothing processed yet: start from the requested window, with a warm-up
+            cursor.execute("DELETE FROM outlier_state;")
+            cursor.execute("DELETE FROM power_anomalies;")
+            origin, mark = start - self.warmup, None
+            self._set_mark(cursor, ORIGIN_NAME, origin)
+        elif start - self.warmup < origin:
+            # Requested window starts before anything processed: only the missing prefix is scanned
+            self._scan_prefix(cursor, read_cursor, start - self.warmup, origin, mark)
+            origin = start - self.warmup
+            self._set_mark(cursor, ORIGIN_NAME, origin)
+
+        since = mark or origin
+        if since >= until:
+            conn.commit()
+            return mark
+
+        baselines = self._load_baselines(cursor)
+        mark = self._scan(cursor, read_cursor, baselines, since, until) or mark
+
+        # Open intervals are stored too (and extended by the next run through the upsert)
+        self._save_intervals(cursor, [(device_id, *b.open_interval) for device_id, b in baselines.items()
+                                      if b.open_interval is not None])
+        self._save_baselines(cursor, baselines)
+        if mark is not None:
+            self._set_mark(cursor, MARK_NAME, mark)
+        conn.commit()
+        return mark
+
+    def _scan(self, cursor, read_cursor, baselines, since, until):
+        """Runs the readings in (since, until] through `baselines`, saving the closed intervals. Newest timestamp read or None"""
+        mark = None
+        for device_ids, timestamps, powers in self.iter_chunks(read_cursor, since, until):
+            closed = []
+            order = np.argsort(device_ids, kind='stable')
+            device_ids, timestamps, powers = device_ids[order], timestamps[order], powers[order]
+            unique_ids, first_index = np.unique(device_ids, return_index=True)
+            bounds = list(first_index) + [len(device_ids)]
+            for i, device_id in enumerate(unique_ids):
+                baseline = baselines.setdefault(int(device_id), DeviceBaseline())
+                self._process_device(int(device_id), baseline, timestamps[bounds[i]:bounds[i + 1]],
+                                     powers[bounds[i]:bounds[i + 1]], closed)
+            self._save_intervals(cursor, closed)
+            mark = timestamps.max().item()
+        return mark
+
+    def _scan_prefix(self, cursor, read_cursor, new_origin, origin, mark):
+        """
+        Detects the anomalies of (new_origin, origin] and merges them with the
+        ones already stored. The prefix baselines are thrown away afterwards,
+        the stored ones are further ahead. The scan runs one warm-up past
+        `origin`, where the stored baselines were still warming up, and its
+        intervals replace the stored ones lying there. An anomaly crossing
+        the end of that overlap may be stored as two overlapping intervals.
+        """
+        overlap_end = min(origin + self.warmup, mark)
+        cursor.execute("DELETE FROM power_anomalies WHERE start_ts > ? AND end_ts <= ?;", (origin, overlap_end))
+        baselines = {}
+        self._scan(cursor, read_cursor, baselines, new_origin, overlap_end)
+        self._save_intervals(cursor, [(device_id, *b.open_interval) for device_id, b in baselines.items()
+                                      if b.open_interval is not None])
+
+    def get_intervals(self, start, end):
+        """Anomalous intervals overlapping [start, end) as (name, start, end, peak, baseline, score) tuples"""
+        self.run(start, end)
+        query = """
+            SELECT d.name, a.start_ts, a.end_ts, a.peak_power, a.baseline_power, a.max_score
+            FROM power_anomalies a
+            JOIN devices d ON d.device_id = a.device_id
+            WHERE a.end_ts >= ? AND a.start_ts < ?
+            ORDER BY a.max_score DESC;
+        """
+        with self.db.cursor() as cursor:
+            cursor.execute(query, (start, end))
+            return [tuple(row) for row in cursor.fetchall()]
@@ -0,0 +1,87 @@
+import contextvars
+import threading
+
+from abc import ABC
+from contextlib import contextmanager
+from typing import Optional
+
+
+class TurnCancelledError(Exception):
+    pass
+
+
+class CancellationToken(ABC):
+    """
+    Cooperative cancellation of a chat turn.
+
+    The work in flight registers how it can be interrupted (cancel the asyncio
+    task, cancel the running query...) with `on_cancel`, and `cancel`, called
+    from any thread, runs those callbacks right away. Work that hasn't started
+    yet checks the token and raises TurnCancelledError instead.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cancelled = False
+        self._callbacks = []
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled
+
+    def cancel(self) -> None:
+        with self._lock:
+            if self._cancelled:
+                return
+            self._cancelled = True
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                # Interrupting is best effort, the work may just have finished
+                pass
+
+    def raise_if_cancelled(self) -> None:
+        if self._cancelled:
+            raise TurnCancelledError('The chat turn was cancelled')
+
+    @contextmanager
+    def on_cancel(self, callback):
+        """Calls `callback` (from the cancelling thread) if the token is cancelled while inside the block"""
+        with self._lock:
+            self.raise_if_cancelled()
+            self._callbacks.append(callback)
+        try:
+            yield self
+        finally:
+            with self._lock:
+                self._callbacks = [registered for registered in self._callbacks if registered is not callback]
+
+    @contextmanager
+    def activate(self):
+        """Makes this the token returned by `active` inside the block, including the threads started with asyncio.to_thread"""
+        self.raise_if_cancelled()
+        reset_token = _active.set(self)
+        try:
+            yield self
+        finally:
+            _active.reset(reset_token)
+
+
+_active = contextvars.ContextVar('cancellation_token', default=None)
+
+
+def active() -> Optional[CancellationToken]:
+    """Token of the chat turn running in this context, None outside of a turn"""
+    return _active.get()
+
+
+@contextmanager
+def cancelling(callback):
+    """Calls `callback` if the active chat turn is cancelled inside the block, a no-op outside of a turn"""
+    token = active()
+    if token is None:
+        yield
+        return
+    with token.on_cancel(callback):
+        yield
@@ -0,0 +1,56 @@
+import time
+import asyncio
+
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+
+def fan_out(func, items, concurrency, timeout, default=None):
+    """
+    Call `func` on every item from a pool of `concurrency` threads and return
+    the results in the order of `items`. A call that fails or takes longer than
+    `timeout` seconds (counted from when it actually started) yields `default`.
+    """
+    results = [default] * len(items)
+    if not items:
+        return results
+
+    started = {}
+
+    def run(idx, item):
+        started[idx] = time.monotonic()
+        return func(item)
+
+    executor = ThreadPoolExecutor(max_workers=max(1, concurrency))
+    futures = [executor.submit(run, idx, item) for idx, item in enumerate(items)]
+    try:
+        for idx, future in enumerate(futures):
+            while True:
+                start = started.get(idx)
+                remaining = timeout if start is None else start + timeout - time.monotonic()
+                try:
+                    results[idx] = future.result(timeout=max(remaining, 0))
+                    break
+                except TimeoutError:
+                    # Still queued behind the concurrency limit: keep waiting for it to start
+                    if idx in started and started[idx] + timeout <= time.monotonic():
+                        break
+                except Exception:
+                    break
+    finally:
+        # Timed out calls can't be interrupted, but nobody waits for them
+        executor.shutdown(wait=False, cancel_futures=True)
+    return results
+
+
+async def afan_out(afunc, items, concurrency, timeout, default=None):
+    """Async counterpart of fan_out, the limit is enforced with a semaphore"""
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+
+    async def run(item):
+        async with semaphore:
+            try:
+                return await asyncio.wait_for(afunc(item), timeout)
+            except Exception:
+                return default
+
+    return list(await asyncio.gather(*(run(item) for item in items)))
@@ -1,19 +1,77 @@
-from abc import ABC
+import threading
+import numpy as np
+import pyarrow as pa
 
-from pyodbc import Cursor
+from abc import ABC
+from collections import OrderedDict
 from datetime import datetime, timedelta
 
+from typing import Iterator
+
+from src.config.db import DataDB, StreamingDataDB
+from src.config.env import settings
+from src.libs.rollups import RollupManager, plan_segments
+from src.libs.measurement_cache import MeasurementCache
+from src.libs.anomaly import OutlierEngine
+from src.libs.streaming import PowerFactorSummary
+
 
 class DataAccess(ABC):
-    def __init__(self, cursor: Cursor):
-        self.cursor = cursor
+    OPERATIONS = {
+        'get_consumption_distribution',
+        'get_daily_consumption',
+        'get_power_readings_by_device',
+        'get_power_box_stats',
+        'get_power_outliers',
+        'get_power_factor_analysis',
+    }
+    # Number of graph runs whose results are kept by the request-scoped memo
+    MEMO_RUNS = 8
+
+    def __init__(self, db: DataDB):
+        self.db = db
+        self.rollups = RollupManager(db)
+        self.cache = MeasurementCache(StreamingDataDB(), settings.MEASUREMENT_CACHE_DIR,
+                                      settle=timedelta(minutes=settings.MEASUREMENT_CACHE_SETTLE_MINUTES))
+        self.outliers = OutlierEngine(db)
+        self._devices = None
+        self._memo = OrderedDict()
+        self._memo_lock = threading.Lock()
+
+    def fetch(self, run_id, operation, *params):
+        """
+        Run a data operation memoized per graph run: repeated (operation, params)
+        calls within the same run reuse the first result instead of hitting the
+        database again
+        """
+        if operation not in self.OPERATIONS:
+            raise ValueError(f"Operação inválida: {operation}")
+
+        key = (operation, tuple(params))
+        with self._memo_lock:
+            run_memo = self._memo.setdefault(run_id, {})
+            self._memo.move_to_end(run_id)
+            while len(self._memo) > self.MEMO_RUNS:
+                self._memo.popitem(last=False)
+            if key in run_memo:
+                return run_memo[key]
+
+        result = getattr(self, operation)(*params)
+
+        with self._memo_lock:
+            run_memo[key] = result
+        return result
+
+    def iter_measurements(self, start, end, device_id=None, chunk_size=None) -> Iterator[pa.RecordBatch]:
+        """Raw measurements in [start, end) as record batches, read through the local cache"""
+        return self.cache.iter_window(start, end, device_id, chunk_size)
 
     def get_consumption_distribution(self, period):
-        # Define o intervalo de datas conforme o período
+        # Define o intervalo de datas conforme o período (intervalo semiaberto [start, end))
         now = datetime(2025, 9, 15)
         if period == "yesterday":
             start = (now - timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
-            end = start.replace(hour=23, minute=59, second=59)
+            end = start + timedelta(days=1)
         elif period == "last_week":
             start = (now - timedelta(days=7)).replace(hour=0, minute=0, second=0, microsecond=0)
             end = now
@@ -23,18 +81,21 @@ class DataAccess(ABC):
         else:
             raise ValueError("Período inválido")
 
-        query = """
-            SELECT d.type, SUM(m.active_power) as total_active_power
+        raw_query = """
+            SELECT d.type, SUM(m.active_power) / 60.0 as total_kwh
             FROM devices d
             JOIN measurements m ON d.device_id = m.device_id
-            WHERE m.timestamp BETWEEN ? AND ?
+            WHERE m.timestamp >= ? AND m.timestamp < ?
             GROUP BY d.type
         """
-        self.cursor.execute(query, (start, end))
-        results = self.cursor.fetchall()
-
+        rollup_query = """
+            SELECT r.device_type, SUM(r.energy_kwh) as total_kwh
+            FROM measurements_type_{rollup} r
+            WHERE r.bucket >= ? AND r.bucket < ?
+            GROUP BY r.device_type
+        """
         # Retorna como dicionário: {tipo: consumo_total}
-        return {row.type: row.total_active_power / 60.0 for row in results}
+        return self._sum_over_segments(start, end, raw_query, rollup_query)
 
     def get_daily_consumption(self, period):
         now = datetime(2025, 9, 15)
@@ -49,50 +110,175 @@ class DataAccess(ABC):
         
         end = now
 
-        # Query para somar o consumo de todos os aparelhos, agrupado por dia.
-        # DATE_TRUNC('day', m.timestamp) agrupa todos os timestamps para o início do dia.
-        query = """
+        # Soma o consumo de todos os aparelhos, agrupado por dia.
+        # DATE_TRUNC('day', ...) agrupa todos os timestamps para o início do dia.
+        raw_query = """
             SELECT 
                 CAST(DATE_TRUNC('day', m.timestamp) AS DATE) as consumption_day, 
                 SUM(m.active_power / 60.0) as total_kwh
             FROM measurements m
-            WHERE m.timestamp BETWEEN ? AND ?
+            WHERE m.timestamp >= ? AND m.timestamp < ?
             GROUP BY consumption_day
-            ORDER BY consumption_day;
         """
-        self.cursor.execute(query, (start, end))
-        rows = self.cursor.fetchall()
-        
-        # Converte explicitamente a lista de objetos Row em uma lista de tuplas
-        results = [tuple(row) for row in rows]
-        
-        return results
+        rollup_query = """
+            SELECT 
+                CAST(DATE_TRUNC('day', r.bucket) AS DATE) as consumption_day, 
+                SUM(r.energy_kwh) as total_kwh
+            FROM measurements_type_{rollup} r
+            WHERE r.bucket >= ? AND r.bucket < ?
+            GROUP BY consumption_day
+        """
+        totals = self._sum_over_segments(start, end, raw_query, rollup_query)
+
+        return sorted(totals.items())
+
+    def _sum_over_segments(self, start, end, raw_query, rollup_query):
+        """
+        Run a (key, kwh) aggregate over [start, end), reading each segment from the
+        coarsest rollup able to answer it and the raw measurements for the rest
+        """
+        totals = {}
+        with self.db.cursor() as cursor:
+            segments = plan_segments(start, end, self.rollups.watermark(cursor))
+            for source, segment_start, segment_end in segments:
+                if source == 'raw':
+                    cursor.execute(raw_query, (segment_start, segment_end))
+                else:
+                    cursor.execute(rollup_query.format(rollup=source), (segment_start, segment_end))
+                for key, kwh in cursor.fetchall():
+                    totals[key] = totals.get(key, 0.0) + kwh
+        return totals
+
+    def get_devices(self):
+        # A tabela de aparelhos é pequena e praticamente estática: consulta uma única vez
+        if self._devices is None:
+            with self.db.cursor() as cursor:
+                cursor.execute("SELECT d.device_id, d.name, d.type FROM devices d;")
+                self._devices = {row.device_id: (row.name, row.type) for row in cursor.fetchall()}
+        return self._devices
+
+    def data_version(self):
+        """Timestamp of the newest measurement, changes whenever new readings arrive"""
+        with self.db.cursor() as cursor:
+            cursor.execute("SELECT MAX(m.timestamp) FROM measurements m;")
+            return cursor.fetchone()[0]
 
     def get_power_readings_by_device(self, period):
         now = datetime(2025, 9, 15)
         if period == "yesterday":
             start = (now - timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
-            end = start.replace(hour=23, minute=59, second=59)
+            end = start + timedelta(days=1)
         elif period == "last_week":
             start = (now - timedelta(days=7)).replace(hour=0, minute=0, second=0, microsecond=0)
             end = now
         else:
             raise ValueError("Período inválido. Use 'yesterday' ou 'last_week'.")
 
-        # Query para buscar a potência ativa de cada aparelho.
-        query = """
-            SELECT d.name, m.active_power
-            FROM measurements m
-            JOIN devices d ON m.device_id = d.device_id
-            WHERE m.timestamp BETWEEN ? AND ?;
+        # Potência ativa de cada aparelho, lida do cache local (só as lacunas vão ao banco)
+        window = self.cache.get_window(start, end)
+        devices = self.get_devices()
+        device_ids = window.column('device_id').to_pylist()
+        powers = window.column('active_power').to_pylist()
+
+        return [(devices.get(device_id, (f'Aparelho {device_id}',))[0], power) for device_id, power in zip(device_ids, powers)]
+
+    def get_power_box_stats(self, period, mode=None):
         """
-        self.cursor.execute(query, (start, end))
-        rows = self.cursor.fetchall()
-        
-        # Converte explicitamente a lista de objetos Row em uma lista de tuplas
-        results = [tuple(row) for row in rows]
-        
-        return results
+        Box plot statistics per device: (name, q1, median, q3, lower_whisker,
+        upper_whisker, count) rows plus the (name, active_power) outliers beyond
+        1.5 IQR. Only these are transferred, so the result grows with the number
+        of devices instead of the number of readings.
+        """
+        now = datetime(2025, 9, 15)
+        if period == "yesterday":
+            start = (now - timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+            end = start + timedelta(days=1)
+        elif period == "last_week":
+            start = (now - timedelta(days=7)).replace(hour=0, minute=0, second=0, microsecond=0)
+            end = now
+        else:
+            raise ValueError("Período inválido. Use 'yesterday' ou 'last_week'.")
+
+        mode = mode or settings.POWER_BOX_STATS_MODE
+        if mode == 'sql':
+            return self._box_stats_sql(start, end)
+        elif mode == 'numpy':
+            return self._box_stats_numpy(start, end)
+        else:
+            raise ValueError(f"Modo inválido: {mode}. Use 'sql' ou 'numpy'.")
+
+    def _box_stats_sql(self, start, end):
+        # Quartis calculados no servidor com percentile_cont, cercas em 1.5 IQR
+        fences = """
+            WITH readings AS (
+                SELECT m.device_id, m.active_power
+                FROM measurements m
+                WHERE m.timestamp >= ? AND m.timestamp < ?
+            ),
+            fences AS (
+                SELECT
+                    r.device_id,
+                    percentile_cont(0.25) WITHIN GROUP (ORDER BY r.active_power) AS q1,
+                    percentile_cont(0.5) WITHIN GROUP (ORDER BY r.active_power) AS median,
+                    percentile_cont(0.75) WITHIN GROUP (ORDER BY r.active_power) AS q3,
+                    COUNT(*) AS n
+                FROM readings r
+                GROUP BY r.device_id
+            )
+        """
+        stats_query = fences + """
+            SELECT
+                d.name, f.q1, f.median, f.q3,
+                MIN(r.active_power) FILTER (WHERE r.active_power >= f.q1 - 1.5 * (f.q3 - f.q1)) AS lower_whisker,
+                MAX(r.active_power) FILTER (WHERE r.active_power <= f.q3 + 1.5 * (f.q3 - f.q1)) AS upper_whisker,
+                f.n
+            FROM fences f
+            JOIN readings r ON r.device_id = f.device_id
+            JOIN devices d ON d.device_id = f.device_id
+            GROUP BY d.name, f.q1, f.median, f.q3, f.n
+            ORDER BY d.name;
+        """
+        outliers_query = fences + """
+            SELECT d.name, r.active_power
+            FROM readings r
+            JOIN fences f ON r.device_id = f.device_id
+            JOIN devices d ON d.device_id = r.device_id
+            WHERE r.active_power < f.q1 - 1.5 * (f.q3 - f.q1)
+               OR r.active_power > f.q3 + 1.5 * (f.q3 - f.q1);
+        """
+        with self.db.cursor() as cursor:
+            cursor.execute(stats_query, (start, end))
+            stats = [tuple(row) for row in cursor.fetchall()]
+            cursor.execute(outliers_query, (start, end))
+            outliers = [tuple(row) for row in cursor.fetchall()]
+
+        return stats, outliers
+
+    def _box_stats_numpy(self, start, end):
+        # Mesmas estatísticas calculadas com NumPy sobre o buffer colunar do cache local
+        window = self.cache.get_window(start, end)
+        devices = self.get_devices()
+        device_ids = window.column('device_id').to_numpy()
+        powers = window.column('active_power').to_numpy(zero_copy_only=False).astype(float)
+
+        stats, outliers = [], []
+        # A janela vem ordenada por aparelho, cada aparelho é uma fatia contígua
+        unique_ids, first_index = np.unique(device_ids, return_index=True)
+        bounds = list(first_index) + [len(device_ids)]
+        for i, device_id in enumerate(unique_ids):
+            values = powers[bounds[i]:bounds[i + 1]]
+            values = values[~np.isnan(values)]
+            if values.size == 0:
+                continue
+            q1, median, q3 = np.percentile(values, [25, 50, 75])
+            low, high = q1 - 1.5 * (q3 - q1), q3 + 1.5 * (q3 - q1)
+            inside = values[(values >= low) & (values <= high)]
+            name = devices.get(int(device_id), (f'Aparelho {device_id}',))[0]
+            stats.append((name, q1, median, q3, inside.min(), inside.max(), int(values.size)))
+            outliers.extend((name, float(v)) for v in values[(values < low) | (values > high)])
+
+        stats.sort(key=lambda row: row[0])
+        return stats, outliers
 
     def get_power_factor_analysis(self, device_id, period):
         now = datetime(2025, 9, 15)
@@ -105,22 +291,30 @@ class DataAccess(ABC):
         
         end = now
 
-        query = """
-            SELECT m.active_power, m.power_factor
-            FROM measurements m
-            WHERE m.device_id = ? AND m.timestamp BETWEEN ? AND ?;
-        """
-        self.cursor.execute(query, (device_id, start, end))
-        rows = self.cursor.fetchall()
+        # Consome as leituras em lotes: a memória não depende do tamanho do período
+        summary = PowerFactorSummary()
+        for batch in self.iter_measurements(start, end, device_id=int(device_id)):
+            summary.update(batch)
         
-        # Converte explicitamente a lista de objetos Row em uma lista de tuplas
-        results = [tuple(row) for row in rows]
-        
-        return results
+        return summary
 
     def get_power_outliers(self, period):
-        self.cursor.execute("""
-            
-        """, (period,))
-        return self.cursor.fetchall()
-        pass
+        """
+        Anomalous power intervals in the period as (name, start, end, peak_power,
+        baseline_power, score) tuples, most anomalous first. The streaming engine
+        only processes the readings not seen by previous calls.
+        """
+        now = datetime(2025, 9, 15)
+        if period == "yesterday":
+            start = (now - timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+            end = start + timedelta(days=1)
+        elif period == "last_week":
+            start = (now - timedelta(days=7)).replace(hour=0, minute=0, second=0, microsecond=0)
+            end = now
+        elif period == "last_month":
+            start = (now - timedelta(days=30)).replace(hour=0, minute=0, second=0, microsecond=0)
+            end = now
+        else:
+            raise ValueError("Período inválido. Use 'yesterday', 'last_week' ou 'last_month'.")
+
+        return self.outliers.get_intervals(start, end)
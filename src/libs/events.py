@@ -0,0 +1,104 @@
+import atexit
+import queue
+import threading
+import time
+
+from abc import ABC
+
+
+# Kinds of events published while the chat runs
+STATUS = 'status'    # what the chat is doing, shown to the user while waiting
+DEBUG = 'debug'      # debug log lines
+CONTROL = 'control'  # 'running', 'aborting' or 'idle', set by the GUI
+
+
+class EventBus(ABC):
+    """
+    In-process publish/subscribe of the chat events.
+
+    Every subscriber gets its own queue.Queue, so publishing never blocks and
+    never touches the disk. The last event of every kind is also kept, which
+    lets the current status or a pending abort be read without subscribing.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = []  # (kinds, queue) pairs, an empty kinds set receives everything
+        self._last = {}
+
+    def subscribe(self, *kinds) -> queue.Queue:
+        events = queue.Queue()
+        with self._lock:
+            self._subscribers.append((frozenset(kinds), events))
+        return events
+
+    def unsubscribe(self, events: queue.Queue) -> None:
+        with self._lock:
+            self._subscribers = [(kinds, subscribed) for kinds, subscribed in self._subscribers if subscribed is not events]
+
+    def publish(self, kind, payload) -> None:
+        with self._lock:
+            self._last[kind] = payload
+            subscribers = list(self._subscribers)
+        for kinds, events in subscribers:
+            if not kinds or kind in kinds:
+                events.put((kind, payload))
+
+    def last(self, kind, default=None):
+        with self._lock:
+            return self._last.get(kind, default)
+
+    @staticmethod
+    def drain(events: queue.Queue) -> list:
+        """Every (kind, payload) already in the queue, without waiting"""
+        drained = []
+        while True:
+            try:
+                drained.append(events.get_nowait())
+            except queue.Empty:
+                return drained
+
+
+class FileSink(ABC):
+    """
+    Appends the payload of the events to a file from a background thread.
+
+    The file stays open and is only flushed every `flush_interval` seconds,
+    instead of being opened and closed for every line.
+    """
+    _STOP = object()
+
+    def __init__(self, bus: EventBus, path, kinds=(DEBUG,), flush_interval=1.0):
+        self.bus = bus
+        self.path = path
+        self.flush_interval = flush_interval
+        self.events = bus.subscribe(*kinds)
+        self._thread = threading.Thread(target=self._run, name='event-file-sink', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _run(self):
+        with open(self.path, 'a') as f:
+            last_flush = time.monotonic()
+            while True:
+                try:
+                    event = self.events.get(timeout=self.flush_interval)
+                except queue.Empty:
+                    event = None
+                if event is self._STOP:
+                    return
+                if event is not None:
+                    f.write(f'{event[1]}\n')
+                if time.monotonic() - last_flush >= self.flush_interval:
+                    f.flush()
+                    last_flush = time.monotonic()
+
+    def close(self):
+        """Stops the sink once the events already published are written"""
+        if self._thread.is_alive():
+            self.bus.unsubscribe(self.events)
+            self.events.put(self._STOP)
+            self._thread.join()
+
+
+# Shared by the whole process, like the settings
+event_bus = EventBus()
@@ -0,0 +1,104 @@
+import re
+
+from abc import ABC
+
+
+# Periods accepted by every DataAccess operation
+OPERATION_PERIODS = {
+    'get_consumption_distribution': ('yesterday', 'last_week', 'last_month'),
+    'get_daily_consumption': ('last_week', 'last_month', 'last_year'),
+    'get_power_readings_by_device': ('yesterday', 'last_week'),
+    'get_power_factor_analysis': ('last_week', 'last_month'),
+    'get_power_outliers': ('yesterday', 'last_week', 'last_month'),
+}
+
+OPERATION_PATTERNS = {
+    'get_power_factor_analysis': r'\bpower[ -]factor\b',
+    'get_power_outliers': r'\b(outliers?|anomal(y|ies|ous)|abnormal|spikes?)\b',
+    'get_power_readings_by_device': r'\b(power readings|power (distribution )?(by|per|of each) device|readings (by|per) device|box ?plots?)\b',
+    'get_consumption_distribution': r'\b((consumption|energy|usage) (distribution|breakdown|split)|(consumption|energy|usage) (by|per) (device )?type|distribution of (the )?(consumption|energy|usage))\b',
+    'get_daily_consumption': r'\b((daily|day by day|per day) (energy )?(consumption|usage)|(consumption|usage) (per|by|for each|each) day|daily energy)\b',
+}
+
+PERIOD_PATTERNS = {
+    'yesterday': r'\byesterday\b',
+    'last_week': r'\b(last|past|previous) (7 days|seven days|week)\b',
+    'last_month': r'\b(last|past|previous) (30 days|thirty days|month)\b',
+    'last_year': r'\b(last|past|previous) (12 months|twelve months|year)\b',
+}
+
+PLOT_PATTERN = r'\b(plot|plotted|chart|graph|visuali[sz]e|visuali[sz]ation|draw)\b'
+
+# Device ids as listed to the DataAgent: computers and monitors alternate from 1, then the rest
+DEVICE_PATTERNS = (
+    (r'\bdevice(?: id)? ?#?(\d+)\b', lambda n: n),
+    (r'\b(?:computer|computador|pc) ?#?(\d+)\b', lambda n: 2 * n - 1 if 1 <= n <= 12 else None),
+    (r'\bmonitor ?#?(\d+)\b', lambda n: 2 * n if 1 <= n <= 12 else None),
+    (r'\b(?:air[ -]conditioner|air[ -]conditioning|ar[ -]condicionado|ac) ?#?(\d+)\b', lambda n: 26 + n if n in (1, 2) else None),
+    (r'\b(?:router|roteador)\b', lambda n: 25),
+    (r'\b(?:projector|projetor)\b', lambda n: 26),
+)
+DEVICE_COUNT = 28
+
+NUMBER_PATTERN = r'\d+(?:[.,]\d+)?'
+
+
+class FastRouter(ABC):
+    """
+    Rule-based recognition of well-formed data questions.
+
+    A question is routed only when it names exactly one data operation and
+    exactly one period that operation accepts (plus a single known device for
+    the power factor analysis). The result has the same shape as the DataAgent
+    LLM output, anything ambiguous returns None and is left to the LLMs.
+    """
+    def __init__(self):
+        self.operations = {operation: re.compile(pattern) for operation, pattern in OPERATION_PATTERNS.items()}
+        self.periods = {period: re.compile(pattern) for period, pattern in PERIOD_PATTERNS.items()}
+        self.plot = re.compile(PLOT_PATTERN)
+        self.devices = [(re.compile(pattern), resolve) for pattern, resolve in DEVICE_PATTERNS]
+        self.numbers = re.compile(NUMBER_PATTERN)
+
+    def device_id(self, text):
+        found = set()
+        for pattern, resolve in self.devices:
+            for match in pattern.finditer(text):
+                device_id = resolve(int(match.group(1)) if match.groups() else 0)
+                if device_id is None or not 1 <= device_id <= DEVICE_COUNT:
+                    return None
+                found.add(device_id)
+        return found.pop() if len(found) == 1 else None
+
+    def signature(self, text):
+        """Periods, devices and numbers named in the text, questions with different signatures ask for different data"""
+        text = ' '.join(text.lower().split())
+        periods = frozenset(period for period, pattern in self.periods.items() if pattern.search(text))
+        devices = set()
+        for pattern, resolve in self.devices:
+            for match in pattern.finditer(text):
+                device_id = resolve(int(match.group(1)) if match.groups() else 0)
+                # Unknown devices still tell questions apart by their wording
+                devices.add(device_id if device_id is not None else match.group(0))
+        numbers = tuple(sorted(number.replace(',', '.') for number in self.numbers.findall(text)))
+        return periods, frozenset(devices), numbers
+
+    def route(self, text):
+        """{'operation', 'parameters', 'plot'} for a confidently recognised data question, None otherwise"""
+        text = ' '.join(text.lower().split())
+        operations = [operation for operation, pattern in self.operations.items() if pattern.search(text)]
+        periods = [period for period, pattern in self.periods.items() if pattern.search(text)]
+        if len(operations) != 1 or len(periods) != 1:
+            return None
+
+        operation, period = operations[0], periods[0]
+        if period not in OPERATION_PERIODS[operation]:
+            return None
+
+        parameters = [period]
+        if operation == 'get_power_factor_analysis':
+            device_id = self.device_id(text)
+            if device_id is None:
+                return None
+            parameters = [device_id, period]
+
+        return {'operation': operation, 'parameters': parameters, 'plot': bool(self.plot.search(text))}
@@ -0,0 +1,308 @@
+import asyncio
+import threading
+import pyodbc
+
+from abc import ABC
+
+from langchain.prompts import PromptTemplate
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.runnables import Runnable
+
+from src.config.db import MemoryDB, PoolTimeoutError
+from src.config.env import settings
+from src.libs.memory import Memory
+
+
+# Raised when the memory database can't be reached
+STORE_ERRORS = (pyodbc.Error, PoolTimeoutError)
+
+
+class TokenCounter(ABC):
+    """
+    Counts tokens with a local Hugging Face tokenizer.
+
+    The tokenizer is loaded on first use. When it can't be loaded (no
+    transformers, model not downloaded and no network) tokens are estimated
+    as one every four characters.
+    """
+    def __init__(self, tokenizer_name=None):
+        if tokenizer_name is None:
+            tokenizer_name = settings.HISTORY_TOKENIZER or settings.HUGGINGFACE_EMBEDDING_MODEL
+        self.tokenizer_name = tokenizer_name
+        self._tokenizer = None
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    @property
+    def tokenizer(self):
+        with self._lock:
+            if not self._loaded:
+                self._loaded = True
+                try:
+                    from transformers import AutoTokenizer
+                    self._tokenizer = AutoTokenizer.from_pretrained(self.tokenizer_name)
+                except Exception:
+                    self._tokenizer = None
+            return self._tokenizer
+
+    def count(self, text) -> int:
+        tokenizer = self.tokenizer
+        if tokenizer is None:
+            return len(text) // 4 + 1
+        return len(tokenizer.encode(text, add_special_tokens=False))
+
+
+class HistoryStore(ABC):
+    """
+    Append-only store of the chat messages in the memory database.
+
+    Every message is one row, so a turn costs one insert no matter how long
+    the session is, and the last messages of a session are read through the
+    (session_id, message_id) index. Sessions never touch each other's rows.
+    The running summary of a session is one row of its own, overwritten
+    along with the number of messages of the session it covers.
+    """
+    def __init__(self, db: MemoryDB):
+        self.db = db
+
+    def ensure_schema(self):
+        with self.db.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS chat_messages (
+                    message_id BIGSERIAL PRIMARY KEY,
+                    session_id TEXT NOT NULL,
+                    role TEXT NOT NULL,
+                    content TEXT NOT NULL,
+                    created_at TIMESTAMP NOT NULL DEFAULT now()
+                );
+            """)
+            cursor.execute("CREATE INDEX IF NOT EXISTS chat_messages_session ON chat_messages (session_id, message_id);")
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS chat_summaries (
+                    session_id TEXT PRIMARY KEY,
+                    summary TEXT NOT NULL,
+                    summarized BIGINT NOT NULL,
+                    updated_at TIMESTAMP NOT NULL DEFAULT now()
+                );
+            """)
+            conn.commit()
+
+    def append(self, session_id, role, content) -> None:
+        with self.db.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("INSERT INTO chat_messages (session_id, role, content) VALUES (?, ?, ?)",
+                           (session_id, role, content))
+            conn.commit()
+
+    def last_messages(self, session_id, limit) -> list:
+        """The `limit` newest messages of the session, oldest first"""
+        with self.db.cursor() as cursor:
+            cursor.execute("""
+                SELECT role, content FROM (
+                    SELECT message_id, role, content FROM chat_messages
+                    WHERE session_id = ?
+                    ORDER BY message_id DESC
+                    LIMIT ?
+                ) recent
+                ORDER BY message_id;
+            """, (session_id, limit))
+            return [{"role": row.role, "content": row.content} for row in cursor.fetchall()]
+
+    def count_messages(self, session_id) -> int:
+        with self.db.cursor() as cursor:
+            cursor.execute("SELECT COUNT(*) FROM chat_messages WHERE session_id = ?;", (session_id,))
+            return cursor.fetchone()[0]
+
+    def save_summary(self, session_id, summary, summarized) -> None:
+        """`summarized` counts the oldest messages of the whole session folded into `summary`"""
+        with self.db.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                INSERT INTO chat_summaries (session_id, summary, summarized) VALUES (?, ?, ?)
+                ON CONFLICT (session_id) DO UPDATE
+                SET summary = EXCLUDED.summary, summarized = EXCLUDED.summarized, updated_at = now();
+            """, (session_id, summary, summarized))
+            conn.commit()
+
+    def load_summary(self, session_id):
+        """(summary, summarized) of the session, ('', 0) before its first summary"""
+        with self.db.cursor() as cursor:
+            cursor.execute("SELECT summary, summarized FROM chat_summaries WHERE session_id = ?;", (session_id,))
+            row = cursor.fetchone()
+            return (row.summary, row.summarized) if row is not None else ('', 0)
+
+
+class HistoryManager(ABC):
+    """
+    Chat history sent to the LLMs, bounded by a token budget.
+
+    The most recent messages are kept verbatim as long as they fit in
+    `token_budget`. Older messages are folded into a running summary by
+    `compact`, in calls of at most `token_budget` tokens of messages each
+    (a single longer message goes alone). `compact` is meant to run once the
+    answer of a turn was shown so the user never waits for it. Whatever `compact` has not caught up
+    with yet is simply left out of the prompt, so the budget always holds.
+
+    With a `store`, every message and summary is also saved under
+    `session_id`, and the last messages of the session are loaded back on
+    creation along with the summary. If the store can't be reached the
+    history just stays in memory for the rest of the session.
+    """
+    def __init__(self, summary_model, token_budget=None, summary_tokens=None, min_messages=None, token_counter=None,
+                 store: HistoryStore = None, session_id=None):
+        self.summary_model = summary_model
+        # 0 is a valid setting (e.g. min_messages=0), only a missing argument takes the default
+        self.token_budget = token_budget if token_budget is not None else settings.HISTORY_TOKEN_BUDGET
+        self.summary_tokens = summary_tokens if summary_tokens is not None else settings.HISTORY_SUMMARY_TOKENS
+        self.min_messages = min_messages if min_messages is not None else settings.HISTORY_MIN_MESSAGES
+        self.token_counter = token_counter if token_counter is not None else TokenCounter()
+
+        self.messages = []
+        self.token_counts = []
+        self.summary = ''
+        self.summary_token_count = 0  # Tokens of the summary message, taken from the budget
+        self.summarized = 0  # Number of oldest messages already folded into the summary
+        self.offset = 0  # Number of messages of the session older than the loaded ones
+        self._lock = threading.Lock()
+        self.memory = Memory()
+
+        self.store = store
+        self.session_id = session_id
+        if self.store is not None:
+            try:
+                self.load()
+            except STORE_ERRORS as e:
+                self.drop_store(e)
+
+    def load(self) -> None:
+        messages = self.store.last_messages(self.session_id, settings.HISTORY_LOAD_MESSAGES)
+        self.offset = self.store.count_messages(self.session_id) - len(messages)
+        for message in messages:
+            self.remember(message["role"], message["content"])
+        summary, summarized = self.store.load_summary(self.session_id)
+        if summary:
+            # Messages summarized before the loaded ones only live in the summary
+            self.apply_summary(min(max(summarized - self.offset, 0), len(messages)), summary)
+
+    def drop_store(self, error) -> None:
+        self.memory.save_debug(f'History store unavailable, the history is kept in memory only: {error}')
+        self.store = None
+
+    def remember(self, role, content) -> None:
+        tokens = self.token_counter.count(content)
+        with self._lock:
+            self.messages.append({"role": role, "content": content})
+            self.token_counts.append(tokens)
+
+    def add(self, role, content) -> None:
+        """Adds a new message, blocking while it is written to the store"""
+        if self.store is not None:
+            try:
+                self.store.append(self.session_id, role, content)
+            except STORE_ERRORS as e:
+                # Later messages would be saved with a gap, stop saving altogether
+                self.drop_store(e)
+        self.remember(role, content)
+
+    def window_start(self) -> int:
+        """Index of the oldest message that still fits in the budget left by the summary (the newest `min_messages` always do)"""
+        with self._lock:
+            start = len(self.messages)
+            used = self.summary_token_count
+            while start > self.summarized:
+                used += self.token_counts[start - 1]
+                if used > self.token_budget and len(self.messages) - start >= self.min_messages:
+                    break
+                start -= 1
+            return start
+
+    def prompt_history(self) -> list:
+        """Running summary of the older turns followed by the recent messages"""
+        start = self.window_start()
+        with self._lock:
+            history = list(self.messages[start:])
+            if self.summary:
+                history.insert(0, self.summary_message(self.summary))
+        return history
+
+    # Running summary
+
+    def get_summary_chain(self) -> Runnable:
+        prompt = PromptTemplate(
+            template="""<|begin_of_text|><|start_header_id|>system<|end_header_id|>
+            You keep a running SUMMARY of a conversation between a user and the Energy
+            System Insight Tool (ESIT). Update the SUMMARY with the NEW_MESSAGES, keeping
+            the facts, numbers, devices, periods and user preferences that later questions
+            may refer to, and dropping greetings and repetitions. \n
+
+            Your output must be only the updated summary, in english, in at most
+            {max_words} words. \n
+
+            <|eot_id|><|start_header_id|>user<|end_header_id|>
+            SUMMARY: {summary} \n
+            NEW_MESSAGES: {messages} \n
+            <|eot_id|><|start_header_id|>assistant<|end_header_id|>""",
+            input_variables=["summary", "messages", "max_words"],
+        )
+        return prompt | self.summary_model | StrOutputParser()
+
+    def pending(self):
+        """
+        (end, inputs) of the oldest messages that left the window and are not
+        summarized yet, as many as fit in the token budget (at least one). None
+        if there are none
+        """
+        end = self.window_start()
+        with self._lock:
+            if end <= self.summarized:
+                return None
+            used = self.token_counts[self.summarized]
+            for i in range(self.summarized + 1, end):
+                used += self.token_counts[i]
+                if used > self.token_budget:
+                    end = i
+                    break
+            inputs = {"summary": self.summary or 'None',
+                      "messages": self.messages[self.summarized:end],
+                      "max_words": self.summary_tokens * 3 // 4}
+        return end, inputs
+
+    def summary_message(self, summary) -> dict:
+        return {"role": "system", "content": f"Summary of the earlier conversation: {summary}"}
+
+    def apply_summary(self, end, summary) -> None:
+        summary = summary.strip()
+        tokens = self.token_counter.count(self.summary_message(summary)["content"]) if summary else 0
+        with self._lock:
+            self.summary = summary
+            self.summary_token_count = tokens
+            self.summarized = max(self.summarized, end)
+
+    def save_summary(self) -> None:
+        """Writes the running summary to the store, blocking"""
+        store = self.store
+        if store is None:
+            return
+        with self._lock:
+            summary, summarized = self.summary, self.offset + self.summarized
+        try:
+            store.save_summary(self.session_id, summary, summarized)
+        except STORE_ERRORS as e:
+            self.drop_store(e)
+
+    def compact(self) -> None:
+        pending = self.pending()
+        while pending is not None:
+            end, inputs = pending
+            self.apply_summary(end, self.get_summary_chain().invoke(inputs))
+            self.save_summary()
+            pending = self.pending()
+
+    async def acompact(self) -> None:
+        pending = self.pending()
+        while pending is not None:
+            end, inputs = pending
+            self.apply_summary(end, await self.get_summary_chain().ainvoke(inputs))
+            await asyncio.to_thread(self.save_summary)
+            pending = self.pending()
@@ -0,0 +1,129 @@
+import math
+import re
+
+from abc import ABC
+from collections import Counter
+
+
+# Small reference texts, in the register of the questions the tool gets, from
+# which the character n-gram model of every language is learnt
+SAMPLES = {
+    'english': """
+        How much energy did the laboratory consume last week? Show me the daily consumption of last month
+        with a plot. What is the power factor of the air conditioner and which devices had outliers yesterday?
+        I would like to know the consumption distribution by type of device over the last year. Can you
+        explain what this paper says about energy system modelling and how the results were obtained? What
+        is the weather like today, and what are the latest news about renewable energy in the world? Please
+        calculate the total cost if the price of electricity is fifty cents per kilowatt hour. Thank you for
+        the help, that was very useful. Which device used the most power and when did it happen? Tell me
+        about the readings of the meters, the peak demand and the average load during the working hours.
+    """,
+    'portuguese': """
+        Quanto de energia o laboratório consumiu na semana passada? Mostre o consumo diário do mês passado
+        com um gráfico. Qual é o fator de potência do ar condicionado e quais aparelhos tiveram outliers
+        ontem? Eu gostaria de saber a distribuição do consumo por tipo de aparelho no último ano. Você pode
+        explicar o que este artigo diz sobre a modelagem de sistemas de energia e como os resultados foram
+        obtidos? Como está o tempo hoje e quais são as últimas notícias sobre energia renovável no mundo? Por
+        favor calcule o custo total se o preço da eletricidade for cinquenta centavos por quilowatt hora.
+        Obrigado pela ajuda, foi muito útil. Qual aparelho usou mais potência e quando isso aconteceu? Fale
+        sobre as leituras dos medidores, o pico de demanda e a carga média durante o horário de trabalho.
+    """,
+    'spanish': """
+        ¿Cuánta energía consumió el laboratorio la semana pasada? Muéstrame el consumo diario del mes pasado
+        con un gráfico. ¿Cuál es el factor de potencia del aire acondicionado y qué aparatos tuvieron valores
+        atípicos ayer? Me gustaría saber la distribución del consumo por tipo de aparato en el último año.
+        ¿Puedes explicar lo que dice este artículo sobre el modelado de sistemas de energía y cómo se
+        obtuvieron los resultados? ¿Qué tiempo hace hoy y cuáles son las últimas noticias sobre energía
+        renovable en el mundo? Por favor calcula el costo total si el precio de la electricidad es cincuenta
+        centavos por kilovatio hora. Gracias por la ayuda, fue muy útil. ¿Qué aparato usó más potencia y
+        cuándo ocurrió? Háblame de las lecturas de los medidores, el pico de demanda y la carga media.
+    """,
+    'french': """
+        Combien d'énergie le laboratoire a-t-il consommé la semaine dernière? Montre-moi la consommation
+        journalière du mois dernier avec un graphique. Quel est le facteur de puissance du climatiseur et
+        quels appareils ont eu des valeurs aberrantes hier? Je voudrais connaître la répartition de la
+        consommation par type d'appareil sur la dernière année. Peux-tu expliquer ce que dit cet article sur
+        la modélisation des systèmes énergétiques et comment les résultats ont été obtenus? Quel temps
+        fait-il aujourd'hui et quelles sont les dernières nouvelles sur les énergies renouvelables dans le
+        monde? Merci pour l'aide, c'était très utile. Quel appareil a utilisé le plus de puissance et quand
+        est-ce arrivé? Parle-moi des relevés des compteurs, du pic de demande et de la charge moyenne.
+    """,
+    'german': """
+        Wie viel Energie hat das Labor letzte Woche verbraucht? Zeig mir den täglichen Verbrauch des letzten
+        Monats mit einem Diagramm. Wie hoch ist der Leistungsfaktor der Klimaanlage und welche Geräte hatten
+        gestern Ausreißer? Ich möchte die Verteilung des Verbrauchs nach Gerätetyp im letzten Jahr wissen.
+        Kannst du erklären, was dieser Artikel über die Modellierung von Energiesystemen sagt und wie die
+        Ergebnisse erzielt wurden? Wie ist das Wetter heute und was sind die neuesten Nachrichten über
+        erneuerbare Energie in der Welt? Bitte berechne die Gesamtkosten, wenn der Strompreis fünfzig Cent
+        pro Kilowattstunde beträgt. Danke für die Hilfe, das war sehr nützlich. Welches Gerät hat die meiste
+        Leistung verbraucht und wann ist das passiert? Erzähl mir von den Zählerständen und der Spitzenlast.
+    """,
+    'italian': """
+        Quanta energia ha consumato il laboratorio la settimana scorsa? Mostrami il consumo giornaliero del
+        mese scorso con un grafico. Qual è il fattore di potenza del condizionatore e quali apparecchi hanno
+        avuto valori anomali ieri? Vorrei conoscere la distribuzione dei consumi per tipo di apparecchio
+        nell'ultimo anno. Puoi spiegare cosa dice questo articolo sulla modellazione dei sistemi energetici e
+        come sono stati ottenuti i risultati? Che tempo fa oggi e quali sono le ultime notizie sulle energie
+        rinnovabili nel mondo? Per favore calcola il costo totale se il prezzo dell'elettricità è cinquanta
+        centesimi per chilowattora. Grazie per l'aiuto, è stato molto utile. Quale apparecchio ha usato più
+        potenza e quando è successo? Parlami delle letture dei contatori, del picco di domanda e del carico.
+    """,
+}
+
+_NON_LETTERS = re.compile(r"[^\w']+|[\d_]+")
+
+
+def normalize(text):
+    return ' '.join(_NON_LETTERS.sub(' ', text.lower()).split())
+
+
+def ngrams(text, orders=(1, 2, 3)):
+    """Counts of the character n-grams of every word (padded with spaces)"""
+    counts = Counter()
+    for word in normalize(text).split():
+        padded = f' {word} '
+        for n in orders:
+            counts.update(padded[i:i + n] for i in range(len(padded) - n + 1))
+    return counts
+
+
+class LanguageDetector(ABC):
+    """
+    Character n-gram language identification, fully local and well under a
+    millisecond per sentence.
+
+    Every language is a naive Bayes model of character n-gram frequencies
+    (with add-alpha smoothing) learnt from a reference text. `detect` returns
+    the most likely language and its posterior probability as the confidence.
+    """
+    def __init__(self, samples=SAMPLES, alpha=0.5):
+        self.models = {}
+        vocabulary = set()
+        counts = {language: ngrams(text) for language, text in samples.items()}
+        for language_counts in counts.values():
+            vocabulary.update(language_counts)
+        for language, language_counts in counts.items():
+            denominator = sum(language_counts.values()) + alpha * len(vocabulary)
+            self.models[language] = ({gram: math.log((count + alpha) / denominator) for gram, count in language_counts.items()},
+                                     math.log(alpha / denominator))
+
+    def log_likelihoods(self, text):
+        grams = ngrams(text)
+        return {language: sum(count * log_probs.get(gram, unseen) for gram, count in grams.items())
+                for language, (log_probs, unseen) in self.models.items()}
+
+    def detect(self, text):
+        """(language, confidence), the confidence being the posterior probability of the language"""
+        log_likelihoods = self.log_likelihoods(text)
+        best = max(log_likelihoods, key=log_likelihoods.get)
+        total = sum(math.exp(value - log_likelihoods[best]) for value in log_likelihoods.values())
+        return best, 1.0 / total
+
+    def is_english(self, text, threshold, min_letters=8):
+        """True only when the text is confidently English, anything doubtful goes to the translator"""
+        letters = [c for c in text if c.isalpha()]
+        # Accented letters never show up in English questions
+        if len(letters) < min_letters or any(not c.isascii() for c in letters):
+            return False
+        language, confidence = self.detect(text)
+        return language == 'english' and confidence >= threshold
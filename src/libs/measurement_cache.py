@@ -0,0 +1,260 @@
+import os
+import json
+import uuid
+import threading
+
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from abc import ABC
+from typing import Iterator
+from datetime import datetime, timedelta
+
+from src.config.db import DataDB
+from src.config.env import settings
+from src.libs.streaming import iter_record_batches
+
+
+SCHEMA = pa.schema([
+    ('device_id', pa.int32()),
+    ('timestamp', pa.timestamp('us')),
+    ('active_power', pa.float64()),
+    ('power_factor', pa.float64()),
+])
+
+
+def merge_ranges(ranges):
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def subtract_ranges(start, end, covered):
+    """Parts of [start, end) not present in the sorted, merged `covered` ranges"""
+    missing = []
+    cursor = start
+    for covered_start, covered_end in covered:
+        if covered_end <= cursor:
+            continue
+        if covered_start >= end:
+            break
+        if covered_start > cursor:
+            missing.append((cursor, covered_start))
+        cursor = max(cursor, covered_end)
+        if cursor >= end:
+            break
+    if cursor < end:
+        missing.append((cursor, end))
+    return missing
+
+
+def in_ranges(timestamps, ranges):
+    """Boolean mask of the timestamps falling in any of the [start, end) ranges"""
+    mask = False
+    for start, end in ranges:
+        mask = mask | ((timestamps >= start) & (timestamps < end))
+    return mask
+
+
+class MeasurementCache(ABC):
+    """
+    Local Parquet copy of the measurements table.
+
+    Fetched windows are stored partitioned by day and device
+    (<cache_dir>/day=YYYY-MM-DD/device=N/<range>.parquet) and the time ranges
+    already present, for every device or for single devices, are kept in an
+    in-memory index (persisted to index.json), so only the missing parts of a
+    window are queried from PostgreSQL, and only for the device asked. Data
+    newer than `settle` is still being written by the acquisition, so it is
+    always read from the database and never cached.
+    """
+    def __init__(self, db: DataDB, cache_dir, settle=timedelta(minutes=10)):
+        self.db = db
+        self.cache_dir = cache_dir
+        self.settle = settle
+        self.index_path = os.path.join(cache_dir, 'index.json')
+        self._lock = threading.Lock()  # Guards the index only
+        # One fill at a time so concurrent callers never fetch the same range twice,
+        # reads of ranges already cached never wait for it
+        self._fill_lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self._covered, self._device_covered = self._load_index()
+
+    def _load_index(self):
+        try:
+            with open(self.index_path, 'r') as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return [], {}
+        if isinstance(index, list):
+            # Written before single devices were cached
+            index = {'all': index, 'devices': {}}
+
+        def parse(ranges):
+            return merge_ranges([(datetime.fromisoformat(s), datetime.fromisoformat(e)) for s, e in ranges])
+
+        return parse(index.get('all', [])), {int(d): parse(ranges) for d, ranges in index.get('devices', {}).items()}
+
+    def _save_index(self):
+        def dump(ranges):
+            return [(s.isoformat(), e.isoformat()) for s, e in ranges]
+
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'all': dump(self._covered),
+                       'devices': {str(d): dump(ranges) for d, ranges in self._device_covered.items()}}, f)
+        os.replace(tmp_path, self.index_path)
+
+    def _coverage(self, device_id=None):
+        # Must be called holding the lock
+        if device_id is None:
+            return self._covered
+        return merge_ranges(self._covered + self._device_covered.get(device_id, []))
+
+    def covered_ranges(self, device_id=None):
+        with self._lock:
+            return list(self._coverage(device_id))
+
+    def missing_ranges(self, start, end, device_id=None):
+        with self._lock:
+            return subtract_ranges(start, end, self._coverage(device_id))
+
+    def _mark_covered(self, start, end, device_id=None):
+        with self._lock:
+            if device_id is None:
+                self._covered = merge_ranges(self._covered + [(start, end)])
+            else:
+                self._device_covered[device_id] = merge_ranges(self._device_covered.get(device_id, []) + [(start, end)])
+            self._save_index()
+
+    def get_window(self, start, end, device_id=None) -> pa.Table:
+        """All measurements in [start, end), optionally of a single device, as one sorted table"""
+        table = pa.Table.from_batches(list(self.iter_window(start, end, device_id)), schema=SCHEMA)
+        return table.sort_by([('device_id', 'ascending'), ('timestamp', 'ascending')])
+
+    def iter_window(self, start, end, device_id=None, batch_size=None) -> Iterator[pa.RecordBatch]:
+        """Measurements in [start, end) as a stream of record batches (in no particular order)"""
+        batch_size = batch_size or settings.DB_STREAM_FETCH_SIZE
+        horizon = min(end, datetime.now() - self.settle)
+
+        if start < horizon:
+            if self.missing_ranges(start, horizon, device_id):
+                with self._fill_lock:
+                    # Checked again, another caller may have filled the gaps meanwhile
+                    for missing_start, missing_end in self.missing_ranges(start, horizon, device_id):
+                        self._fill(missing_start, missing_end, batch_size, device_id)
+                        self._mark_covered(missing_start, missing_end, device_id)
+            dataset = self._dataset(start, horizon, device_id)
+            if dataset is not None:
+                yield from dataset.to_batches(filter=self._condition(start, horizon, device_id), batch_size=batch_size)
+
+        if horizon < end:
+            yield from self._query(max(start, horizon), end, batch_size, device_id)
+
+    def _query(self, start, end, batch_size, device_id=None, ordered=False) -> Iterator[pa.RecordBatch]:
+        query = """
+            SELECT m.device_id, m.timestamp, m.active_power, m.power_factor
+            FROM measurements m
+            WHERE m.timestamp >= ? AND m.timestamp < ?
+        """
+        params = [start, end]
+        if device_id is not None:
+            query += " AND m.device_id = ?"
+            params.append(device_id)
+        if ordered:
+            query += " ORDER BY m.timestamp, m.device_id"
+
+        with self.db.cursor() as cursor:
+            cursor.execute(query, params)
+            yield from iter_record_batches(cursor, batch_size, SCHEMA)
+
+    def _partition_dir(self, day, device_id):
+        return os.path.join(self.cache_dir, f'day={day.isoformat()}', f'device={device_id}')
+
+    def _fill(self, start, end, batch_size, device_id=None):
+        """Stream [start, end) from the database into the day/device partitions, all or nothing"""
+        # Files are written under a temporary name and only renamed once the whole
+        # range was fetched, a failed or aborted fill leaves nothing behind that a
+        # later fill of the same range would duplicate
+        file_name = f'{start:%Y%m%dT%H%M%S}-{end:%Y%m%dT%H%M%S}-{uuid.uuid4().hex[:8]}.parquet'
+        with self._lock:
+            # A fill of every device skips what single devices already have cached
+            device_covered = {} if device_id is not None else {d: list(ranges) for d, ranges in self._device_covered.items()}
+
+        # Rows arrive ordered by time, so only the writers of the current day are ever open
+        writers = {}
+        paths = []
+        current_day = None
+        try:
+            for batch in self._query(start, end, batch_size, device_id, ordered=True):
+                df = batch.to_pandas()
+                for (day, group_device), group in df.groupby([df['timestamp'].dt.date, 'device_id']):
+                    covered = device_covered.get(int(group_device))
+                    if covered:
+                        group = group[~in_ranges(group['timestamp'], covered)]
+                        if group.empty:
+                            continue
+                    if day != current_day:
+                        for writer in writers.values():
+                            writer.close()
+                        writers = {}
+                        current_day = day
+                    writer = writers.get(group_device)
+                    if writer is None:
+                        partition = self._partition_dir(day, group_device)
+                        os.makedirs(partition, exist_ok=True)
+                        path = os.path.join(partition, file_name)
+                        paths.append(path)
+                        writer = pq.ParquetWriter(path + '.tmp', SCHEMA)
+                        writers[group_device] = writer
+                    writer.write_table(pa.Table.from_pandas(group, schema=SCHEMA, preserve_index=False))
+            for writer in writers.values():
+                writer.close()
+            writers = {}
+            for path in paths:
+                os.replace(path + '.tmp', path)
+        except Exception:
+            for writer in writers.values():
+                try:
+                    writer.close()
+                except Exception:
+                    pass
+            for path in paths:
+                for partial in (path + '.tmp', path):
+                    try:
+                        os.remove(partial)
+                    except OSError:
+                        pass
+            raise
+
+    def _condition(self, start, end, device_id=None):
+        timestamp = ds.field('timestamp')
+        condition = (timestamp >= pa.scalar(start, type=pa.timestamp('us'))) & (timestamp < pa.scalar(end, type=pa.timestamp('us')))
+        if device_id is not None:
+            condition = condition & (ds.field('device_id') == device_id)
+        return condition
+
+    def _dataset(self, start, end, device_id=None):
+        files = []
+        day = start.date()
+        while day <= (end - timedelta(microseconds=1)).date():
+            day_dir = os.path.join(self.cache_dir, f'day={day.isoformat()}')
+            if device_id is not None:
+                device_dirs = [self._partition_dir(day, device_id)]
+            elif os.path.isdir(day_dir):
+                device_dirs = [os.path.join(day_dir, d) for d in os.listdir(day_dir)]
+            else:
+                device_dirs = []
+            for device_dir in device_dirs:
+                if os.path.isdir(device_dir):
+                    files.extend(os.path.join(device_dir, f) for f in os.listdir(device_dir) if f.endswith('.parquet'))
+            day += timedelta(days=1)
+
+        if not files:
+            return None
+        return ds.dataset(files, schema=SCHEMA, format='parquet')
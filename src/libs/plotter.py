@@ -4,19 +4,20 @@ from src.config.db import DataDB
 from src.libs.data_access import DataAccess
 
 import plotly.express as px
+import plotly.graph_objects as go
 import plotly.io as pio
 import pandas as pd
 
 
 class Plotter(ABC):
     def __init__(self):
-        db = DataDB()
-        cursor = db.cursor
-        self.data_access = DataAccess(cursor)
+        self.data_access = DataAccess(DataDB())
         pio.renderers.default = "browser"
     
-    def plot_consumption_distribution(self, period):
-        dist = self.data_access.get_consumption_distribution(period)
+    def plot_consumption_distribution(self, period, dist=None):
+        # The caller may pass the data it already fetched to avoid running the query twice
+        if dist is None:
+            dist = self.data_access.get_consumption_distribution(period)
         labels = [f"{tipo.capitalize()}" for tipo in dist.keys()]
         values = [round(valor, 1) for valor in dist.values()]
         df = pd.DataFrame({'Tipo': labels, 'Consumo (kWh)': values})
@@ -25,8 +26,9 @@ class Plotter(ABC):
                      title='Distribuição de Consumo por Tipo de Aparelho')
         fig.show()
     
-    def plot_daily_consumption(self, period):
-        daily_data = self.data_access.get_daily_consumption(period)
+    def plot_daily_consumption(self, period, daily_data=None):
+        if daily_data is None:
+            daily_data = self.data_access.get_daily_consumption(period)
         if not daily_data:
             print("Não há dados para o período selecionado.")
             return
@@ -39,31 +41,47 @@ class Plotter(ABC):
         fig.update_layout(xaxis_title="Data", yaxis_title="Consumo Total (kWh)")
         fig.show()
     
-    def plot_power_outliers(self, period):
-        power_data = self.data_access.get_power_readings_by_device(period)
-        if not power_data:
+    def plot_power_outliers(self, period, box_stats=None):
+        # Recebe apenas as estatísticas das caixas e os outliers reais, não todas as leituras
+        if box_stats is None:
+            box_stats = self.data_access.get_power_box_stats(period)
+        stats, outliers = box_stats
+        if not stats:
             print("Não há dados para o período selecionado.")
             return
             
-        df = pd.DataFrame(power_data, columns=['Aparelho', 'Potência Ativa (kW)'])
+        df = pd.DataFrame(stats, columns=['Aparelho', 'q1', 'median', 'q3', 'lower_whisker', 'upper_whisker', 'count'])
+        outliers_df = pd.DataFrame(outliers, columns=['Aparelho', 'Potência Ativa (kW)'])
 
-        fig = px.box(df, x='Aparelho', y='Potência Ativa (kW)',
-                     title=f'Distribuição de Potência e Anomalias por Aparelho ({period.replace("_", " ").title()})',
-                     points="all") # 'all' mostra todos os pontos, destacando outliers
+        fig = go.Figure()
+        fig.add_trace(go.Box(x=df['Aparelho'], q1=df['q1'], median=df['median'], q3=df['q3'],
+                             lowerfence=df['lower_whisker'], upperfence=df['upper_whisker'],
+                             name='Potência Ativa (kW)', boxpoints=False))
+        fig.add_trace(go.Scatter(x=outliers_df['Aparelho'], y=outliers_df['Potência Ativa (kW)'],
+                                 mode='markers', name='Anomalias'))
+        fig.update_layout(title=f'Distribuição de Potência e Anomalias por Aparelho ({period.replace("_", " ").title()})',
+                          yaxis_title='Potência Ativa (kW)')
         fig.update_xaxes(tickangle=45) # Rotaciona os nomes dos aparelhos para melhor leitura
         fig.show()
     
-    def plot_power_factor_analysis(self, device_id, device_name, period):
-        pf_data = self.data_access.get_power_factor_analysis(device_id, period)
-        if not pf_data:
+    def plot_power_factor_analysis(self, device_id, device_name, period, pf_summary=None):
+        # pf_summary é um PowerFactorSummary construído em lotes: plota a amostra e a tendência exata
+        if pf_summary is None:
+            pf_summary = self.data_access.get_power_factor_analysis(device_id, period)
+        if pf_summary.count == 0:
             print(f"Não há dados para o aparelho {device_name} no período selecionado.")
             return
             
-        df = pd.DataFrame(pf_data, columns=['Potência Ativa (kW)', 'Fator de Potência'])
+        df = pd.DataFrame(pf_summary.sample, columns=['Potência Ativa (kW)', 'Fator de Potência'])
 
         fig = px.scatter(df, x='Potência Ativa (kW)', y='Fator de Potência',
-                         title=f'Análise de Eficiência: Fator de Potência vs. Consumo para {device_name}',
-                         trendline="ols",  # Adiciona uma linha de tendência para ver a correlação
-                         trendline_color_override="red")
+                         title=f'Análise de Eficiência: Fator de Potência vs. Consumo para {device_name}')
+        trend = pf_summary.trend
+        if trend is not None:
+            # Linha de tendência (mínimos quadrados sobre todas as leituras, não só a amostra)
+            slope, intercept = trend
+            x = [df['Potência Ativa (kW)'].min(), df['Potência Ativa (kW)'].max()]
+            fig.add_trace(go.Scatter(x=x, y=[slope * v + intercept for v in x], mode='lines',
+                                     name='Tendência', line=dict(color='red')))
         fig.update_yaxes(range=[0.5, 1.0]) # Fixa a escala do Fator de Potência
         fig.show()
@@ -29,10 +29,5 @@ class FinalAnswerPrinter(PrinterBase):
         if self.debug:
             self.memory.save_debug("------------------FINAL ANSWER------------------")
             self.memory.save_debug(f"Final Answer: {self.state['final_answer']} \n")
-            
-        history = self.state['history']
-        history.append({"role": "assistant", "content": self.state['final_answer']})
-        
-        self.memory.save_history(history)
         
         return
\ No newline at end of file
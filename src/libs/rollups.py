@@ -0,0 +1,214 @@
+import time
+import pyodbc
+
+from abc import ABC
+from threading import Thread
+from datetime import datetime, timedelta
+
+from src.config.db import DataDB
+
+
+HOUR = timedelta(hours=1)
+DAY = timedelta(days=1)
+EPOCH = datetime(1970, 1, 1)
+
+# Coarsest first, each entry is (rollup name, bucket size)
+GRANULARITIES = [('daily', DAY), ('hourly', HOUR)]
+
+WATERMARK_NAME = 'measurements'
+
+# High-water marks of the incremental jobs over the measurements (rollups, outliers)
+ROLLUP_STATE_DDL = """
+    CREATE TABLE IF NOT EXISTS rollup_state (
+        name TEXT PRIMARY KEY,
+        high_water_mark TIMESTAMP
+    );
+"""
+
+
+def floor_to(ts, size):
+    return EPOCH + ((ts - EPOCH) // size) * size
+
+
+def ceil_to(ts, size):
+    floored = floor_to(ts, size)
+    return floored if floored == ts else floored + size
+
+
+def plan_segments(start, end, watermark, granularities=GRANULARITIES):
+    """
+    Split the half-open window [start, end) into (source, start, end) segments,
+    answering as much as possible from the coarsest rollup. A rollup bucket is
+    only used when it ends before the rollup high-water mark, the leftovers at
+    the edges go to finer rollups and finally to the raw measurements.
+    """
+    if start >= end:
+        return []
+    if watermark is None or not granularities:
+        return [('raw', start, end)]
+
+    (name, size), finer = granularities[0], granularities[1:]
+    first = ceil_to(start, size)
+    last = floor_to(min(end, watermark), size)
+    if first >= last:
+        return plan_segments(start, end, watermark, finer)
+
+    return (plan_segments(start, first, watermark, finer)
+            + [(name, first, last)]
+            + plan_segments(last, end, watermark, finer))
+
+
+class RollupManager(ABC):
+    """
+    Maintains hourly and daily aggregates of the minute-level measurements,
+    per device (measurements_hourly/daily) and per device type
+    (measurements_type_hourly/daily). Refreshes are incremental from the
+    high-water mark stored in rollup_state.
+    """
+    def __init__(self, db: DataDB):
+        self.db = db
+
+    def ensure_schema(self):
+        with self.db.connection() as conn:
+            cursor = conn.cursor()
+            for rollup in ('hourly', 'daily'):
+                cursor.execute(f"""
+                    CREATE TABLE IF NOT EXISTS measurements_{rollup} (
+                        device_id INTEGER NOT NULL,
+                        bucket TIMESTAMP NOT NULL,
+                        energy_kwh DOUBLE PRECISION NOT NULL,
+                        min_power DOUBLE PRECISION,
+                        max_power DOUBLE PRECISION,
+                        mean_power DOUBLE PRECISION,
+                        mean_power_factor DOUBLE PRECISION,
+                        sample_count INTEGER NOT NULL,
+                        PRIMARY KEY (device_id, bucket)
+                    );
+                """)
+                cursor.execute(f"""
+                    CREATE TABLE IF NOT EXISTS measurements_type_{rollup} (
+                        device_type TEXT NOT NULL,
+                        bucket TIMESTAMP NOT NULL,
+                        energy_kwh DOUBLE PRECISION NOT NULL,
+                        min_power DOUBLE PRECISION,
+                        max_power DOUBLE PRECISION,
+                        mean_power DOUBLE PRECISION,
+                        mean_power_factor DOUBLE PRECISION,
+                        sample_count INTEGER NOT NULL,
+                        PRIMARY KEY (device_type, bucket)
+                    );
+                """)
+            cursor.execute(ROLLUP_STATE_DDL)
+            conn.commit()
+
+    def watermark(self, cursor):
+        """Latest raw timestamp already folded into the rollups, None if they are not available"""
+        try:
+            cursor.execute("SELECT high_water_mark FROM rollup_state WHERE name = ?", (WATERMARK_NAME,))
+            row = cursor.fetchone()
+        except pyodbc.ProgrammingError:
+            # Rollup tables were never created, leave the transaction usable for the raw fallback
+            cursor.connection.rollback()
+            return None
+        return row[0] if row else None
+
+    def refresh(self):
+        """Fold every measurement newer than the high-water mark into the rollups"""
+        with self.db.connection() as conn:
+            cursor = conn.cursor()
+            old_mark = self.watermark(cursor)
+            cursor.execute("SELECT MAX(timestamp) FROM measurements")
+            new_mark = cursor.fetchone()[0]
+            if new_mark is None or (old_mark is not None and new_mark <= old_mark):
+                return old_mark
+
+            # The buckets holding the old mark may have been partial, recompute them whole
+            hour_from = floor_to(old_mark, HOUR) if old_mark else EPOCH
+            day_from = floor_to(old_mark, DAY) if old_mark else EPOCH
+
+            cursor.execute("""
+                INSERT INTO measurements_hourly
+                SELECT
+                    m.device_id,
+                    DATE_TRUNC('hour', m.timestamp) AS bucket,
+                    SUM(m.active_power) / 60.0,
+                    MIN(m.active_power),
+                    MAX(m.active_power),
+                    AVG(m.active_power),
+                    AVG(m.power_factor),
+                    COUNT(*)
+                FROM measurements m
+                WHERE m.timestamp >= ? AND m.timestamp <= ?
+                GROUP BY m.device_id, bucket
+                ON CONFLICT (device_id, bucket) DO UPDATE SET
+                    energy_kwh = EXCLUDED.energy_kwh,
+                    min_power = EXCLUDED.min_power,
+                    max_power = EXCLUDED.max_power,
+                    mean_power = EXCLUDED.mean_power,
+                    mean_power_factor = EXCLUDED.mean_power_factor,
+                    sample_count = EXCLUDED.sample_count;
+            """, (hour_from, new_mark))
+            self._merge(cursor, 'measurements_hourly', 'measurements_daily', 'device_id',
+                        "h.device_id", "DATE_TRUNC('day', h.bucket)", day_from)
+            self._merge(cursor, 'measurements_hourly', 'measurements_type_hourly', 'device_type',
+                        "d.type", "h.bucket", hour_from)
+            self._merge(cursor, 'measurements_daily', 'measurements_type_daily', 'device_type',
+                        "d.type", "h.bucket", day_from)
+
+            cursor.execute("""
+                INSERT INTO rollup_state (name, high_water_mark) VALUES (?, ?)
+                ON CONFLICT (name) DO UPDATE SET high_water_mark = EXCLUDED.high_water_mark;
+            """, (WATERMARK_NAME, new_mark))
+            conn.commit()
+            return new_mark
+
+    def _merge(self, cursor, source, target, key, key_expr, bucket_expr, since):
+        # Means are recombined weighted by the number of raw samples of each source bucket
+        cursor.execute(f"""
+            INSERT INTO {target}
+            SELECT
+                {key_expr} AS group_key,
+                {bucket_expr} AS target_bucket,
+                SUM(h.energy_kwh),
+                MIN(h.min_power),
+                MAX(h.max_power),
+                SUM(h.mean_power * h.sample_count) / SUM(h.sample_count),
+                SUM(h.mean_power_factor * h.sample_count) / NULLIF(SUM(CASE WHEN h.mean_power_factor IS NULL THEN 0 ELSE h.sample_count END), 0),
+                SUM(h.sample_count)
+            FROM {source} h
+            JOIN devices d ON d.device_id = h.device_id
+            WHERE h.bucket >= ?
+            GROUP BY group_key, target_bucket
+            ON CONFLICT ({key}, bucket) DO UPDATE SET
+                energy_kwh = EXCLUDED.energy_kwh,
+                min_power = EXCLUDED.min_power,
+                max_power = EXCLUDED.max_power,
+                mean_power = EXCLUDED.mean_power,
+                mean_power_factor = EXCLUDED.mean_power_factor,
+                sample_count = EXCLUDED.sample_count;
+        """, (since,))
+
+    def start_background_refresh(self, interval):
+        """Keep the rollups up to date from a daemon thread, refreshing every `interval` seconds"""
+        def loop():
+            schema_ready = False
+            while True:
+                try:
+                    # Retried with the refresh, the database may not be reachable at startup
+                    if not schema_ready:
+                        self.ensure_schema()
+                        schema_ready = True
+                    self.refresh()
+                except pyodbc.Error as e:
+                    print(f'Rollup refresh failed: {e}')
+                time.sleep(interval)
+
+        thread = Thread(target=loop, daemon=True)
+        thread.start()
+        return thread
+
+
+if __name__ == '__main__':
+    manager = RollupManager(DataDB())
+    manager.ensure_schema()
+    print(f'Rollups refreshed up to {manager.refresh()}')
@@ -99,4 +99,29 @@ class TranslationRouter(BaseRouter):
             message += "translate output\n"
             translate = True
         
-        return str(translate)
\ No newline at end of file
+        return str(translate)
+
+class CacheRouter(BaseRouter):
+    def execute(self) -> str:
+        cache_hit = self.state['cache_hit']
+
+        message = "---CACHE ROUTER---\nROUTE TO: "
+
+        if cache_hit == 'answer':
+            if self.state['target_language'].lower() == 'english':
+                message += "Print cached answer\n"
+                selection = "answer"
+            else:
+                message += "Translate cached answer\n"
+                selection = "translate_answer"
+        elif cache_hit == 'context':
+            message += "Final answer generation from cached context\n"
+            selection = "context"
+        else:
+            message += "Select tool\n"
+            selection = "miss"
+
+        if self.debug:
+            self.memory.save_debug(message)
+
+        return selection
@@ -0,0 +1,129 @@
+import time
+import threading
+import numpy as np
+
+from abc import ABC
+from collections import OrderedDict
+
+from src.config.env import settings
+from src.libs.fast_router import FastRouter
+
+
+class CacheEntry:
+    def __init__(self, question, embedding, signature, answer, context, data_version):
+        self.question = question
+        self.embedding = embedding
+        # Periods, devices and numbers of the question, only an equal signature may reuse the entry
+        self.signature = signature
+        self.answer = answer
+        self.context = context
+        # Newest measurement when the data was fetched, None for answers not backed by the database
+        self.data_version = data_version
+        self.created = time.monotonic()
+
+
+class SemanticCache(ABC):
+    """
+    Answers and tool contexts of previous turns, looked up by meaning.
+
+    Questions are embedded and compared by cosine similarity with the cached
+    ones. Above `answer_threshold` the cached answer is reused as is, above
+    `context_threshold` only the tool context is reused and the answer is
+    generated again for the new wording. Either way the periods, devices and
+    numbers of both questions must be the same, since "last week" and "last
+    month" embed almost alike. Entries expire after `ttl` seconds,
+    the least recently used ones are evicted beyond `max_entries`, and entries
+    built from measurements are dropped as soon as newer measurements exist.
+    """
+    def __init__(self, embedding_model=None, data_version=None, answer_threshold=None, context_threshold=None,
+                 ttl=None, max_entries=None, signature=None):
+        self._embedding_model = embedding_model
+        self.data_version = data_version
+        self.answer_threshold = answer_threshold or settings.SEMANTIC_CACHE_ANSWER_THRESHOLD
+        self.context_threshold = context_threshold or settings.SEMANTIC_CACHE_CONTEXT_THRESHOLD
+        self.ttl = ttl or settings.SEMANTIC_CACHE_TTL
+        self.max_entries = max_entries or settings.SEMANTIC_CACHE_MAX_ENTRIES
+        self.signature = signature or FastRouter().signature
+        self._entries = OrderedDict()  # question -> CacheEntry, least recently used first
+        self._lock = threading.Lock()
+        self._stats = {'hits_answer': 0, 'hits_context': 0, 'misses': 0, 'invalidated': 0, 'evicted': 0}
+
+    @property
+    def embedding_model(self):
+        if self._embedding_model is None:
+            from llama_index.embeddings.huggingface import HuggingFaceEmbedding
+            self._embedding_model = HuggingFaceEmbedding(model_name=settings.HUGGINGFACE_EMBEDDING_MODEL)
+        return self._embedding_model
+
+    def embed(self, text):
+        embedding = np.asarray(self.embedding_model.get_text_embedding(text.strip().lower()), dtype=np.float32)
+        return embedding / max(float(np.linalg.norm(embedding)), 1e-12)
+
+    def _expire(self):
+        now = time.monotonic()
+        for question in [q for q, entry in self._entries.items() if now - entry.created > self.ttl]:
+            del self._entries[question]
+            self._stats['evicted'] += 1
+
+    def lookup(self, question):
+        """(kind, entry) of the closest valid entry, kind being 'answer' or 'context', or (None, None)"""
+        embedding = self.embed(question)
+        signature = self.signature(question)
+        with self._lock:
+            self._expire()
+            entries = list(self._entries.values())
+        if not entries:
+            with self._lock:
+                self._stats['misses'] += 1
+            return None, None
+
+        similarities = np.stack([entry.embedding for entry in entries]) @ embedding
+        current_version = None
+        for i in np.argsort(-similarities):
+            similarity, entry = float(similarities[i]), entries[i]
+            if similarity < self.context_threshold:
+                break
+            if entry.signature != signature:
+                continue
+            # Only a candidate that would be returned costs a query, and at most one per lookup
+            if entry.data_version is not None and self.data_version is not None:
+                if current_version is None:
+                    current_version = self.data_version()
+                if current_version != entry.data_version:
+                    with self._lock:
+                        self._entries.pop(entry.question, None)
+                        self._stats['invalidated'] += 1
+                    continue
+
+            kind = 'answer' if similarity >= self.answer_threshold else 'context'
+            with self._lock:
+                if entry.question in self._entries:
+                    self._entries.move_to_end(entry.question)
+                self._stats[f'hits_{kind}'] += 1
+            return kind, entry
+
+        with self._lock:
+            self._stats['misses'] += 1
+        return None, None
+
+    def store(self, question, answer, context, data_version=None):
+        """`data_version` is the newest measurement when the context was fetched, None if it has no data"""
+        entry = CacheEntry(question, self.embed(question), self.signature(question), answer, list(context), data_version)
+        with self._lock:
+            self._entries[question] = entry
+            self._entries.move_to_end(question)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats['evicted'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+        lookups = stats['hits_answer'] + stats['hits_context'] + stats['misses']
+        stats['hit_rate'] = (stats['hits_answer'] + stats['hits_context']) / lookups if lookups else 0.0
+        return stats
@@ -1,6 +1,10 @@
-from typing import List
+import uuid
+
+from typing import Any, List, Optional
 from typing_extensions import TypedDict
 
+from src.libs.cancellation import CancellationToken
+
 
 ### State
 
@@ -9,37 +13,55 @@ class GraphStateType(TypedDict):
     Represents the state of the graph.
 
     Attributes:
+        run_id: unique identifier of the graph run, scopes per-request caches
         num_steps: number of steps already taken
-        history: a list containing the history of user inputs and model outputs
+        history: recent user inputs and model outputs, preceded by a summary of the older ones
         target_language: target language for translation if needed
         user_input: user input provided to the pipeline
         is_conversation: bypass to the output if the user is simply having a chat with the model
         selected_tool: tool selected to be used
+        data_request: data operation recognised by the fast router (operation, parameters, plot), None otherwise
         context: list of context gathered from the tools
         is_data_complete: boolean to indicate that all necessary context was gathered
         final_answer: final answer generated by the LLM, the one to be displayed to the user
+        cache_hit: 'answer' or 'context' when the semantic cache answered the turn, empty otherwise
+        data_backed: boolean to indicate that the context includes data read from the database
+        data_version: newest measurement when the data of the context was first fetched, None without data
+        cancellation: token cancelled when the user aborts the turn
     """
+    run_id: str
     num_steps: int
     history: List[dict]
     target_language: str
     user_input: str
     is_conversation: bool
     selected_tool: str
+    data_request: Optional[dict]
     context: List[str]
     is_data_complete: bool
     final_answer: str
+    cache_hit: str
+    data_backed: bool
+    data_version: Optional[Any]
+    cancellation: CancellationToken
     
 class GraphState:
     @staticmethod
-    def initialize(user_input: str, history: List[dict]) -> 'GraphStateType':
+    def initialize(user_input: str, history: List[dict], cancellation: Optional[CancellationToken] = None) -> 'GraphStateType':
         return GraphStateType({
+            "run_id": uuid.uuid4().hex,
             "num_steps": 0,
             "history": history,
             "target_language": '',
             "user_input": user_input,
             "is_conversation": False,
             "selected_tool": "",
+            "data_request": None,
             "context": [],
             "is_data_complete": False,
-            "final_answer": ""
+            "final_answer": "",
+            "cache_hit": "",
+            "data_backed": False,
+            "data_version": None,
+            "cancellation": cancellation if cancellation is not None else CancellationToken()
         })
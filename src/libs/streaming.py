@@ -0,0 +1,105 @@
+import numpy as np
+import pyarrow as pa
+
+from typing import Iterator
+
+
+def iter_record_batches(cursor, chunk_size, schema=None) -> Iterator[pa.RecordBatch]:
+    """Yield the pending result set of `cursor` as Arrow record batches of at most `chunk_size` rows"""
+    names = [column[0] for column in cursor.description]
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            return
+        # Rows are transposed into columns chunk by chunk, never materialized as a whole
+        columns = list(zip(*rows))
+        del rows
+        if schema is not None:
+            yield pa.RecordBatch.from_arrays([pa.array(column, type=field.type) for column, field in zip(columns, schema)],
+                                             schema=schema)
+        else:
+            yield pa.RecordBatch.from_arrays([pa.array(column) for column in columns], names=names)
+
+
+class PowerFactorSummary:
+    """
+    Power factor vs. active power statistics built incrementally from record
+    batches: exact moments for the means, correlation and trend line, and a
+    fixed-size reservoir sample of points for plotting. Memory does not depend
+    on the number of readings.
+    """
+    def __init__(self, sample_size=5000, low_power_factor=0.92, seed=0):
+        self.sample_size = sample_size
+        self.low_power_factor = low_power_factor
+        self.count = 0
+        self.low_count = 0
+        self._sx = self._sy = self._sxx = self._syy = self._sxy = 0.0
+        self._sample = np.empty((sample_size, 2))
+        self._rng = np.random.default_rng(seed)
+
+    def update(self, batch: pa.RecordBatch):
+        power = batch.column('active_power').to_numpy(zero_copy_only=False).astype(float)
+        pf = batch.column('power_factor').to_numpy(zero_copy_only=False).astype(float)
+        valid = ~(np.isnan(power) | np.isnan(pf))
+        power, pf = power[valid], pf[valid]
+        n = power.size
+        if n == 0:
+            return
+
+        self._sx += power.sum()
+        self._sy += pf.sum()
+        self._sxx += (power * power).sum()
+        self._syy += (pf * pf).sum()
+        self._sxy += (power * pf).sum()
+        self.low_count += int((pf < self.low_power_factor).sum())
+
+        # Vectorized reservoir sampling (algorithm R)
+        seen = self.count + np.arange(1, n + 1)
+        fill = seen <= self.sample_size
+        self._sample[seen[fill] - 1] = np.column_stack((power[fill], pf[fill]))
+        slots = (self._rng.random(n) * seen).astype(np.int64)
+        replace = ~fill & (slots < self.sample_size)
+        self._sample[slots[replace]] = np.column_stack((power[replace], pf[replace]))
+        self.count += n
+
+    @property
+    def sample(self):
+        return self._sample[:min(self.count, self.sample_size)]
+
+    @property
+    def mean_power(self):
+        return self._sx / self.count if self.count else None
+
+    @property
+    def mean_power_factor(self):
+        return self._sy / self.count if self.count else None
+
+    @property
+    def low_power_factor_share(self):
+        return self.low_count / self.count if self.count else None
+
+    def _variances(self):
+        var_x = self._sxx / self.count - self.mean_power ** 2
+        var_y = self._syy / self.count - self.mean_power_factor ** 2
+        cov = self._sxy / self.count - self.mean_power * self.mean_power_factor
+        return var_x, var_y, cov
+
+    @property
+    def correlation(self):
+        if self.count < 2:
+            return None
+        var_x, var_y, cov = self._variances()
+        if var_x <= 0 or var_y <= 0:
+            return None
+        return cov / np.sqrt(var_x * var_y)
+
+    @property
+    def trend(self):
+        """(slope, intercept) of the least squares line power_factor = slope * active_power + intercept"""
+        if self.count < 2:
+            return None
+        var_x, _, cov = self._variances()
+        if var_x <= 0:
+            return None
+        slope = cov / var_x
+        return slope, self.mean_power_factor - slope * self.mean_power
@@ -0,0 +1,300 @@
+import os
+import glob
+import json
+import uuid
+import sqlite3
+import hashlib
+import threading
+import multiprocessing
+import numpy as np
+
+from abc import ABC
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+from llama_parse import LlamaParse, ResultType
+from llama_index.core import Document
+from llama_index.core.node_parser import SentenceSplitter
+from llama_index.core.schema import MetadataMode
+from llama_index.readers.file import PDFReader
+from llama_index.embeddings.huggingface import HuggingFaceEmbedding
+
+from src.config.env import settings
+
+
+SOURCE_DIR = 'rag_source'
+
+# Everything that changes the parsed text of a file has to be part of the cache key
+PARSERS = {
+    'llamaparse': {'parser': 'llamaparse', 'result_type': ResultType.MD.value, 'split_by_page': True},
+    'local': {'parser': 'pypdf', 'return_full_document': False},
+}
+
+
+def file_hash(path, block_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def source_files(source_dir=SOURCE_DIR):
+    """Content hash of every PDF in the source folder, by file name"""
+    return {os.path.basename(path): file_hash(path) for path in sorted(glob.glob(os.path.join(source_dir, '*.pdf')))}
+
+
+def parse_pages(path, parser):
+    """Text of every page of a PDF using the given parser"""
+    if parser == 'llamaparse':
+        return [document.text for document in LlamaParse(result_type=ResultType.MD).load_data(path)]
+    return [document.text for document in PDFReader(return_full_document=False).load_data(file=Path(path))]
+
+
+def parse_pdf(path, content_hash, parser=None, cache=None):
+    """Parsed pages of a PDF as documents tagged with the file, page and content hash they come from"""
+    parser = parser or settings.RAG_PARSER
+    pages = cache.get(content_hash, parser) if cache is not None else None
+    if pages is None:
+        try:
+            pages = parse_pages(path, parser)
+        except Exception as e:
+            if parser == 'local':
+                raise
+            # LlamaParse is a remote service, offline builds still get the local parse
+            print(f'{parser} failed on {os.path.basename(path)} ({e}), falling back to the local parser.')
+            parser = 'local'
+            pages = cache.get(content_hash, parser) if cache is not None else None
+            if pages is None:
+                pages = parse_pages(path, parser)
+        if cache is not None:
+            cache.put(content_hash, parser, pages)
+
+    name = os.path.basename(path)
+    documents = []
+    for page, text in enumerate(pages, start=1):
+        # Stable ids, so the vectors of this exact file version can be found and deleted later
+        document = Document(text=text, id_=f'{name}-{content_hash[:16]}-{page}',
+                            metadata={'file_name': name, 'page_label': str(page), 'file_hash': content_hash})
+        document.excluded_embed_metadata_keys.append('file_hash')
+        document.excluded_llm_metadata_keys.append('file_hash')
+        documents.append(document)
+    return documents
+
+
+class ParseCache(ABC):
+    """
+    Parsed pages of the RAG source files stored on disk, one JSON file per
+    (content hash, parser settings) pair. Rebuilding the collection, e.g.
+    after an embedding model change, never parses the same file twice.
+    """
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir or settings.RAG_PARSE_CACHE_DIR
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def key(self, content_hash, parser):
+        parser_settings = json.dumps(PARSERS[parser], sort_keys=True)
+        return hashlib.sha256(f'{content_hash}:{parser_settings}'.encode()).hexdigest()
+
+    def path(self, content_hash, parser):
+        return os.path.join(self.cache_dir, f'{self.key(content_hash, parser)}.json')
+
+    def get(self, content_hash, parser):
+        try:
+            with open(self.path(content_hash, parser), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def put(self, content_hash, parser, pages):
+        path = self.path(content_hash, parser)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(pages, f)
+        os.replace(tmp_path, path)
+
+
+class SourceManifest(ABC):
+    """
+    Record of the indexed version of every RAG source file.
+
+    Each entry maps a PDF file name to its content hash and the ids of the
+    documents inserted in the vector store for it. Comparing it to the hashes
+    on disk tells which files have to be (re)indexed and which documents have
+    to be deleted, so only changed files are ever parsed and embedded again.
+    """
+    def __init__(self, path=os.path.join(SOURCE_DIR, 'manifest.json')):
+        # No path: the index lives only as long as the process, and so does the manifest
+        self.path = path
+        self.exists = path is not None and os.path.exists(path)
+        self.entries = self._load()
+
+    def _load(self):
+        if self.path is None:
+            return {}
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save(self):
+        if self.path is None:
+            return
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.entries, f, indent=2)
+        os.replace(tmp_path, self.path)
+        self.exists = True
+
+    def diff(self, current):
+        """(stale, pending) file names: entries to delete from the index and files to index"""
+        stale = [name for name, entry in self.entries.items() if current.get(name) != entry['hash']]
+        pending = [name for name, content_hash in current.items()
+                   if name not in self.entries or self.entries[name]['hash'] != content_hash]
+        return stale, pending
+
+    def add(self, name, content_hash, doc_ids):
+        self.entries[name] = {'hash': content_hash, 'doc_ids': list(doc_ids)}
+        self.save()
+
+    def remove(self, name):
+        self.entries.pop(name, None)
+        self.save()
+
+
+class EmbeddingCache(ABC):
+    """Chunk embeddings stored in SQLite, keyed by (chunk hash, embedding model)"""
+    def __init__(self, path=None):
+        self.path = path or settings.RAG_EMBEDDING_CACHE_PATH
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS embeddings (
+                    chunk_hash TEXT NOT NULL,
+                    model TEXT NOT NULL,
+                    embedding BLOB NOT NULL,
+                    PRIMARY KEY (chunk_hash, model)
+                );
+            """)
+
+    def get_many(self, chunk_hashes, model, batch_size=500):
+        found = {}
+        with self._lock:
+            for i in range(0, len(chunk_hashes), batch_size):
+                batch = chunk_hashes[i:i + batch_size]
+                rows = self._conn.execute(
+                    f"SELECT chunk_hash, embedding FROM embeddings WHERE model = ? AND chunk_hash IN ({', '.join('?' * len(batch))})",
+                    [model, *batch])
+                for chunk_hash, embedding in rows:
+                    found[chunk_hash] = np.frombuffer(embedding, dtype=np.float32).tolist()
+        return found
+
+    def put_many(self, items, model):
+        """Store (chunk_hash, embedding) pairs"""
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (chunk_hash, model, embedding) VALUES (?, ?, ?)",
+                [(chunk_hash, model, np.asarray(embedding, dtype=np.float32).tobytes()) for chunk_hash, embedding in items])
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+_worker_model = None
+
+
+def _init_embedding_worker(model_name, batch_size, threads):
+    global _worker_model
+    import torch
+    # Workers share the cores, so every process only gets its slice of them
+    torch.set_num_threads(threads)
+    _worker_model = HuggingFaceEmbedding(model_name=model_name, embed_batch_size=batch_size)
+
+
+def _embed_batch(texts):
+    return _worker_model.get_text_embedding_batch(texts)
+
+
+class IngestionPipeline(ABC):
+    """
+    Chunking, embedding and upserting of parsed RAG documents.
+
+    Documents are split with a SentenceSplitter, chunks already embedded with
+    the same model are taken from the embedding cache and the rest are embedded
+    in batches across a pool of worker processes (one model copy per worker),
+    then all nodes are upserted into the vector store in bulk batches. The
+    worker pool is started on first use and kept for every `run` until `close`.
+    """
+    def __init__(self, vector_store, embedding_model, model_name, cache=None, workers=None, batch_size=None,
+                 upsert_batch_size=None, chunk_size=None, chunk_overlap=None):
+        self.vector_store = vector_store
+        self.embedding_model = embedding_model
+        self.model_name = model_name
+        self.cache = cache or EmbeddingCache()
+        # Every worker loads its own copy of the embedding model, so keep them few
+        self.workers = workers if workers is not None else settings.RAG_EMBED_WORKERS
+        self.batch_size = batch_size or settings.RAG_EMBED_BATCH_SIZE
+        self.upsert_batch_size = upsert_batch_size or settings.RAG_UPSERT_BATCH_SIZE
+        self.splitter = SentenceSplitter(chunk_size=chunk_size or settings.RAG_CHUNK_SIZE,
+                                         chunk_overlap=chunk_overlap or settings.RAG_CHUNK_OVERLAP)
+        self._executor = None
+
+    def split(self, documents):
+        nodes = self.splitter.get_nodes_from_documents(documents)
+        chunk_numbers = {}
+        for node in nodes:
+            # Deterministic point ids, numbered within their document so they don't depend on
+            # what else is ingested: re-running an interrupted ingestion overwrites instead of duplicating
+            i = chunk_numbers.get(node.ref_doc_id, 0)
+            chunk_numbers[node.ref_doc_id] = i + 1
+            node.id_ = str(uuid.uuid5(uuid.NAMESPACE_URL, f'{node.ref_doc_id}/{i}'))
+        return nodes
+
+    def executor(self):
+        if self._executor is None:
+            threads = max(1, (os.cpu_count() or 1) // self.workers)
+            # spawn: forking a process that already loaded torch is not safe
+            self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'),
+                                                 initializer=_init_embedding_worker,
+                                                 initargs=(self.model_name, self.batch_size, threads))
+        return self._executor
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        self.cache.close()
+
+    def embed(self, texts):
+        batches = [texts[i:i + self.batch_size] for i in range(0, len(texts), self.batch_size)]
+        if self.workers <= 1 or len(batches) <= 1:
+            return self.embedding_model.get_text_embedding_batch(texts)
+        return [embedding for batch in self.executor().map(_embed_batch, batches) for embedding in batch]
+
+    def run(self, documents):
+        """Index the documents, returning the number of chunks upserted"""
+        nodes = self.split(documents)
+        if not nodes:
+            return 0
+
+        texts = [node.get_content(metadata_mode=MetadataMode.EMBED) for node in nodes]
+        hashes = [hashlib.sha256(text.encode('utf-8')).hexdigest() for text in texts]
+        cached = self.cache.get_many(list(set(hashes)), self.model_name)
+
+        missing = sorted({chunk_hash: i for i, chunk_hash in enumerate(hashes) if chunk_hash not in cached}.values())
+        if missing:
+            print(f'Embedding {len(missing)} chunks ({len(nodes) - len(missing)} cached).')
+            embeddings = self.embed([texts[i] for i in missing])
+            new = [(hashes[i], embedding) for i, embedding in zip(missing, embeddings)]
+            self.cache.put_many(new, self.model_name)
+            cached.update(new)
+
+        for node, chunk_hash in zip(nodes, hashes):
+            node.embedding = cached[chunk_hash]
+        for i in range(0, len(nodes), self.upsert_batch_size):
+            self.vector_store.add(nodes[i:i + self.upsert_batch_size])
+        return len(nodes)
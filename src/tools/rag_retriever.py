@@ -1,57 +1,153 @@
-import glob
-import pickle
-import qdrant_client
+import os
+import asyncio
 
 from abc import ABC
 
 from langchain_groq import ChatGroq
 
-from llama_parse import LlamaParse, ResultType
-
 from llama_index.embeddings.huggingface import HuggingFaceEmbedding
 from llama_index.core import Settings
-from llama_index.core import VectorStoreIndex, StorageContext
-from llama_index.vector_stores.qdrant import QdrantVectorStore
+from llama_index.core import VectorStoreIndex
+from llama_index.core import get_response_synthesizer
+from llama_index.core.schema import NodeWithScore
+from qdrant_client.http import models
 
 from src.config.env import settings
+from src.libs.concurrency import fan_out, afan_out
+from src.tools.rag_ingestion import SOURCE_DIR, IngestionPipeline, ParseCache, SourceManifest, source_files, parse_pdf
+from src.tools.vector_stores import COLLECTION_NAME, NumpyVectorStore, build_vector_store, manifest_path
 
 
 class RAGRetriever(ABC):
     def __init__(self, chat_model: ChatGroq):
-        pdf_list = [f.split('/')[-1] for f in glob.glob('rag_source/*.pdf')]
-
-        try:
-            with open('rag_source/metadata.pkl', 'rb') as handle:
-                old_pdf_list = pickle.load(handle)
-            update_collection = False if old_pdf_list == pdf_list else True
-            print('No updates detected on the RAG source files, proceeding with current collection.')
-        except:
-            update_collection = True
-            print('RAG source files changed, updating collection.')
-
-        client = qdrant_client.QdrantClient(api_key=settings.QDRANT_API_KEY.get_secret_value(), url=settings.QDRANT_URL)
+        vector_store = build_vector_store()
+        client = vector_store.client
         embedding_model = HuggingFaceEmbedding(model_name=settings.HUGGINGFACE_EMBEDDING_MODEL)
         
         Settings.embed_model = embedding_model
         Settings.llm = chat_model
-            
-        if update_collection:
-            pdf_files = glob.glob('rag_source/*.pdf')
-            parsed_documents = []
-            for pdf_file in pdf_files:
-                parsed_documents.extend(LlamaParse(result_type=ResultType.MD).load_data(pdf_file))
-            
-            vector_store = QdrantVectorStore(client=client, collection_name='pdf_paper_rag')
-            storage_context = StorageContext.from_defaults(vector_store=vector_store)
-            index = VectorStoreIndex.from_documents(documents=parsed_documents, storage_context=storage_context, show_progress=True)
-            
-            with open('rag_source/metadata.pkl', 'wb') as handle:
-                pickle.dump(pdf_list, handle, protocol=pickle.HIGHEST_PROTOCOL)
-        else:
-            vector_store = QdrantVectorStore(client=client, collection_name='pdf_paper_rag')
-            index = VectorStoreIndex.from_vector_store(vector_store, embedding_model)
+
+        manifest = SourceManifest(manifest_path())
+        if client is not None and not manifest.exists and client.collection_exists(COLLECTION_NAME):
+            # Collection built before the manifest existed: its vectors can't be matched to files, start over
+            print('No RAG source manifest found, rebuilding collection.')
+            client.delete(COLLECTION_NAME, points_selector=models.FilterSelector(filter=models.Filter()))
+
+        index = VectorStoreIndex.from_vector_store(vector_store, embedding_model)
+        self.sync_sources(vector_store, embedding_model, manifest)
         
-        self.query_engine = index.as_query_engine()
+        self.client = client
+        self.index = index
+        self.embedding_model = embedding_model
+        self.vector_store = vector_store
+        self.top_k = settings.RAG_SIMILARITY_TOP_K
+        self.query_engine = index.as_query_engine(similarity_top_k=self.top_k)
+        self.synthesizer = get_response_synthesizer()
+        self._vector_name = None
     
+    def sync_sources(self, vector_store, embedding_model, manifest):
+        """Bring the collection up to date with rag_source/, indexing only new or changed PDFs"""
+        current = source_files()
+        stale, pending = manifest.diff(current)
+        if not stale and not pending:
+            print('No updates detected on the RAG source files, proceeding with current collection.')
+            return
+
+        for name in stale:
+            print(f'Removing outdated RAG source {name} from the collection.')
+            for doc_id in manifest.entries[name]['doc_ids']:
+                vector_store.delete(doc_id)
+            manifest.remove(name)
+
+        if not pending:
+            return
+        parse_cache = ParseCache()
+        # One pipeline for all pending files, so the embedding workers start only once
+        pipeline = IngestionPipeline(vector_store, embedding_model, settings.HUGGINGFACE_EMBEDDING_MODEL)
+        try:
+            for name in pending:
+                print(f'Parsing RAG source {name}.')
+                documents = parse_pdf(os.path.join(SOURCE_DIR, name), current[name], cache=parse_cache)
+                pipeline.run(documents)
+                # Recorded file by file, an interrupted sync resumes from the first file not indexed
+                manifest.add(name, current[name], [document.doc_id for document in documents])
+        finally:
+            pipeline.close()
+
     def execute(self, query):
-        return self.query_engine.query(query)
\ No newline at end of file
+        return self.query_engine.query(query)
+
+    async def aexecute(self, query):
+        return await self.query_engine.aquery(query)
+
+    @staticmethod
+    def to_chunk(node_with_score):
+        metadata = node_with_score.node.metadata
+        file_path = metadata.get('file_name') or metadata.get('file_path')
+        return {
+            'id': node_with_score.node.node_id,
+            'text': node_with_score.node.get_content(),
+            'score': node_with_score.score,
+            'file': os.path.basename(file_path) if file_path else 'PDF paper',
+            'page': metadata.get('page_label'),
+        }
+
+    def retrieve(self, query, top_k=None):
+        """Top-k chunks for the query (text, score, file and page), without any LLM synthesis"""
+        retriever = self.index.as_retriever(similarity_top_k=top_k or self.top_k)
+        return [self.to_chunk(node) for node in retriever.retrieve(query)]
+
+    async def aretrieve(self, query, top_k=None):
+        retriever = self.index.as_retriever(similarity_top_k=top_k or self.top_k)
+        return [self.to_chunk(node) for node in await retriever.aretrieve(query)]
+
+    def retrieve_many(self, queries, top_k=None):
+        """retrieve() for every query through a single batched embedding and Qdrant request"""
+        return [[self.to_chunk(node) for node in nodes] for nodes in self.retrieve_batch(queries, top_k)]
+
+    def vector_name(self):
+        """Name of the dense vector in the collection, None for collections with a single unnamed vector"""
+        if self._vector_name is None:
+            vectors = self.client.get_collection(COLLECTION_NAME).config.params.vectors
+            self._vector_name = self.vector_store.dense_vector_name if isinstance(vectors, dict) else ''
+        return self._vector_name or None
+
+    def embed_queries(self, queries):
+        """
+        Query embeddings of every query, the same get_query_embedding computes
+        (query instruction or prefix included), in one batch when the model allows it
+        """
+        embed = getattr(self.embedding_model, '_embed', None)
+        if embed is not None:
+            # HuggingFaceEmbedding: the call behind _get_query_embedding, for all the queries at once
+            embeddings = embed(list(queries), prompt_name='query')
+            return embeddings.tolist() if hasattr(embeddings, 'tolist') else embeddings
+        return [self.embedding_model.get_query_embedding(query) for query in queries]
+
+    def retrieve_batch(self, queries, top_k=None):
+        """Top-k nodes of every query using one embedding batch and one multi-vector Qdrant request"""
+        top_k = top_k or self.top_k
+        # Query-side embeddings for every backend, documents were embedded with the text path
+        embeddings = self.embed_queries(queries)
+        if isinstance(self.vector_store, NumpyVectorStore):
+            return [[NodeWithScore(node=node, score=score) for node, score in zip(result.nodes, result.similarities)]
+                    for result in self.vector_store.query_batch(embeddings, top_k)]
+
+        requests = [models.QueryRequest(query=embedding, using=self.vector_name(), limit=top_k, with_payload=True)
+                    for embedding in embeddings]
+        responses = self.client.query_batch_points(collection_name=COLLECTION_NAME, requests=requests)
+
+        results = []
+        for response in responses:
+            result = self.vector_store.parse_to_query_result(response.points)
+            results.append([NodeWithScore(node=node, score=score) for node, score in zip(result.nodes, result.similarities)])
+        return results
+
+    def execute_batch(self, queries, concurrency, timeout):
+        """Same answers as execute() for every query, with the retrieval batched and the syntheses run concurrently"""
+        nodes = self.retrieve_batch(queries)
+        return fan_out(lambda pair: self.synthesizer.synthesize(*pair), list(zip(queries, nodes)), concurrency, timeout)
+
+    async def aexecute_batch(self, queries, concurrency, timeout):
+        nodes = await asyncio.to_thread(self.retrieve_batch, queries)
+        return await afan_out(lambda pair: self.synthesizer.asynthesize(*pair), list(zip(queries, nodes)), concurrency, timeout)
@@ -0,0 +1,190 @@
+import os
+import json
+import threading
+import numpy as np
+import qdrant_client
+
+from typing import Any, List
+from collections import defaultdict
+
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.core.schema import BaseNode
+from llama_index.core.vector_stores.types import BasePydanticVectorStore, VectorStoreQuery, VectorStoreQueryResult
+from llama_index.core.vector_stores.utils import metadata_dict_to_node, node_to_metadata_dict
+from llama_index.vector_stores.qdrant import QdrantVectorStore
+
+from src.config.env import settings
+from src.tools.rag_ingestion import SOURCE_DIR
+
+
+COLLECTION_NAME = 'pdf_paper_rag'
+BACKENDS = ('remote', 'memory', 'local', 'numpy')
+
+
+class NumpyVectorStore(BasePydanticVectorStore):
+    """
+    Exact cosine-similarity vector store kept in a local folder.
+
+    Normalized float32 vectors are appended to a raw file that is read through
+    a memory map, so queries are one matrix product over the page cache and
+    never touch the network. Node records go to an append-only JSON lines log
+    next to it; deletions are logged too and only mask the rows they remove.
+    """
+    stores_text: bool = True
+    flat_metadata: bool = False
+    path: str
+
+    _lock: Any = PrivateAttr()
+    _dim: Any = PrivateAttr(default=None)
+    _vectors: Any = PrivateAttr(default=None)
+    _records: Any = PrivateAttr(default_factory=list)  # (node_id, ref_doc_id, node_dict) per row
+    _alive: Any = PrivateAttr(default=None)
+
+    def __init__(self, path: str, **kwargs: Any):
+        super().__init__(path=path, **kwargs)
+        os.makedirs(path, exist_ok=True)
+        self._lock = threading.Lock()
+        self._load()
+
+    @classmethod
+    def class_name(cls) -> str:
+        return 'NumpyVectorStore'
+
+    @property
+    def client(self) -> Any:
+        return None
+
+    @property
+    def vectors_path(self):
+        return os.path.join(self.path, 'vectors.f32')
+
+    @property
+    def log_path(self):
+        return os.path.join(self.path, 'records.jsonl')
+
+    def _load(self):
+        records, alive = [], []
+        rows_by_id, rows_by_doc = {}, defaultdict(list)
+        try:
+            with open(self.log_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    entry = json.loads(line)
+                    if 'dim' in entry:
+                        self._dim = entry['dim']
+                    elif 'delete' in entry:
+                        for row in rows_by_doc.pop(entry['delete'], []):
+                            alive[row] = False
+                    else:
+                        # A node added again replaces its previous row
+                        previous = rows_by_id.get(entry['id'])
+                        if previous is not None:
+                            alive[previous] = False
+                        rows_by_id[entry['id']] = len(records)
+                        rows_by_doc[entry['ref_doc_id']].append(len(records))
+                        records.append((entry['id'], entry['ref_doc_id'], entry['node']))
+                        alive.append(True)
+        except OSError:
+            pass
+
+        rows = os.path.getsize(self.vectors_path) // (4 * self._dim) if self._dim and os.path.exists(self.vectors_path) else 0
+        # A crash between the vector and the record write leaves rows without a record (or a
+        # partial row): cut them off, the next add must append right after the last recorded row
+        rows = min(rows, len(records))
+        if self._dim and os.path.exists(self.vectors_path) and os.path.getsize(self.vectors_path) != rows * self._dim * 4:
+            os.truncate(self.vectors_path, rows * self._dim * 4)
+        self._records = records[:rows]
+        self._alive = np.asarray(alive[:rows], dtype=bool)
+        self._map(rows)
+
+    def _map(self, rows):
+        self._vectors = np.memmap(self.vectors_path, dtype=np.float32, mode='r', shape=(rows, self._dim)) if rows else None
+
+    def _append_log(self, entries):
+        with open(self.log_path, 'a', encoding='utf-8') as f:
+            for entry in entries:
+                f.write(json.dumps(entry) + '\n')
+
+    def add(self, nodes: List[BaseNode], **add_kwargs: Any) -> List[str]:
+        if not nodes:
+            return []
+        vectors = np.asarray([node.get_embedding() for node in nodes], dtype=np.float32)
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+        with self._lock:
+            entries = []
+            if self._dim is None:
+                self._dim = vectors.shape[1]
+                entries.append({'dim': self._dim})
+            elif vectors.shape[1] != self._dim:
+                raise ValueError(f'Embedding dimension {vectors.shape[1]} does not match the store dimension {self._dim}')
+
+            ids = {node.node_id for node in nodes}
+            self._alive &= np.asarray([record[0] not in ids for record in self._records], dtype=bool)
+            with open(self.vectors_path, 'ab') as f:
+                f.write(vectors.tobytes())
+            for node in nodes:
+                record = (node.node_id, node.ref_doc_id, node_to_metadata_dict(node, remove_text=False, flat_metadata=False))
+                self._records.append(record)
+                entries.append({'id': record[0], 'ref_doc_id': record[1], 'node': record[2]})
+            self._append_log(entries)
+            self._alive = np.concatenate((self._alive, np.ones(len(nodes), dtype=bool)))
+            self._map(len(self._records))
+        return [node.node_id for node in nodes]
+
+    def delete(self, ref_doc_id: str, **delete_kwargs: Any) -> None:
+        with self._lock:
+            self._alive &= np.asarray([record[1] != ref_doc_id for record in self._records], dtype=bool)
+            self._append_log([{'delete': ref_doc_id}])
+
+    def query_batch(self, embeddings, top_k) -> List[VectorStoreQueryResult]:
+        """Top-k rows for every query embedding with a single matrix product"""
+        with self._lock:
+            vectors, alive, records = self._vectors, self._alive, self._records
+        if vectors is None or not alive.any():
+            return [VectorStoreQueryResult(nodes=[], similarities=[], ids=[]) for _ in embeddings]
+
+        queries = np.asarray(embeddings, dtype=np.float32)
+        queries /= np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+        scores = queries @ vectors.T
+        scores[:, ~alive] = -np.inf
+        k = min(top_k, int(alive.sum()))
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+
+        results = []
+        for row_scores, row_top in zip(scores, top):
+            row_top = row_top[np.argsort(-row_scores[row_top])]
+            nodes = [metadata_dict_to_node(records[i][2]) for i in row_top]
+            results.append(VectorStoreQueryResult(nodes=nodes, similarities=[float(row_scores[i]) for i in row_top],
+                                                  ids=[records[i][0] for i in row_top]))
+        return results
+
+    def query(self, query: VectorStoreQuery, **kwargs: Any) -> VectorStoreQueryResult:
+        return self.query_batch([query.query_embedding], query.similarity_top_k)[0]
+
+
+def build_vector_store(backend=None):
+    """Vector store of the RAG collection for the configured backend"""
+    backend = backend or settings.VECTOR_STORE_BACKEND
+    if backend == 'numpy':
+        return NumpyVectorStore(settings.NUMPY_VECTOR_STORE_PATH)
+    if backend == 'remote':
+        client = qdrant_client.QdrantClient(api_key=settings.QDRANT_API_KEY.get_secret_value(), url=settings.QDRANT_URL)
+    elif backend == 'memory':
+        client = qdrant_client.QdrantClient(location=':memory:')
+    elif backend == 'local':
+        client = qdrant_client.QdrantClient(path=settings.QDRANT_PATH)
+    else:
+        raise ValueError(f'Unknown vector store backend {backend!r}, expected one of {BACKENDS}')
+    return QdrantVectorStore(client=client, collection_name=COLLECTION_NAME)
+
+
+def manifest_path(backend=None):
+    """Where the source manifest of a backend lives (next to its data), None for the in-memory store"""
+    backend = backend or settings.VECTOR_STORE_BACKEND
+    if backend == 'remote':
+        return os.path.join(SOURCE_DIR, 'manifest.json')
+    if backend == 'local':
+        return os.path.join(settings.QDRANT_PATH, 'manifest.json')
+    if backend == 'numpy':
+        return os.path.join(settings.NUMPY_VECTOR_STORE_PATH, 'manifest.json')
+    return None
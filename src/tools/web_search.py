@@ -1,3 +1,6 @@
+import time
+import asyncio
+
 from abc import ABC
 
 from langchain_community.tools.tavily_search import TavilySearchResults
@@ -9,4 +12,24 @@ class WebSearchTool(ABC):
         self.web_search_tool = TavilySearchResults(tavily_api_key=settings.TAVILY_API_KEY)
     
     def execute(self, query):
-        return self.web_search_tool.invoke({"query": query, "max_results": 3})
\ No newline at end of file
+        return self.web_search_tool.invoke({"query": query, "max_results": 3})
+
+    async def aexecute(self, query):
+        return await self.web_search_tool.ainvoke({"query": query, "max_results": 3})
+
+
+class StubWebSearchTool(ABC):
+    """Offline stand-in for WebSearchTool returning canned results after a fixed latency"""
+    def __init__(self, latency=0.5):
+        self.latency = latency
+
+    def results(self, query):
+        return [{"url": f"https://example.com/{i}", "content": f"Result {i} for {query}"} for i in range(3)]
+
+    def execute(self, query):
+        time.sleep(self.latency)
+        return self.results(query)
+
+    async def aexecute(self, query):
+        await asyncio.sleep(self.latency)
+        return self.results(query)